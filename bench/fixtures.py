@@ -0,0 +1,287 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import re
+import subprocess
+import uuid
+
+from aiohttp import web
+
+from core.ffmpeg import FFMPEG_PATH
+from core.models import YouTubeDownloader
+
+
+class FixtureDownloader(YouTubeDownloader):
+    # Only used by the benchmarks, yt-dlp's generic extractor handles the local URLs.
+    pattern = re.compile(r'https?://127\.0\.0\.1:\d+/media/(?P<id>[\w.-]+)')
+    hosts = ("127.0.0.1",)
+
+
+def make_download_fixture(path: str, size: int) -> str:
+    # Random bytes, only downloaded and never decoded, with the size of a long video's stream.
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        return path
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "wb") as f:
+        for offset in range(0, size, 1024 * 1024):
+            f.write(os.urandom(min(1024 * 1024, size - offset)))
+    return path
+
+
+def make_fixture(path: str, duration: int = 30, size: str = "1280x720") -> str:
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    subprocess.run([
+        FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', f"testsrc2=duration={duration}:size={size}:rate=30",
+        '-f', 'lavfi', '-i', f"sine=frequency=440:duration={duration}",
+        '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-b:a', '128k', '-shortest', '-movflags', '+faststart',
+        path,
+    ], check=True)
+    return path
+
+
+# Serves fixture media, a tmpfiles.org compatible upload endpoint and a bare S3 stand-in on localhost.
+class LocalServers:
+    def __init__(self, media_directory: str):
+        self.media_directory: str = media_directory
+        self.upload_directory: str | None = None
+        self.runner: web.AppRunner | None = None
+        self.port: int | None = None
+        self.uploaded_bytes: int = 0
+        self.uploads: int = 0
+        self.multipart: dict[str, dict[int, bytes]] = {}
+        # Bytes per second per connection on /throttled, like a CDN that limits each connection. 0 is unlimited.
+        self.connection_rate: int = 0
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def upload_url(self) -> str:
+        return f"{self.base_url}/api/v1/upload"
+
+    @property
+    def s3_endpoint(self) -> str:
+        return f"{self.base_url}/s3"
+
+    def media_url(self, name: str) -> str:
+        return f"{self.base_url}/media/{name}"
+
+    async def handle_upload(self, request: web.Request) -> web.Response:
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name != 'file':
+                continue
+
+            name = f"{uuid.uuid4().hex}-{part.filename}"
+            with open(os.path.join(self.upload_directory, name), "wb") as f:
+                while chunk := await part.read_chunk(1024 * 1024):
+                    f.write(chunk)
+                    self.uploaded_bytes += len(chunk)
+
+            self.uploads += 1
+            return web.json_response({"status": "success", "data": {"url": f"{self.base_url}/uploads/{name}"}})
+
+        return web.json_response({"status": "error"}, status=400)
+
+    async def handle_throttled(self, request: web.Request) -> web.StreamResponse:
+        path = os.path.join(self.media_directory, os.path.basename(request.match_info["name"]))
+        if not os.path.isfile(path):
+            raise web.HTTPNotFound()
+
+        size = os.path.getsize(path)
+        requested = request.http_range
+        start = requested.start or 0
+        if start < 0:
+            start = max(0, size + start)
+        stop = size if requested.stop is None else min(requested.stop, size)
+        headers = {"Content-Type": "video/mp4", "Accept-Ranges": "bytes", "Content-Length": str(stop - start)}
+        status = 200
+        if "Range" in request.headers:
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+        if request.method == "HEAD":
+            return response
+
+        chunk_size = max(16 * 1024, self.connection_rate // 20) if self.connection_rate else 1024 * 1024
+        try:
+            with open(path, "rb") as f:
+                f.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    data = f.read(min(chunk_size, remaining))
+                    await response.write(data)
+                    remaining -= len(data)
+                    if self.connection_rate:
+                        await asyncio.sleep(len(data) / self.connection_rate)
+            await response.write_eof()
+        except ConnectionResetError:
+            # yt-dlp's generic extractor only reads the start of the file to recognise it.
+            pass
+        return response
+
+    def s3_path(self, request: web.Request) -> str:
+        path = os.path.join(self.upload_directory, "s3", request.match_info["key"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    # Only what S3Backend uses: single PUT, multipart create, part, complete and abort. Signatures aren't checked.
+    async def handle_s3_put(self, request: web.Request) -> web.Response:
+        data = await request.read()
+        self.uploaded_bytes += len(data)
+        upload_id = request.query.get("uploadId")
+        if upload_id is not None:
+            self.multipart[upload_id][int(request.query["partNumber"])] = data
+            return web.Response(headers={"ETag": f'"{upload_id}-{request.query["partNumber"]}"'})
+
+        with open(self.s3_path(request), "wb") as f:
+            f.write(data)
+        self.uploads += 1
+        return web.Response()
+
+    async def handle_s3_post(self, request: web.Request) -> web.Response:
+        if "uploads" in request.query:
+            upload_id = uuid.uuid4().hex
+            self.multipart[upload_id] = {}
+            body = f"<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>"
+            return web.Response(text=body, content_type="application/xml")
+
+        parts = self.multipart.pop(request.query["uploadId"])
+        with open(self.s3_path(request), "wb") as f:
+            for number in sorted(parts):
+                f.write(parts[number])
+        self.uploads += 1
+        return web.Response(text="<CompleteMultipartUploadResult/>", content_type="application/xml")
+
+    async def handle_s3_delete(self, request: web.Request) -> web.Response:
+        self.multipart.pop(request.query.get("uploadId", ""), None)
+        return web.Response(status=204)
+
+    async def start(self, upload_directory: str) -> None:
+        self.upload_directory = upload_directory
+        app = web.Application(client_max_size=1024 ** 4)
+        app.router.add_post("/api/v1/upload", self.handle_upload)
+        app.router.add_put("/s3/{key:.+}", self.handle_s3_put)
+        app.router.add_post("/s3/{key:.+}", self.handle_s3_post)
+        app.router.add_delete("/s3/{key:.+}", self.handle_s3_delete)
+        app.router.add_static("/media", self.media_directory)
+        app.router.add_get("/throttled/{name}", self.handle_throttled)
+        app.router.add_static("/uploads", upload_directory)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        _, self.port = self.runner.addresses[0][:2]
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+# A Redis stand-in speaking just the commands the job broker uses, so worker mode runs without a Redis server.
+class RespStandIn:
+    def __init__(self):
+        self.values: dict[bytes, bytes] = {}
+        self.lists: dict[bytes, list[bytes]] = {}
+        self.changed: asyncio.Condition = asyncio.Condition()
+        self.server: asyncio.Server | None = None
+        self.port: int | None = None
+        self.connections: set[asyncio.Task[None]] = set()
+
+    @property
+    def url(self) -> str:
+        return f"redis://127.0.0.1:{self.port}/0"
+
+    @staticmethod
+    async def read_command(reader: asyncio.StreamReader) -> list[bytes] | None:
+        line = await reader.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int((await reader.readline())[1:-2])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    @staticmethod
+    def encode(value: object) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, str):
+            return f"+{value}\r\n".encode()
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(RespStandIn.encode(item) for item in value)
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    async def pop(self, key: bytes, timeout: float, right: bool) -> list[bytes] | None:
+        async with self.changed:
+            try:
+                await asyncio.wait_for(self.changed.wait_for(lambda: bool(self.lists.get(key))), timeout or None)
+            except asyncio.TimeoutError:
+                return None
+            items = self.lists[key]
+            return [key, items.pop() if right else items.pop(0)]
+
+    async def execute(self, name: str, args: list[bytes]) -> object:
+        if name in ("PING", "AUTH", "SELECT"):
+            return "OK"
+        if name == "SET":
+            self.values[args[0]] = args[1]
+            return "OK"
+        if name == "GET":
+            return self.values.get(args[0])
+        if name == "EXISTS":
+            return int(args[0] in self.values or bool(self.lists.get(args[0])))
+        if name == "EXPIRE":
+            return 1
+        if name in ("LPUSH", "RPUSH"):
+            items = self.lists.setdefault(args[0], [])
+            for value in args[1:]:
+                items.insert(0, value) if name == "LPUSH" else items.append(value)
+            async with self.changed:
+                self.changed.notify_all()
+            return len(items)
+        if name in ("BRPOP", "BLPOP"):
+            return await self.pop(args[0], float(args[-1]), right=name == "BRPOP")
+        raise ValueError(name)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            while (command := await self.read_command(reader)) is not None:
+                try:
+                    reply = self.encode(await self.execute(command[0].decode().upper(), command[1:]))
+                except ValueError as e:
+                    reply = f"-ERR unknown command {e}\r\n".encode()
+                writer.write(reply)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            self.server.close()
+        # Closing the server leaves open connections running, a blocked pop would outlive the loop.
+        for task in list(self.connections):
+            task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
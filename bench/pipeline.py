@@ -0,0 +1,287 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def cpu_seconds() -> float:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is in KiB on Linux, each case runs in its own process so this is per case.
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * 1024
+
+
+async def run_case(fixture: str, file_type_name: str, preset_name: str, backend: str, stream: bool) -> dict[str, Any]:
+    # The cache would turn every case after the first into a hit, the bench measures the full pipeline.
+    os.environ["RESULT_CACHE_SIZE_MB"] = "0"
+    if stream:
+        os.environ["STREAM_PRESETS"] = "low,medium"
+
+    from bench.fixtures import FixtureDownloader, LocalServers
+    from core.client import StellaVideoBot
+    from core.models import FileType, CompressionType
+
+    file_type = FileType[file_type_name]
+    preset = CompressionType[preset_name]
+    servers = LocalServers(os.path.dirname(os.path.abspath(fixture)))
+    with tempfile.TemporaryDirectory() as uploads, tempfile.TemporaryDirectory() as tmp:
+        await servers.start(uploads)
+        os.environ["UPLOAD_URL"] = servers.upload_url
+        os.environ["UPLOAD_BACKENDS"] = backend
+        if backend == "s3":
+            os.environ.update({
+                "S3_ENDPOINT": servers.s3_endpoint, "S3_BUCKET": "bench",
+                "S3_ACCESS_KEY": "bench", "S3_SECRET_KEY": "bench",
+            })
+        bot = StellaVideoBot()
+        await bot.uploads.start()
+        link = FixtureDownloader.from_url(servers.media_url(os.path.basename(fixture)))
+        link.preset = preset
+        link.executor = bot.executor
+        link.size_limit = bot.upload_size_limit
+
+        cpu_start = cpu_seconds()
+        start = time.perf_counter()
+        try:
+            link.info = await bot.info_cache.get(link, bot.executor)
+            metadata_done = time.perf_counter()
+
+            filename = f"{tmp}/file.{file_type}"
+            streamed = bot.uploads.streams(preset) and link.can_stream(file_type)
+            if streamed:
+                # The upload runs during the encode, it has no time of its own.
+                await link.download_stream(filename, file_type, bot.uploads.upload_stream)
+                download_done = upload_done = time.perf_counter()
+            else:
+                filename = await link.download(filename, file_type)
+                download_done = time.perf_counter()
+
+                await bot.upload_file(filename)
+                upload_done = time.perf_counter()
+        finally:
+            await bot.uploads.close()
+            bot.executor.close()
+            await servers.stop()
+
+        wall = upload_done - start
+        input_size = os.path.getsize(fixture)
+        return {
+            "file_type": file_type.name,
+            "preset": preset.name,
+            "backend": backend,
+            "streamed": streamed,
+            "wall_seconds": wall,
+            "metadata_seconds": metadata_done - start,
+            "download_seconds": download_done - metadata_done,
+            "upload_seconds": upload_done - download_done,
+            "cpu_seconds": cpu_seconds() - cpu_start,
+            "peak_rss_bytes": peak_rss_bytes(),
+            "input_bytes": input_size,
+            "output_bytes": servers.uploaded_bytes if streamed else os.path.getsize(filename),
+            "uploaded_bytes": servers.uploaded_bytes,
+            "throughput_bytes_per_second": input_size / wall,
+        }
+
+
+async def run_download_case(fixture: str, connection_rate: int) -> dict[str, Any]:
+    from bench.fixtures import LocalServers
+    from core import segments
+    from core.executor import extract
+
+    servers = LocalServers(os.path.dirname(os.path.abspath(fixture)))
+    servers.connection_rate = connection_rate
+    with tempfile.TemporaryDirectory() as uploads, tempfile.TemporaryDirectory() as tmp:
+        await servers.start(uploads)
+        ydl_opts = {
+            'quiet': True,
+            'noprogress': True,
+            'format': 'best',
+            'concurrent_fragment_downloads': segments.CONNECTIONS_PER_JOB,
+            'outtmpl': f"{tmp}/source.%(ext)s",
+        }
+        try:
+            start = time.perf_counter()
+            fetched = await asyncio.to_thread(extract, f"{servers.base_url}/throttled/{os.path.basename(fixture)}", ydl_opts)
+            wall = time.perf_counter() - start
+        finally:
+            await servers.stop()
+
+    return {
+        "engine": segments.ENGINE,
+        "connections": segments.CONNECTIONS_PER_JOB,
+        "wall_seconds": wall,
+        "bytes": fetched.filesize,
+        "throughput_bytes_per_second": fetched.filesize / wall,
+        "cpu_seconds": cpu_seconds(),
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+
+def run_downloads(args: argparse.Namespace) -> list[dict[str, Any]]:
+    from bench.fixtures import make_download_fixture
+
+    fixture = make_download_fixture(
+        os.path.join(ROOT, ".cache", "bench", f"download-{args.size_mb}.mp4"), args.size_mb * 1024 * 1024
+    )
+    results = []
+    for engine in ("ytdlp", "segmented"):
+        for run in range(args.repeat):
+            env = {**os.environ, "DOWNLOAD_ENGINE": engine, "DOWNLOAD_CONNECTIONS": str(args.connections)}
+            process = subprocess.run(
+                [sys.executable, "-m", "bench.pipeline", "download-case", fixture, str(args.rate_kb * 1024)],
+                cwd=ROOT, env=env, capture_output=True, text=True,
+            )
+            if process.returncode != 0:
+                result = {"engine": engine, "error": process.stderr.strip()[-2000:]}
+            else:
+                result = json.loads(process.stdout.strip().splitlines()[-1])
+
+            result["run"] = run
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+    return results
+
+
+def run_all(args: argparse.Namespace) -> list[dict[str, Any]]:
+    from bench.fixtures import make_fixture
+    from core.models import FileType, CompressionType
+
+    fixture = make_fixture(args.fixture, duration=args.duration)
+    results = []
+    for file_type, preset in itertools.product(FileType, CompressionType):
+        for run in range(args.repeat):
+            env = {**os.environ, "DOWNLOAD_EXECUTOR": args.executor}
+            process = subprocess.run(
+                [
+                    sys.executable, "-m", "bench.pipeline", "case", fixture, file_type.name, preset.name,
+                    "--backend", args.backend, *(["--stream"] if args.stream else []),
+                ],
+                cwd=ROOT, env=env, capture_output=True, text=True,
+            )
+            if process.returncode != 0:
+                result = {"file_type": file_type.name, "preset": preset.name, "error": process.stderr.strip()[-2000:]}
+            else:
+                result = json.loads(process.stdout.strip().splitlines()[-1])
+
+            result.update({"run": run, "executor": args.executor})
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+    return results
+
+
+def measure_startup(repeat: int) -> dict[str, Any]:
+    # Importing main builds the bot, this is everything before it connects to Discord.
+    code = "import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)"
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+        samples.append({
+            "import_seconds": float(process.stdout.strip().splitlines()[-1]),
+            "process_seconds": time.perf_counter() - start,
+        })
+    return {
+        "samples": samples,
+        "import_seconds": sorted(sample["import_seconds"] for sample in samples)[len(samples) // 2],
+        "process_seconds": sorted(sample["process_seconds"] for sample in samples)[len(samples) // 2],
+    }
+
+
+def compare(baseline_path: str, candidate_path: str) -> None:
+    def load(path: str) -> dict[tuple[str, str], list[dict[str, Any]]]:
+        with open(path) as f:
+            grouped: dict[tuple[str, str], list[dict[str, Any]]] = {}
+            for result in json.load(f)["results"]:
+                if "error" not in result:
+                    grouped.setdefault((result["file_type"], result["preset"]), []).append(result)
+            return grouped
+
+    def mean(results: list[dict[str, Any]], key: str) -> float:
+        return sum(r[key] for r in results) / len(results)
+
+    baseline, candidate = load(baseline_path), load(candidate_path)
+    keys = ("wall_seconds", "cpu_seconds", "peak_rss_bytes", "output_bytes")
+    print(f"{'case':<16}" + "".join(f"{key:>20}" for key in keys))
+    for case in sorted(baseline.keys() & candidate.keys()):
+        ratios = [mean(candidate[case], key) / (mean(baseline[case], key) or 1) for key in keys]
+        print(f"{':'.join(case):<16}" + "".join(f"{ratio:>19.2f}x" for ratio in ratios))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline benchmark of the download, transcode and upload pipeline.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Benchmark every file type and preset.")
+    run.add_argument("--fixture", default=os.path.join(ROOT, ".cache", "bench", "fixture.mp4"))
+    run.add_argument("--duration", type=int, default=30, help="Length of the generated fixture in seconds.")
+    run.add_argument("--repeat", type=int, default=1)
+    run.add_argument("--executor", choices=("thread", "process"), default="thread")
+    run.add_argument("--backend", choices=("tmpfiles", "s3"), default="tmpfiles", help="Upload backend to exercise.")
+    run.add_argument("--stream", action="store_true", help="Stream low and medium into the upload, needs --backend s3.")
+    run.add_argument("--output", default="-")
+
+    case = commands.add_parser("case", help="Run one case in this process, used by 'run'.")
+    case.add_argument("fixture")
+    case.add_argument("file_type")
+    case.add_argument("preset")
+    case.add_argument("--backend", choices=("tmpfiles", "s3"), default="tmpfiles")
+    case.add_argument("--stream", action="store_true")
+
+    startup = commands.add_parser("startup", help="Measure how long importing the bot takes.")
+    startup.add_argument("--repeat", type=int, default=5)
+
+    downloads = commands.add_parser("download", help="Compare the download engines against a throttled range server.")
+    downloads.add_argument("--size-mb", type=int, default=64)
+    downloads.add_argument("--rate-kb", type=int, default=4096, help="Per connection limit of the local server.")
+    downloads.add_argument("--connections", type=int, default=4)
+    downloads.add_argument("--repeat", type=int, default=1)
+
+    download_case = commands.add_parser("download-case", help="Run one download in this process, used by 'download'.")
+    download_case.add_argument("fixture")
+    download_case.add_argument("connection_rate", type=int)
+
+    diff = commands.add_parser("compare", help="Compare two result files.")
+    diff.add_argument("baseline")
+    diff.add_argument("candidate")
+
+    args = parser.parse_args()
+    if args.command == "case":
+        print(json.dumps(asyncio.run(run_case(args.fixture, args.file_type, args.preset, args.backend, args.stream))))
+    elif args.command == "compare":
+        compare(args.baseline, args.candidate)
+    elif args.command == "startup":
+        print(json.dumps(measure_startup(args.repeat), indent=4))
+    elif args.command == "download-case":
+        print(json.dumps(asyncio.run(run_download_case(args.fixture, args.connection_rate))))
+    elif args.command == "download":
+        print(json.dumps({"cpu_count": os.cpu_count(), "results": run_downloads(args)}, indent=4))
+    else:
+        from core.client import VERSION
+
+        report = {"version": VERSION, "cpu_count": os.cpu_count(), "results": run_all(args)}
+        if args.output == "-":
+            print(json.dumps(report, indent=4))
+        else:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import resource
+import signal
+import sys
+import tempfile
+import threading
+import time
+from typing import Any
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_INTERVAL = 0.1
+
+
+def percentile(values: list[float], fraction: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def open_fds() -> int:
+    return len(os.listdir("/proc/self/fd"))
+
+
+class Recorder:
+    def __init__(self):
+        self.edits: list[float] = []
+        self.sends: int = 0
+        self.loop_lag: list[float] = []
+        self.rss: list[int] = []
+        self.fds: list[int] = []
+        self.latencies: list[float] = []
+        self.outcomes: dict[str, int] = {}
+
+    async def sample(self) -> None:
+        # Anything holding the event loop shows up as a sleep that overshoots.
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(SAMPLE_INTERVAL)
+            self.loop_lag.append(loop.time() - start - SAMPLE_INTERVAL)
+            self.rss.append(rss_bytes())
+            self.fds.append(open_fds())
+
+    def edit_rates(self) -> tuple[float, int]:
+        if not self.edits:
+            return 0, 0
+        span = max(self.edits[-1] - self.edits[0], 1)
+        busiest = max(sum(1 for _ in group) for _, group in itertools.groupby(int(stamp) for stamp in self.edits))
+        return len(self.edits) / span, busiest
+
+
+# Just enough of discord.py's objects for the flows in main, every call that would reach Discord is recorded.
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id: int = user_id
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id: int = guild_id
+        self.filesize_limit: int = 25 * 1024 * 1024
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int):
+        self.id: int = channel_id
+
+
+class FakeResponse:
+    async def defer(self, **_kwargs: Any) -> None:
+        pass
+
+    def is_done(self) -> bool:
+        return True
+
+
+class FakeMessage:
+    ids = itertools.count(1)
+
+    def __init__(self, soak: Soak, channel: FakeChannel, content: str | None = None, ctx: FakeContext | None = None):
+        self.soak: Soak = soak
+        # Whoever sent it, views edited in later are answered as that user.
+        self.ctx: FakeContext | None = ctx
+        self.id: int = next(self.ids)
+        self.channel: FakeChannel = channel
+        self.content: str = content or ""
+        self.embeds: list[Any] = []
+
+    async def edit(self, *, view: Any = None, **_kwargs: Any) -> FakeMessage:
+        self.soak.recorder.edits.append(time.monotonic())
+        await asyncio.sleep(self.soak.api_latency)
+        if view is not None and self.ctx is not None:
+            self.soak.react(self.ctx, view)
+        return self
+
+    async def delete(self, **_kwargs: Any) -> None:
+        pass
+
+
+class FakeInteraction:
+    def __init__(self, user: FakeUser, guild: FakeGuild | None):
+        self.user: FakeUser = user
+        self.guild: FakeGuild | None = guild
+        self.application_id: int = 1
+        self.token: str = f"token-{user.id}"
+        self.filesize_limit: int = 25 * 1024 * 1024
+        self.response: FakeResponse = FakeResponse()
+        # What bot.get_context hands back for this interaction.
+        self.context: FakeContext | None = None
+
+
+class FakeContext:
+    def __init__(self, soak: Soak, author: FakeUser, guild: FakeGuild | None, interaction: FakeInteraction | None = None):
+        self.soak: Soak = soak
+        self.author: FakeUser = author
+        self.guild: FakeGuild | None = guild
+        self.interaction: FakeInteraction | None = interaction
+        self.channel: FakeChannel = FakeChannel(author.id)
+
+    async def send(self, content: str | None = None, *, view: Any = None, **_kwargs: Any) -> FakeMessage:
+        self.soak.recorder.sends += 1
+        await asyncio.sleep(self.soak.api_latency)
+        message = FakeMessage(self.soak, self.channel, content, self)
+        if view is not None:
+            self.soak.react(self, view)
+        return message
+
+
+class FixtureDispatcher:
+    # The bot's own dispatcher only looks for hostnames, the fixtures are served from an IP.
+    CANDIDATE = re.compile(r"https?://127\.0\.0\.1:\d+/media/\S+")
+
+    def __init__(self):
+        from bench.fixtures import FixtureDownloader
+        from core.models import URLDispatcher
+
+        self.dispatcher = URLDispatcher([FixtureDownloader])
+
+    def find_all(self, text: str) -> list[Any]:
+        return [link for found in self.CANDIDATE.finditer(text) if (link := self.dispatcher.match(found.group(0)))]
+
+
+class Soak:
+    def __init__(self, args: argparse.Namespace, servers: Any, names: list[str]):
+        self.args: argparse.Namespace = args
+        self.servers: Any = servers
+        self.names: list[str] = names
+        self.api_latency: float = args.api_latency_ms / 1000
+        self.recorder: Recorder = Recorder()
+        self.presses: set[asyncio.Task[None]] = set()
+        self.presets: dict[int, str] = {}
+        self.fds_before: int = 0
+
+    def react(self, ctx: FakeContext, view: Any) -> None:
+        from core.models import ViewFormatType, ViewCompressionType, ViewCancel
+
+        buttons = {"low": "low", "medium": "med", "hd": "hd", "original": "ori", "fit": "fit"}
+        if isinstance(view, ViewFormatType):
+            button = view.vid if self.args.file_type == "video" else view.aud
+            self.press(ctx, button, self.args.think_ms / 1000)
+        elif isinstance(view, ViewCompressionType):
+            self.press(ctx, getattr(view, buttons[self.presets[ctx.author.id]]), self.args.think_ms / 1000)
+        elif isinstance(view, ViewCancel) and random.random() < self.args.cancel_rate:
+            self.press(ctx, view.cancel, random.uniform(0, self.args.cancel_after))
+
+    def press(self, ctx: FakeContext, button: Any, delay: float) -> None:
+        async def click() -> None:
+            await asyncio.sleep(delay)
+            await button.callback(FakeInteraction(ctx.author, ctx.guild))
+
+        task = asyncio.create_task(click())
+        self.presses.add(task)
+        task.add_done_callback(self.presses.discard)
+
+    async def user(self, index: int) -> None:
+        import main
+        from bench.fixtures import FixtureDownloader
+        from core.errors import DisplayError
+        from core.models import FileType, CompressionType
+
+        await asyncio.sleep(index * self.args.ramp / max(1, self.args.users))
+        author = FakeUser(1000 + index)
+        guild = FakeGuild(index % self.args.guilds) if self.args.guilds else None
+        for iteration in range(self.args.iterations):
+            name = self.names[0] if self.args.same_link else self.names[(index * self.args.iterations + iteration) % len(self.names)]
+            url = self.servers.media_url(name)
+            preset = random.choice(self.args.presets.split(","))
+            self.presets[author.id] = preset
+            start = time.perf_counter()
+            try:
+                if random.random() < self.args.context_share:
+                    interaction = FakeInteraction(author, guild)
+                    interaction.context = FakeContext(self, author, guild, interaction)
+                    await main.context_download.callback(interaction, FakeMessage(self, FakeChannel(0), f"look {url}"))
+                else:
+                    ctx = FakeContext(self, author, guild)
+                    link = FixtureDownloader.from_url(url)
+                    await main.download_flow(ctx, link, FileType[self.args.file_type], CompressionType[preset])
+                outcome = "finished"
+            except DisplayError as e:
+                outcome = e.__class__.__name__
+            except Exception:
+                logging.exception(f"User {index} crashed")
+                outcome = "crashed"
+            self.recorder.latencies.append(time.perf_counter() - start)
+            self.recorder.outcomes[outcome] = self.recorder.outcomes.get(outcome, 0) + 1
+
+    def report(self, wall: float) -> dict[str, Any]:
+        recorder = self.recorder
+        mean_rate, busiest_second = recorder.edit_rates()
+        return {
+            "users": self.args.users,
+            "jobs": len(recorder.latencies),
+            "outcomes": recorder.outcomes,
+            "wall_seconds": wall,
+            "latency_p50_seconds": percentile(recorder.latencies, 0.5),
+            "latency_p99_seconds": percentile(recorder.latencies, 0.99),
+            "latency_max_seconds": max(recorder.latencies, default=None),
+            "loop_lag_p99_seconds": percentile(recorder.loop_lag, 0.99),
+            "loop_lag_max_seconds": max(recorder.loop_lag, default=None),
+            "edits": len(recorder.edits),
+            "edits_per_second": mean_rate,
+            "edits_busiest_second": busiest_second,
+            "sends": recorder.sends,
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "rss_growth_bytes": recorder.rss[-1] - recorder.rss[0] if recorder.rss else None,
+            "peak_open_fds": max(recorder.fds, default=None),
+            "open_fds_after": open_fds(),
+            "open_fds_before": self.fds_before,
+        }
+
+    async def run(self) -> dict[str, Any]:
+        import main
+
+        # Nothing logs in, the flows run against the stand-ins as if commands had been invoked.
+        main.DISPATCHER = FixtureDispatcher()
+        async def get_context(origin: FakeInteraction, **_kwargs: Any) -> FakeContext:
+            return origin.context
+
+        main.bot.get_context = get_context
+        await main.bot.uploads.start()
+        self.fds_before = open_fds()
+        sampler = asyncio.create_task(self.recorder.sample())
+        start = time.perf_counter()
+        try:
+            await asyncio.gather(*(self.user(index) for index in range(self.args.users)))
+            wall = time.perf_counter() - start
+        finally:
+            sampler.cancel()
+            for task in list(self.presses):
+                task.cancel()
+            await asyncio.gather(sampler, *self.presses, return_exceptions=True)
+
+        # Left for last, anything still open now that every flow returned is a leak.
+        await asyncio.sleep(1)
+        report = self.report(wall)
+        await main.bot.uploads.close()
+        main.bot.executor.close()
+        main.bot.edit_governor.close()
+        if main.bot.broker is not None:
+            await main.bot.broker.close()
+        return report
+
+
+async def start_workers(count: int) -> list[asyncio.subprocess.Process]:
+    # worker.py's own entry point with the same environment as the bot, the fixture downloader loaded so jobs restore.
+    return [
+        await asyncio.create_subprocess_exec(sys.executable, "-c", "import bench.fixtures, worker; worker.main()", cwd=ROOT)
+        for _ in range(count)
+    ]
+
+
+async def stop_workers(workers: list[asyncio.subprocess.Process]) -> None:
+    for worker in workers:
+        if worker.returncode is None:
+            worker.send_signal(signal.SIGINT)
+    for worker in workers:
+        try:
+            await asyncio.wait_for(worker.wait(), 10)
+        except asyncio.TimeoutError:
+            worker.kill()
+            await worker.wait()
+
+
+async def soak(args: argparse.Namespace) -> dict[str, Any]:
+    from bench.fixtures import LocalServers, RespStandIn, make_fixture
+
+    fixture = args.fixture or make_fixture(os.path.join(ROOT, ".cache", "bench", "fixture.mp4"), duration=args.duration)
+    with tempfile.TemporaryDirectory() as media, tempfile.TemporaryDirectory() as uploads, tempfile.TemporaryDirectory() as work:
+        # One name per job, so identical requests don't collapse into one shared job unless asked to.
+        _, extension = os.path.splitext(fixture)
+        names = [f"fixture-{index}{extension}" for index in range(1 if args.same_link else args.users * args.iterations)]
+        for name in names:
+            try:
+                os.link(fixture, os.path.join(media, name))
+            except OSError:
+                os.symlink(os.path.abspath(fixture), os.path.join(media, name))
+
+        # On a loop of their own, serving the fixtures and taking uploads doesn't count as the bot's loop lag.
+        servers = LocalServers(media)
+        server_loop = asyncio.new_event_loop()
+        server_thread = threading.Thread(target=server_loop.run_forever, daemon=True)
+        server_thread.start()
+        asyncio.run_coroutine_threadsafe(servers.start(uploads), server_loop).result()
+        os.environ.update({
+            "UPLOAD_BACKENDS": "tmpfiles",
+            "UPLOAD_URL": servers.upload_url,
+            "RESULT_CACHE_SIZE_MB": "0",
+            "JOB_JOURNAL_DIR": os.path.join(work, "journal"),
+        })
+        resp = None
+        if args.queue == "redis":
+            resp = RespStandIn()
+            asyncio.run_coroutine_threadsafe(resp.start(), server_loop).result()
+            os.environ.update({"JOB_QUEUE": "redis", "JOB_QUEUE_URL": resp.url})
+        elif args.queue == "sqlite":
+            os.environ.update({"JOB_QUEUE": "sqlite", "JOB_QUEUE_PATH": os.path.join(work, "jobs.sqlite3")})
+        workers = await start_workers(args.workers) if args.queue else []
+        try:
+            report = await Soak(args, servers, names).run()
+        finally:
+            await stop_workers(workers)
+            if resp is not None:
+                asyncio.run_coroutine_threadsafe(resp.stop(), server_loop).result()
+            asyncio.run_coroutine_threadsafe(servers.stop(), server_loop).result()
+            server_loop.call_soon_threadsafe(server_loop.stop)
+            server_thread.join()
+            server_loop.close()
+        report["uploaded_bytes"] = servers.uploaded_bytes
+        return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Soak test the bot's flows against stand-in Discord objects.")
+    parser.add_argument("--users", type=int, default=50, help="Simulated users, each running its own flows.")
+    parser.add_argument("--iterations", type=int, default=1, help="Downloads each user runs one after the other.")
+    parser.add_argument("--ramp", type=float, default=10, help="Seconds over which the users start.")
+    parser.add_argument("--presets", default="low,medium", help="Comma separated presets users pick from at random.")
+    parser.add_argument("--file-type", choices=("video", "audio"), default="video")
+    parser.add_argument("--context-share", type=float, default=0.5, help="Share of downloads started from the context menu.")
+    parser.add_argument("--cancel-rate", type=float, default=0.0, help="Share of downloads the user cancels.")
+    parser.add_argument("--cancel-after", type=float, default=5, help="Cancels happen at a random time up to this many seconds in.")
+    parser.add_argument("--think-ms", type=float, default=300, help="Time a user takes to answer a prompt.")
+    parser.add_argument("--api-latency-ms", type=float, default=80, help="Time every Discord call takes.")
+    parser.add_argument("--guilds", type=int, default=5, help="Guilds the users are spread over, 0 for direct messages.")
+    parser.add_argument("--same-link", action="store_true", help="Every user downloads the same link.")
+    parser.add_argument(
+        "--queue", choices=("sqlite", "redis"), help="Hand jobs to worker.py processes, redis uses a local stand-in server."
+    )
+    parser.add_argument("--workers", type=int, default=2, help="worker.py processes started with --queue.")
+    parser.add_argument("--fixture", help="Media to serve instead of a generated fixture.")
+    parser.add_argument("--duration", type=int, default=30, help="Length of the generated fixture in seconds.")
+    parser.add_argument("--output", default="-")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    report = asyncio.run(soak(args))
+    report.update({"cpu_count": os.cpu_count(), "settings": vars(args)})
+    if args.output == "-":
+        print(json.dumps(report, indent=4))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, AsyncIterator
+
+import yarl
+
+TERMINAL_EVENTS = ("result", "failed")
+EVENT_TTL = 3600
+
+
+@dataclasses.dataclass
+class JobSpec:
+    id: str
+    downloader: str
+    url: str
+    ident: str
+    file_type: str
+    preset: str
+    size_limit: int | None
+    guild_id: int | None
+    user_id: int
+
+    def dumps(self) -> str:
+        return json.dumps(dataclasses.asdict(self))
+
+    @classmethod
+    def loads(cls, raw: str | bytes) -> JobSpec:
+        return cls(**json.loads(raw))
+
+
+class JobBroker(ABC):
+    @abstractmethod
+    async def submit(self, spec: JobSpec) -> None:
+        pass
+
+    @abstractmethod
+    async def claim(self, timeout: float) -> JobSpec | None:
+        pass
+
+    @abstractmethod
+    async def publish(self, job_id: str, event: dict[str, Any]) -> None:
+        pass
+
+    @abstractmethod
+    def events(self, job_id: str) -> AsyncIterator[dict[str, Any]]:
+        pass
+
+    @abstractmethod
+    async def cancel(self, job_id: str) -> None:
+        pass
+
+    @abstractmethod
+    async def cancelled(self, job_id: str) -> bool:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+class SQLiteBroker(JobBroker):
+    # Shared by every process on one machine through the database file, polled since SQLite can't notify.
+    def __init__(self, path: str, poll_interval: float = 0.2):
+        self.path: str = path
+        self.poll_interval: float = poll_interval
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection: sqlite3.Connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.lock: threading.Lock = threading.Lock()
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, spec TEXT NOT NULL, state TEXT NOT NULL, updated REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT NOT NULL, event TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS events_job ON events (job_id, seq)")
+
+    def _execute(self, sql: str, params: tuple[Any, ...] = ()) -> list[tuple[Any, ...]]:
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def _claim(self) -> JobSpec | None:
+        with self.lock:
+            # IMMEDIATE takes the write lock up front, two workers can't claim the same row.
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute(
+                    "SELECT id, spec FROM jobs WHERE state = 'queued' ORDER BY rowid LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    self.connection.execute(
+                        "UPDATE jobs SET state = 'running', updated = ? WHERE id = ?", (time.time(), row[0])
+                    )
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return JobSpec.loads(row[1]) if row is not None else None
+
+    def _expire(self) -> None:
+        deadline = time.time() - EVENT_TTL
+        self._execute("DELETE FROM events WHERE created < ?", (deadline,))
+        self._execute("DELETE FROM jobs WHERE state != 'queued' AND updated < ?", (deadline,))
+
+    async def submit(self, spec: JobSpec) -> None:
+        await asyncio.to_thread(
+            self._execute, "INSERT OR REPLACE INTO jobs (id, spec, state, updated) VALUES (?, ?, 'queued', ?)",
+            (spec.id, spec.dumps(), time.time())
+        )
+
+    async def claim(self, timeout: float) -> JobSpec | None:
+        deadline = time.monotonic() + timeout
+        while True:
+            spec = await asyncio.to_thread(self._claim)
+            if spec is not None or time.monotonic() >= deadline:
+                return spec
+            await asyncio.sleep(self.poll_interval)
+
+    async def publish(self, job_id: str, event: dict[str, Any]) -> None:
+        await asyncio.to_thread(
+            self._execute, "INSERT INTO events (job_id, event, created) VALUES (?, ?, ?)",
+            (job_id, json.dumps(event), time.time())
+        )
+        if event["type"] in TERMINAL_EVENTS:
+            await asyncio.to_thread(
+                self._execute, "UPDATE jobs SET state = 'done', updated = ? WHERE id = ?", (time.time(), job_id)
+            )
+            await asyncio.to_thread(self._expire)
+
+    async def events(self, job_id: str) -> AsyncIterator[dict[str, Any]]:
+        seq = 0
+        while True:
+            rows = await asyncio.to_thread(
+                self._execute, "SELECT seq, event FROM events WHERE job_id = ? AND seq > ? ORDER BY seq", (job_id, seq)
+            )
+            for seq, raw in rows:
+                event = json.loads(raw)
+                yield event
+                if event["type"] in TERMINAL_EVENTS:
+                    return
+            await asyncio.sleep(self.poll_interval)
+
+    async def cancel(self, job_id: str) -> None:
+        await asyncio.to_thread(
+            self._execute, "UPDATE jobs SET state = 'cancelled', updated = ? WHERE id = ? AND state != 'done'",
+            (time.time(), job_id)
+        )
+
+    async def cancelled(self, job_id: str) -> bool:
+        rows = await asyncio.to_thread(self._execute, "SELECT state FROM jobs WHERE id = ?", (job_id,))
+        return bool(rows) and rows[0][0] == 'cancelled'
+
+    async def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+class RespError(Exception):
+    pass
+
+
+class RespConnection:
+    # Just enough of the Redis protocol for the broker, any Redis compatible server works.
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader: asyncio.StreamReader = reader
+        self.writer: asyncio.StreamWriter = writer
+        self.lock: asyncio.Lock = asyncio.Lock()
+
+    @classmethod
+    async def connect(cls, url: str) -> RespConnection:
+        parsed = yarl.URL(url)
+        reader, writer = await asyncio.open_connection(parsed.host or "127.0.0.1", parsed.port or 6379)
+        connection = cls(reader, writer)
+        if parsed.password:
+            await connection.execute("AUTH", *([parsed.user] if parsed.user else []), parsed.password)
+        database = parsed.path.strip("/")
+        if database:
+            await connection.execute("SELECT", database)
+        return connection
+
+    async def _read(self) -> Any:
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Connection to the job queue was closed")
+
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise RespError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length == -1:
+                return None
+            data = await self.reader.readexactly(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length == -1:
+                return None
+            return [await self._read() for _ in range(length)]
+        raise RespError(f"Unexpected reply {line!r}")
+
+    async def execute(self, *args: str | bytes | int | float) -> Any:
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        async with self.lock:
+            self.writer.write(b"".join(parts))
+            await self.writer.drain()
+            return await self._read()
+
+    async def close(self) -> None:
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+class RedisBroker(JobBroker):
+    def __init__(self, url: str, prefix: str = "dvd"):
+        self.url: str = url
+        self.prefix: str = prefix
+        self._connection: RespConnection | None = None
+        # Blocking pops hold their connection until they return, claims get one of their own.
+        self._claimer: RespConnection | None = None
+
+    async def connection(self) -> RespConnection:
+        if self._connection is None:
+            self._connection = await RespConnection.connect(self.url)
+        return self._connection
+
+    def key(self, *parts: str) -> str:
+        return ":".join((self.prefix, *parts))
+
+    async def submit(self, spec: JobSpec) -> None:
+        connection = await self.connection()
+        await connection.execute("SET", self.key("job", spec.id), spec.dumps(), "EX", EVENT_TTL)
+        await connection.execute("LPUSH", self.key("queue"), spec.id)
+
+    async def claim(self, timeout: float) -> JobSpec | None:
+        if self._claimer is None:
+            self._claimer = await RespConnection.connect(self.url)
+        try:
+            popped = await self._claimer.execute("BRPOP", self.key("queue"), max(1, int(timeout)))
+        except BaseException:
+            # A pop interrupted halfway leaves a reply in flight, the connection can't be reused.
+            claimer, self._claimer = self._claimer, None
+            await claimer.close()
+            raise
+        if popped is None:
+            return None
+
+        job_id = popped[1].decode()
+        connection = await self.connection()
+        raw = await connection.execute("GET", self.key("job", job_id))
+        if raw is None or await self.cancelled(job_id):
+            return None
+        return JobSpec.loads(raw)
+
+    async def publish(self, job_id: str, event: dict[str, Any]) -> None:
+        connection = await self.connection()
+        key = self.key("events", job_id)
+        await connection.execute("RPUSH", key, json.dumps(event))
+        await connection.execute("EXPIRE", key, EVENT_TTL)
+
+    async def events(self, job_id: str) -> AsyncIterator[dict[str, Any]]:
+        blocking = await RespConnection.connect(self.url)
+        try:
+            while True:
+                popped = await blocking.execute("BLPOP", self.key("events", job_id), 5)
+                if popped is None:
+                    continue
+                event = json.loads(popped[1])
+                yield event
+                if event["type"] in TERMINAL_EVENTS:
+                    return
+        finally:
+            await blocking.close()
+
+    async def cancel(self, job_id: str) -> None:
+        connection = await self.connection()
+        await connection.execute("SET", self.key("cancel", job_id), 1, "EX", EVENT_TTL)
+
+    async def cancelled(self, job_id: str) -> bool:
+        connection = await self.connection()
+        return bool(await connection.execute("EXISTS", self.key("cancel", job_id)))
+
+    async def close(self) -> None:
+        for connection in (self._connection, self._claimer):
+            if connection is not None:
+                await connection.close()
+
+
+def create_broker() -> JobBroker | None:
+    kind = os.environ.get("JOB_QUEUE", "")
+    if not kind:
+        return None
+    elif kind == "sqlite":
+        return SQLiteBroker(os.environ.get("JOB_QUEUE_PATH", ".cache/jobs.sqlite3"))
+    elif kind == "redis":
+        return RedisBroker(os.environ.get("JOB_QUEUE_URL", "redis://127.0.0.1:6379/0"))
+    else:
+        raise RuntimeError(f"Unknown JOB_QUEUE {kind!r}, expected 'sqlite' or 'redis'.")
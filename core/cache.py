@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from typing import TYPE_CHECKING, Any
+
+from core.metrics import cache_requests
+
+if TYPE_CHECKING:
+    from core.models import URLParsed, FileType, CompressionType
+
+
+@dataclasses.dataclass
+class CacheEntry:
+    key: str
+    # Unset for results streamed straight into an upload, only their URL is kept.
+    path: str | None
+    size: int
+    last_access: float
+    upload_url: str | None = None
+    upload_expires: float | None = None
+
+    @property
+    def cached_url(self) -> str | None:
+        if self.upload_url is None or self.upload_expires is None:
+            return None
+
+        if time.time() >= self.upload_expires:
+            return None
+
+        return self.upload_url
+
+    @property
+    def present(self) -> bool:
+        # A streamed result is only worth keeping while its URL is.
+        if self.path is None:
+            return self.cached_url is not None
+        return os.path.exists(self.path)
+
+
+class ResultCache:
+    def __init__(self, directory: str, max_bytes: int, url_ttl: float):
+        self.directory: str = directory
+        self.max_bytes: int = max_bytes
+        self.url_ttl: float = url_ttl
+        self.index_path: str = os.path.join(directory, "index.json")
+        self.entries: dict[str, CacheEntry] = {}
+        self.saving: asyncio.Lock = asyncio.Lock()
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+            self.load()
+
+    @classmethod
+    def from_environ(cls) -> ResultCache:
+        return cls(
+            directory=os.environ.get("RESULT_CACHE_DIR", ".cache/results"),
+            max_bytes=int(os.environ.get("RESULT_CACHE_SIZE_MB", "2048")) * 1024 * 1024,
+            url_ttl=float(os.environ.get("UPLOAD_URL_TTL", "3000")),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @property
+    def total_size(self) -> int:
+        return sum(entry.size for entry in self.entries.values())
+
+    @staticmethod
+    def make_key(link: URLParsed, file_type: FileType, preset: CompressionType) -> str:
+        raw = f"{link.canonical_id}|{file_type.name}|{preset}"
+        if preset == "fit":
+            raw += f"|{link.size_limit}"
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def load(self) -> None:
+        if not os.path.exists(self.index_path):
+            return
+
+        try:
+            with open(self.index_path, "r") as f:
+                content = json.load(f)
+        except (OSError, ValueError):
+            logging.warning(f"Result cache index at {self.index_path} is unreadable, starting empty.")
+            return
+
+        for data in content.get('entries', []):
+            entry = CacheEntry(**data)
+            if entry.present:
+                self.entries[entry.key] = entry
+
+    async def save(self) -> None:
+        # Snapshot taken on the loop, only writing it out happens in a thread, one write at a time.
+        content = {'entries': [dataclasses.asdict(entry) for entry in self.entries.values()]}
+        async with self.saving:
+            await asyncio.to_thread(self._write, content)
+
+    def _write(self, content: dict[str, Any]) -> None:
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(content, f, indent=4)
+        os.replace(tmp_path, self.index_path)
+
+    def get(self, link: URLParsed, file_type: FileType, preset: CompressionType) -> CacheEntry | None:
+        if not self.enabled:
+            return None
+
+        key = self.make_key(link, file_type, preset)
+        entry = self.entries.get(key)
+        if entry is None:
+            cache_requests.inc(cache="result", result="miss")
+            return None
+
+        if not entry.present:
+            cache_requests.inc(cache="result", result="miss")
+            del self.entries[key]
+            return None
+
+        # Lookups only touch memory, the access time reaches the index with the next write.
+        cache_requests.inc(cache="result", result="hit")
+        entry.last_access = time.time()
+        return entry
+
+    async def put(self, link: URLParsed, file_type: FileType, preset: CompressionType, file_path: str) -> CacheEntry | None:
+        if not self.enabled:
+            return None
+
+        size = os.path.getsize(file_path)
+        if size > self.max_bytes:
+            return None
+
+        key = self.make_key(link, file_type, preset)
+        existing = self.entries.get(key)
+        # Streamed entries have no file, a put replaces them like any other miss.
+        if existing is not None and existing.path is not None and os.path.abspath(existing.path) == os.path.abspath(file_path):
+            existing.last_access = time.time()
+            return existing
+
+        _, ext = os.path.splitext(file_path)
+        path = os.path.join(self.directory, f"{key}{ext}")
+        await asyncio.to_thread(self._store, file_path, path)
+
+        entry = CacheEntry(key=key, path=path, size=size, last_access=time.time())
+        self.entries[key] = entry
+        self.evict(keep=key)
+        await self.save()
+        return entry
+
+    @staticmethod
+    def _store(source: str, destination: str) -> None:
+        tmp_path = f"{destination}.tmp"
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, destination)
+
+    async def put_url(self, link: URLParsed, file_type: FileType, preset: CompressionType, url: str) -> None:
+        if not self.enabled:
+            return
+
+        key = self.make_key(link, file_type, preset)
+        now = time.time()
+        self.entries[key] = CacheEntry(
+            key=key, path=None, size=0, last_access=now, upload_url=url, upload_expires=now + self.url_ttl
+        )
+        await self.save()
+
+    async def remember_url(self, entry: CacheEntry | None, url: str) -> None:
+        if entry is None or entry.key not in self.entries:
+            return
+
+        entry.upload_url = url
+        entry.upload_expires = time.time() + self.url_ttl
+        await self.save()
+
+    def evict(self, keep: str | None = None) -> None:
+        total = self.total_size
+        for entry in sorted(self.entries.values(), key=lambda e: e.last_access):
+            if total <= self.max_bytes:
+                break
+
+            if entry.key == keep:
+                continue
+
+            total -= entry.size
+            del self.entries[entry.key]
+            if entry.path is None:
+                continue
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
@@ -2,12 +2,28 @@ import asyncio
 import json
 import logging
 import os
+import tempfile
+import time
 
-import aiohttp
+from aiohttp import web
 import discord
 from discord.ext import commands
 
-from core.errors import InvalidToken, SomethingWentWrong, UploadError
+from core.cache import ResultCache
+from core.disk import DiskSpace
+from core.executor import DownloadExecutor, create_executor
+from core.errors import InvalidToken, SomethingWentWrong
+from core.broker import JobBroker, create_broker
+from core.jobs import JobRegistry, DownloadJob, RemoteJob
+from core.journal import JobJournal
+from core.metadata import InfoCache, estimate_options
+from core.metrics import queue_depth, serve_metrics, time_to_ready
+from core.models import YouTubeDownloader
+from core.progress import EditGovernor
+from core.scheduler import JobScheduler
+from core.uploads import UploadManager
+from core.utils import process_uptime
+from core.ytdl import pool
 
 VERSION = "0.0.4"
 
@@ -17,31 +33,50 @@ class StellaVideoBot(commands.Bot):
         intents = discord.Intents.default()
         self.startup_path: str = ".startup.json"
         super().__init__(os.environ.get("DISCORD_MESSAGE_PREFIX", "!"), intents=intents)
-        self.session: aiohttp.ClientSession | None = None
-        self.upload_url: str = os.environ.get("UPLOAD_URL", "https://tmpfiles.org/api/v1/upload")
+        self.uploads: UploadManager = UploadManager(self)
+        self.upload_size_limit: int = self.uploads.size_limit or 0
+        self.max_batch_links: int = int(os.environ.get("MAX_BATCH_LINKS", "5"))
+        self.max_playlist_items: int = int(os.environ.get("MAX_PLAYLIST_ITEMS", "25"))
+        self.playlist_concurrency: int = int(os.environ.get("PLAYLIST_CONCURRENCY", "2"))
+        self.max_download_size: int = int(os.environ.get("MAX_DOWNLOAD_SIZE_MB", "2048")) * 1024 * 1024
+        self.result_cache: ResultCache = ResultCache.from_environ()
+        self.executor: DownloadExecutor = create_executor()
+        self.info_cache: InfoCache = InfoCache.from_environ()
+        self.scheduler: JobScheduler = JobScheduler.from_environ()
+        # With a job queue the frontend only hands jobs to headless workers, see worker.py.
+        self.broker: JobBroker | None = create_broker()
+        self.jobs: JobRegistry = JobRegistry(self, RemoteJob if self.broker is not None else DownloadJob)
+        # Jobs handed to workers are theirs to keep, only the ones running here are journaled.
+        self.journal: JobJournal | None = JobJournal.from_environ() if self.broker is None else None
+        self.disk: DiskSpace = DiskSpace.from_environ(
+            self.journal.directory if self.journal else tempfile.gettempdir(), self.result_cache
+        )
+        self.metrics_runner: web.AppRunner | None = None
+        queue_depth.set_collector(lambda: {
+            **{(name,): stage.depth for name, stage in self.scheduler.stages.items()}, ("disk",): self.disk.depth
+        })
+        self.edit_governor: EditGovernor = EditGovernor(
+            edits_per_second=float(os.environ.get("PROGRESS_EDITS_PER_SECOND", "4")),
+            message_interval=float(os.environ.get("PROGRESS_EDIT_INTERVAL", "1")),
+        )
 
     async def close(self) -> None:
-        if self.session:
-            await self.session.close()
-
+        if self.journal is not None:
+            self.journal.close()
+        await self.uploads.close()
+        if self.broker is not None:
+            await self.broker.close()
+
+        if self.metrics_runner:
+            await self.metrics_runner.cleanup()
+
+        self.executor.close()
+        pool.close()
+        self.edit_governor.close()
         await super().close()
 
-    async def upload_file(self, file_path: str):
-        if self.session is None:
-            self.session = aiohttp.ClientSession()
-
-        with open(file_path, 'rb') as f:
-            data = aiohttp.FormData()
-            data.add_field('file', f, filename=file_path.split('/')[-1])
-
-            async with self.session.post(self.upload_url, data=data) as response:
-                result = await response.json()
-                try:
-                    if result['status'] != 'success':
-                        raise UploadError("Couldn't upload to `tmpfiles.org`")
-                    return result['data']['url']
-                except Exception:
-                    raise UploadError("Weird response from tmpfiles.org")
+    async def upload_file(self, file_path: str) -> str:
+        return await self.uploads.upload(file_path)
 
     def check_startup_once(self):
         current = None
@@ -60,11 +95,38 @@ class StellaVideoBot(commands.Bot):
         with open(self.startup_path, "w") as f:
             json.dump({"VERSION": VERSION}, f, indent=4)
 
+    def record_ready(self, phase: str) -> None:
+        uptime = process_uptime()
+        if uptime is not None:
+            time_to_ready.set(uptime, phase=phase)
+            logging.info(f"Ready ({phase}) {uptime:.2f}s after start")
+
+    async def warm_up(self):
+        # Jobs started before this finishes just build their own instances.
+        start = time.perf_counter()
+        profiles = YouTubeDownloader.warm_profiles()
+        try:
+            if self.broker is None:
+                await self.executor.warm(profiles)
+            # Size estimates always run in this process, whichever executor downloads.
+            await asyncio.to_thread(pool.warm, [estimate_options(profile['format']) for profile in profiles])
+        except Exception:
+            logging.exception("Couldn't warm up yt-dlp.")
+            return
+
+        logging.info(f"Warmed up yt-dlp in {time.perf_counter() - start:.2f}s")
+        self.record_ready("ytdl")
+
     async def after_ready(self):
         await self.wait_until_ready()
+        self.record_ready("discord")
         link_auth = discord.utils.oauth_url(self.user.id, scopes=None)
         logging.info("Success!")
         logging.info(f"You can install your discord bot into your discord client by this link: {link_auth}")
+        if self.journal is not None:
+            for entry in self.journal.pending():
+                logging.info(f"Resuming {entry.url} from its {entry.stage} stage.")
+                self.dispatch("job_resume", entry)
 
     async def setup_hook(self) -> None:
         if self.check_startup_once():
@@ -73,7 +135,13 @@ class StellaVideoBot(commands.Bot):
             self.update_versioning()
 
         logging.info(f"Bot version {VERSION}")
+        await self.uploads.start()
+        metrics_port = os.environ.get("METRICS_PORT")
+        if metrics_port:
+            self.metrics_runner = await serve_metrics(os.environ.get("METRICS_HOST", "127.0.0.1"), int(metrics_port))
+
         asyncio.create_task(self.after_ready())
+        asyncio.create_task(self.warm_up())
 
     def starting(self):
         try:
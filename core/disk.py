@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import logging
+import os
+import shutil
+from typing import TYPE_CHECKING, Callable
+
+from core.errors import ErrorProcessing
+from core.scheduler import FairQueue, Waiter, JobTicket
+
+if TYPE_CHECKING:
+    from core.cache import ResultCache
+    from core.models import FileType, CompressionType
+
+# Roughly what FLAC takes for a second of CD quality stereo.
+FLAC_BYTES_PER_SECOND = 110_000
+
+
+def peak_working_set(
+        download_size: int | None, duration: float | None, file_type: FileType, preset: CompressionType
+) -> int | None:
+    if not download_size:
+        return None
+
+    # The separate streams and their merge, then the source and the encoded output, are on disk together.
+    if file_type.name == "audio" and preset.name == "original" and duration:
+        return download_size + int(duration * FLAC_BYTES_PER_SECOND)
+    return download_size * 2
+
+
+@dataclasses.dataclass(eq=False)
+class DiskReservation:
+    space: DiskSpace
+    size: int
+    # Set when the job got room in the scratch directory instead of its usual place.
+    directory: str | None = None
+    released: bool = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.space.release(self)
+
+
+class DiskSpace:
+    # Jobs reserve their estimated peak before downloading, so they wait for room instead of filling the disk midway.
+    def __init__(
+            self, capacity: int, scratch_directory: str | None, scratch_capacity: int, unknown_size: int,
+            measure: Callable[[], int] | None = None
+    ):
+        self.capacity: int = capacity
+        # Works out the budget from the free space again, unset when it was configured.
+        self.measure: Callable[[], int] | None = measure
+        self.reserved: int = 0
+        self.scratch_directory: str | None = scratch_directory
+        self.scratch_capacity: int = scratch_capacity
+        self.scratch_reserved: int = 0
+        self.unknown_size: int = unknown_size
+        self.waiting: FairQueue = FairQueue()
+        self.sizes: dict[Waiter, int] = {}
+
+    @classmethod
+    def from_environ(cls, directory: str, cache: ResultCache | None = None) -> DiskSpace:
+        unknown_size = int(os.environ.get("DISK_UNKNOWN_JOB_MB", "512")) * 1024 * 1024
+        capacity = int(os.environ.get("DISK_BUDGET_MB", "0")) * 1024 * 1024
+        measure = None
+        if not capacity:
+            reserve = int(os.environ.get("DISK_RESERVE_MB", "1024")) * 1024 * 1024
+
+            def measure() -> int:
+                # Everything free where jobs work, less room for the rest of the system and for the result cache to grow.
+                return free_space(directory) - reserve - cache_headroom(cache, directory)
+
+            # Never below a single job, a nearly full disk at startup would otherwise refuse everything.
+            capacity = max(unknown_size, measure())
+
+        scratch_directory = os.environ.get("DISK_SCRATCH_DIR") or None
+        scratch_capacity = 0
+        if scratch_directory is not None:
+            os.makedirs(scratch_directory, exist_ok=True)
+            scratch_capacity = int(os.environ.get("DISK_SCRATCH_MB", "0")) * 1024 * 1024 or free_space(scratch_directory)
+
+        logging.info(f"Jobs may use {capacity // 2 ** 20} MiB of disk, {scratch_capacity // 2 ** 20} MiB of scratch.")
+        return cls(
+            capacity=capacity,
+            scratch_directory=scratch_directory,
+            scratch_capacity=scratch_capacity,
+            unknown_size=unknown_size,
+            measure=measure,
+        )
+
+    @property
+    def depth(self) -> int:
+        return len(self.waiting)
+
+    def check(self, size: int | None) -> None:
+        if size is None or size <= max(self.capacity, self.scratch_capacity):
+            return
+
+        # Space freed since startup counts too, the budget only ever grows here so reservations stay valid.
+        if self.measure is not None:
+            self.capacity = max(self.capacity, self.measure())
+        if size > max(self.capacity, self.scratch_capacity):
+            raise ErrorProcessing("This needs more disk space than the bot has, try a smaller preset.")
+
+    async def reserve(self, ticket: JobTicket, size: int | None, scratch: bool = True) -> DiskReservation:
+        size = size or self.unknown_size
+        if scratch and self.scratch_directory is not None and self.scratch_reserved + size <= self.scratch_capacity:
+            self.scratch_reserved += size
+            return DiskReservation(self, size, self.scratch_directory)
+
+        # Larger than the whole budget would wait forever, it still gets to run once nothing else does.
+        size = min(size, self.capacity)
+        if self.reserved + size <= self.capacity and not self.depth:
+            self.reserved += size
+            return DiskReservation(self, size)
+
+        waiter = Waiter(ticket, asyncio.get_running_loop().create_future())
+        self.sizes[waiter] = size
+        self.waiting.push(waiter)
+        self.notify_positions()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.reserved -= size
+                self.grant()
+            else:
+                self.waiting.remove(waiter)
+                self.notify_positions()
+            raise
+        finally:
+            self.sizes.pop(waiter, None)
+        return DiskReservation(self, size)
+
+    def release(self, reservation: DiskReservation) -> None:
+        if reservation.directory is not None:
+            self.scratch_reserved -= reservation.size
+            return
+
+        self.reserved -= reservation.size
+        self.grant()
+
+    def grant(self) -> None:
+        # Strictly in turn, small jobs don't keep overtaking a large one that is waiting for room.
+        granted = False
+        while self.depth:
+            waiter = next(self.waiting.order())
+            size = self.sizes[waiter]
+            if self.reserved + size > self.capacity and self.reserved:
+                break
+
+            # Popped rather than removed, so the guild and user go to the back of the round-robin.
+            self.waiting.pop()
+            if not waiter.future.done():
+                self.reserved += size
+                waiter.future.set_result(None)
+                granted = True
+        if granted:
+            self.notify_positions()
+
+    def notify_positions(self) -> None:
+        total = self.depth
+        # A newly queued ticket hears its place right away, the others whenever their place or the queue's length changes.
+        for index, waiter in enumerate(self.waiting.order(), start=1):
+            if (waiter.position, waiter.total) == (index, total):
+                continue
+
+            waiter.position, waiter.total = index, total
+            waiter.ticket.notify("disk", index, total)
+
+
+def free_space(directory: str) -> int:
+    os.makedirs(directory, exist_ok=True)
+    return shutil.disk_usage(directory).free
+
+
+def cache_headroom(cache: ResultCache | None, directory: str) -> int:
+    # What the result cache may still grow by, when it fills the same disk as the jobs.
+    if cache is None or not cache.enabled:
+        return 0
+    if os.stat(cache.directory).st_dev != os.stat(directory).st_dev:
+        return 0
+    return max(0, cache.max_bytes - cache.total_size)
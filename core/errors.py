@@ -23,6 +23,10 @@ class UploadError(DisplayError):
     pass
 
 
+class TransientUploadError(UploadError):
+    pass
+
+
 class InvalidToken(RuntimeError):
     def __init__(self, message: str):
         super().__init__(
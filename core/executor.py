@@ -0,0 +1,332 @@
+from __future__ import annotations
+
+import asyncio
+import copy
+import dataclasses
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+from abc import ABC, abstractmethod
+from typing import Any, Callable
+
+from core import segments
+from core.errors import ErrorProcessing
+from core.ytdl import pool
+
+# yt_dlp is imported where it is used, loading its extractors is most of the bot's startup time.
+
+ProgressCallback = Callable[[dict[str, Any]], None]
+EntryCallback = Callable[[dict[str, Any]], None]
+PROBE_OPTIONS = {'quiet': True, 'noplaylist': True}
+LIST_OPTIONS = {'quiet': True, 'extract_flat': 'in_playlist', 'lazy_playlist': True}
+PROGRESS_KEYS = ('status', 'filename', 'downloaded_bytes', 'total_bytes', 'total_bytes_estimate', 'speed', '_eta_str')
+
+
+def slim_progress(d: dict[str, Any]) -> dict[str, Any]:
+    # yt-dlp's hook dict carries the whole info dict, only relay what the listeners read.
+    return {key: d[key] for key in PROGRESS_KEYS if key in d}
+
+
+@dataclasses.dataclass
+class Fetched:
+    filepath: str
+    duration: float | None
+    vcodec: str | None = None
+    acodec: str | None = None
+    height: int | None = None
+    filesize: int | None = None
+    abr: float | None = None
+
+
+def probe(url: str) -> dict[str, Any]:
+    with pool.checkout(PROBE_OPTIONS) as ydl:
+        info = ydl.extract_info(url, download=False)
+        return ydl.sanitize_info(info)
+
+
+def _entry(ydl: Any, entry: dict[str, Any], url: str) -> dict[str, Any]:
+    item = {
+        'id': entry.get('id'),
+        'url': entry.get('url') if entry.get('_type') in ('url', 'url_transparent') else entry.get('webpage_url') or url,
+        'title': entry.get('title'),
+        'duration': entry.get('duration'),
+    }
+    if entry.get('_type', 'video') == 'video':
+        # Already extracted, e.g. the videos of a tweet, the pipeline can skip probing it again.
+        item['info'] = ydl.sanitize_info(entry)
+    return item
+
+
+def list_entries(url: str, limit: int, on_entry: EntryCallback) -> int:
+    import yt_dlp
+
+    with pool.checkout(LIST_OPTIONS) as ydl:
+        info = ydl.extract_info(url, download=False, process=False)
+        for _ in range(3):
+            if info.get('_type') not in ('url', 'url_transparent'):
+                break
+            info = ydl.extract_info(info['url'], download=False, process=False, ie_key=info.get('ie_key'))
+
+        if info.get('_type') not in ('playlist', 'multi_video'):
+            on_entry(_entry(ydl, info, url))
+            return 1
+
+        # Entries are usually a generator fetching pages on demand, only as many pages as needed are requested.
+        entries = info.get('entries') or []
+        if isinstance(entries, yt_dlp.utils.PagedList):
+            entries = entries.getslice(0, limit)
+
+        count = 0
+        for entry in itertools.islice((entry for entry in entries if entry), limit):
+            on_entry(_entry(ydl, entry, url))
+            count += 1
+        return count
+
+
+def extract(url: str, ydl_opts: dict[str, Any], info: dict[str, Any] | None = None) -> Fetched:
+    if segments.ENGINE == "segmented":
+        progress = segments.ProgressTotal(ydl_opts.get('progress_hooks', []))
+        with pool.checkout({**ydl_opts, 'progress_hooks': [progress.hook]}) as ydl:
+            info, filepath = segments.download(ydl, url, info, progress)
+    else:
+        with pool.checkout(ydl_opts) as ydl:
+            if info is None:
+                info = ydl.extract_info(url, download=True)
+            else:
+                # Re-runs format selection on the probed info dict instead of extracting the page again.
+                info = ydl.process_ie_result(copy.deepcopy(info), download=True)
+        filepath = info['requested_downloads'][0]['filepath']
+
+    return Fetched(
+        filepath=filepath,
+        duration=info.get('duration'),
+        vcodec=info.get('vcodec'),
+        acodec=info.get('acodec'),
+        height=info.get('height'),
+        filesize=os.path.getsize(filepath),
+        abr=info.get('abr'),
+    )
+
+
+class DownloadExecutor(ABC):
+    @abstractmethod
+    async def probe(self, url: str) -> dict[str, Any]:
+        pass
+
+    @abstractmethod
+    async def fetch(
+            self, url: str, ydl_opts: dict[str, Any], on_progress: ProgressCallback, info: dict[str, Any] | None = None
+    ) -> Fetched:
+        pass
+
+    @abstractmethod
+    async def list_entries(self, url: str, limit: int, on_entry: EntryCallback) -> int:
+        pass
+
+    async def warm(self, profiles: list[dict[str, Any]]) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class ThreadExecutor(DownloadExecutor):
+    async def probe(self, url: str) -> dict[str, Any]:
+        import yt_dlp
+
+        try:
+            return await asyncio.to_thread(probe, url)
+        except yt_dlp.utils.DownloadError:
+            raise ErrorProcessing(f"Couldn't fetch metadata for {url}.") from None
+
+    async def fetch(
+            self, url: str, ydl_opts: dict[str, Any], on_progress: ProgressCallback, info: dict[str, Any] | None = None
+    ) -> Fetched:
+        import yt_dlp
+
+        loop = asyncio.get_running_loop()
+        ydl_opts = {
+            **ydl_opts,
+            'progress_hooks': [lambda d: loop.call_soon_threadsafe(on_progress, slim_progress(d))],
+        }
+        try:
+            return await asyncio.to_thread(extract, url, ydl_opts, info)
+        except yt_dlp.utils.DownloadError:
+            raise ErrorProcessing(f"Couldn't download {url}.") from None
+
+    async def list_entries(self, url: str, limit: int, on_entry: EntryCallback) -> int:
+        import yt_dlp
+
+        loop = asyncio.get_running_loop()
+        try:
+            return await asyncio.to_thread(list_entries, url, limit, lambda e: loop.call_soon_threadsafe(on_entry, e))
+        except yt_dlp.utils.DownloadError:
+            raise ErrorProcessing(f"Couldn't list the entries of {url}.") from None
+
+    async def warm(self, profiles: list[dict[str, Any]]) -> None:
+        await asyncio.to_thread(pool.warm, profiles)
+
+    def close(self) -> None:
+        pool.close()
+
+
+def _worker_main(conn: multiprocessing.connection.Connection, connections: int) -> None:
+    # Own process group, so killing the worker also takes down the ffmpeg children yt-dlp spawns.
+    if hasattr(os, "setsid"):
+        os.setsid()
+
+    segments.limit_connections(connections)
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            kind, args = conn.recv()
+        except EOFError:
+            return
+
+        try:
+            if kind == "probe":
+                result = probe(*args)
+            elif kind == "warm":
+                result = pool.warm(*args)
+            elif kind == "entries":
+                # Entries travel as progress messages, so the pipeline can start on them while listing goes on.
+                url, limit = args
+                result = list_entries(url, limit, lambda e: conn.send(("progress", e)))
+            else:
+                url, ydl_opts, info = args
+                ydl_opts['progress_hooks'] = [lambda d: conn.send(("progress", slim_progress(d)))]
+                result = extract(url, ydl_opts, info)
+        except Exception as e:
+            conn.send(("error", str(e)))
+        else:
+            conn.send(("done", result))
+
+
+class _Worker:
+    def __init__(self, context: multiprocessing.context.BaseContext, connections: int):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, connections), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    @property
+    def alive(self) -> bool:
+        return self.process.is_alive()
+
+    def kill(self) -> None:
+        if sys.platform != "win32":
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        else:
+            self.process.kill()
+
+        self.conn.close()
+        self.process.join(timeout=5)
+
+
+class ProcessExecutor(DownloadExecutor):
+    def __init__(self, size: int, probes: int):
+        self.context = multiprocessing.get_context("spawn")
+        self.size: int = max(1, size)
+        self.semaphore: asyncio.Semaphore = asyncio.Semaphore(self.size)
+        # Metadata and listing have their own slots, a new request never waits behind running downloads.
+        self.probes: asyncio.Semaphore = asyncio.Semaphore(max(1, probes))
+        self.idle: list[_Worker] = []
+        # Workers can't share a semaphore, each gets an equal share of the connection cap instead.
+        self.connections: int = max(1, segments.MAX_CONNECTIONS // self.size)
+
+    async def probe(self, url: str) -> dict[str, Any]:
+        try:
+            return await self._run(("probe", (url,)), self.probes)
+        except ErrorProcessing:
+            raise ErrorProcessing(f"Couldn't fetch metadata for {url}.") from None
+
+    async def fetch(
+            self, url: str, ydl_opts: dict[str, Any], on_progress: ProgressCallback, info: dict[str, Any] | None = None
+    ) -> Fetched:
+        return await self._run(("extract", (url, ydl_opts, info)), self.semaphore, on_progress)
+
+    async def list_entries(self, url: str, limit: int, on_entry: EntryCallback) -> int:
+        try:
+            return await self._run(("entries", (url, limit)), self.probes, on_entry)
+        except ErrorProcessing:
+            raise ErrorProcessing(f"Couldn't list the entries of {url}.") from None
+
+    async def warm(self, profiles: list[dict[str, Any]]) -> None:
+        # Spawns the workers before the first job needs them, each imports yt-dlp and fills its own pool.
+        async def spawn() -> None:
+            async with self.semaphore:
+                worker = await asyncio.to_thread(_Worker, self.context, self.connections)
+                try:
+                    await self._communicate(worker, ("warm", (profiles,)), None)
+                except BaseException:
+                    await asyncio.to_thread(worker.kill)
+                    raise
+                self.idle.append(worker)
+
+        await asyncio.gather(*(spawn() for _ in range(self.size - len(self.idle))))
+
+    async def _run(
+            self, request: tuple[str, tuple[Any, ...]], slots: asyncio.Semaphore, on_progress: ProgressCallback | None = None
+    ) -> Any:
+        async with slots:
+            worker = None
+            while self.idle and worker is None:
+                worker = self.idle.pop()
+                if not worker.alive:
+                    worker = None
+
+            if worker is None:
+                worker = await asyncio.to_thread(_Worker, self.context, self.connections)
+
+            try:
+                kind, payload = await self._communicate(worker, request, on_progress)
+            except BaseException:
+                # Cancelled or the worker died, either way it can't be trusted with another job.
+                await asyncio.to_thread(worker.kill)
+                raise
+
+            self.idle.append(worker)
+            if kind == "error":
+                raise ErrorProcessing(f"Couldn't download {request[1][0]}.")
+            return payload
+
+    @staticmethod
+    async def _communicate(
+            worker: _Worker, request: tuple[str, tuple[Any, ...]], on_progress: ProgressCallback | None
+    ) -> tuple[str, Any]:
+        worker.conn.send(request)
+        while True:
+            try:
+                kind, payload = await asyncio.to_thread(worker.conn.recv)
+            except (EOFError, OSError):
+                raise ErrorProcessing(f"Download worker for {request[1][0]} stopped unexpectedly.") from None
+
+            if kind == "progress":
+                if on_progress is not None:
+                    on_progress(payload)
+            else:
+                return kind, payload
+
+    def close(self) -> None:
+        for worker in self.idle:
+            worker.kill()
+        self.idle.clear()
+
+
+def create_executor() -> DownloadExecutor:
+    kind = os.environ.get("DOWNLOAD_EXECUTOR", "process")
+    if kind == "thread":
+        return ThreadExecutor()
+    elif kind == "process":
+        return ProcessExecutor(
+            int(os.environ.get("MAX_CONCURRENT_DOWNLOADS", "3")), int(os.environ.get("MAX_CONCURRENT_PROBES", "2"))
+        )
+    else:
+        raise RuntimeError(f"Unknown DOWNLOAD_EXECUTOR {kind!r}, expected 'thread' or 'process'.")
@@ -0,0 +1,131 @@
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import logging
+import os
+from typing import AsyncIterator, Callable
+
+from core.errors import ErrorProcessing
+from core.metrics import active_ffmpeg
+
+FFMPEG_PATH = os.environ.get("FFMPEG_PATH", "ffmpeg")
+FFPROBE_PATH = os.environ.get("FFPROBE_PATH", "ffprobe")
+FIT_PASSES = int(os.environ.get("FIT_PASSES", "2"))
+STREAM_READ_SIZE = 1024 * 1024
+# Progress reports go to stderr between the log lines, `-progress` writes these keys once per update.
+PROGRESS_KEYS = {
+    "frame", "fps", "bitrate", "total_size", "out_time_us", "out_time_ms", "out_time",
+    "dup_frames", "drop_frames", "speed", "progress",
+}
+PROGRESS_ARGS = ['-nostats', '-progress', 'pipe:2']
+
+
+@dataclasses.dataclass
+class EncodeProgress:
+    # Seconds of output written so far, and how many times faster than realtime that is going.
+    seconds: float
+    fps: float | None
+    speed: float | None
+
+
+EncodeListener = Callable[[EncodeProgress], None]
+
+
+def parse_number(value: str | None) -> float | None:
+    try:
+        return float((value or "").rstrip("x"))
+    except ValueError:
+        return None
+
+
+async def read_stderr(stream: asyncio.StreamReader, on_progress: EncodeListener | None) -> str:
+    tail: collections.deque[str] = collections.deque(maxlen=40)
+    fields: dict[str, str] = {}
+    async for raw in stream:
+        line = raw.decode(errors='replace').rstrip()
+        key, separator, value = line.partition("=")
+        if not separator or (key not in PROGRESS_KEYS and not key.startswith("stream_")):
+            tail.append(line)
+            continue
+
+        fields[key] = value
+        if key == "progress":
+            if on_progress is not None:
+                microseconds = parse_number(fields.get("out_time_us"))
+                on_progress(EncodeProgress(
+                    seconds=microseconds / 1_000_000 if microseconds else 0,
+                    fps=parse_number(fields.get("fps")),
+                    speed=parse_number(fields.get("speed")),
+                ))
+            fields.clear()
+    return "\n".join(tail)
+
+
+async def run_ffmpeg(
+        source: str, output: str, args: list[str], input_args: list[str] | None = None,
+        on_progress: EncodeListener | None = None
+) -> None:
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_PATH, '-hide_banner', '-nostdin', '-y', *PROGRESS_ARGS, *(input_args or []), '-i', source, *args, output,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    active_ffmpeg.inc()
+    try:
+        stderr = await read_stderr(process.stderr, on_progress)
+        await process.wait()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    finally:
+        active_ffmpeg.dec()
+
+    if process.returncode != 0:
+        logging.error(f"ffmpeg exited with {process.returncode}: {stderr[-2000:]}")
+        raise ErrorProcessing("Couldn't process the downloaded file.")
+
+
+@contextlib.asynccontextmanager
+async def stream_ffmpeg(
+        source: str, args: list[str], on_progress: EncodeListener | None = None
+) -> AsyncIterator[AsyncIterator[bytes]]:
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_PATH, '-hide_banner', '-nostdin', *PROGRESS_ARGS, '-i', source, *args, 'pipe:1',
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    active_ffmpeg.inc()
+    # Drained alongside stdout, a full stderr pipe would stall the encode.
+    stderr = asyncio.create_task(read_stderr(process.stderr, on_progress))
+
+    async def chunks() -> AsyncIterator[bytes]:
+        while chunk := await process.stdout.read(STREAM_READ_SIZE):
+            yield chunk
+        # The stream only ends once ffmpeg exited cleanly, so a crash midway can't complete an upload.
+        if await process.wait() != 0:
+            logging.error(f"ffmpeg exited with {process.returncode}: {(await stderr)[-2000:]}")
+            raise ErrorProcessing("Couldn't process the downloaded file.")
+
+    try:
+        yield chunks()
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        await asyncio.gather(stderr, return_exceptions=True)
+        active_ffmpeg.dec()
+
+
+async def probe_duration(source: str) -> float | None:
+    process = await asyncio.create_subprocess_exec(
+        FFPROBE_PATH, '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', source,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    stdout, _ = await process.communicate()
+    try:
+        return float(stdout.decode().strip())
+    except ValueError:
+        return None
@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import shutil
+import time
+import urllib.parse
+import uuid
+
+from aiohttp import web
+
+SWEEP_INTERVAL = 60
+
+
+class FileServer:
+    def __init__(self, directory: str, public_url: str, host: str, port: int, ttl: float, secret: bytes):
+        self.directory: str = directory
+        self.public_url: str = public_url.rstrip("/")
+        self.host: str = host
+        self.port: int = port
+        self.ttl: float = ttl
+        self.secret: bytes = secret
+        self.runner: web.AppRunner | None = None
+        self.janitor: asyncio.Task | None = None
+
+    @classmethod
+    def from_environ(cls) -> FileServer:
+        try:
+            public_url = os.environ["FILE_SERVER_PUBLIC_URL"]
+        except KeyError:
+            raise RuntimeError("The local upload backend needs FILE_SERVER_PUBLIC_URL to be set.") from None
+
+        # Without a fixed secret links stop working after a restart, the janitor removes their files anyway.
+        secret = os.environ.get("FILE_SERVER_SECRET")
+        return cls(
+            directory=os.environ.get("FILE_SERVER_DIR", ".cache/served"),
+            public_url=public_url,
+            host=os.environ.get("FILE_SERVER_HOST", "0.0.0.0"),
+            port=int(os.environ.get("FILE_SERVER_PORT", "8080")),
+            ttl=float(os.environ.get("FILE_SERVER_TTL", "86400")),
+            secret=secret.encode() if secret else secrets.token_bytes(32),
+        )
+
+    def sign(self, file_id: str, expires: int) -> str:
+        return hmac.new(self.secret, f"{file_id}:{expires}".encode(), hashlib.sha256).hexdigest()
+
+    def path_of(self, file_id: str) -> str:
+        return os.path.join(self.directory, file_id)
+
+    def publish(self, file_path: str) -> str:
+        _, ext = os.path.splitext(file_path)
+        file_id = f"{uuid.uuid4().hex}{ext}"
+        destination = self.path_of(file_id)
+        # A hard link costs nothing and lets the job's temporary directory go away without taking the file with it.
+        try:
+            os.link(file_path, destination)
+        except OSError:
+            shutil.copyfile(file_path, destination)
+        # The janitor goes by mtime, a linked cache file may be much older than this link.
+        os.utime(destination)
+
+        expires = int(time.time() + self.ttl)
+        name = urllib.parse.quote(os.path.basename(file_path))
+        return f"{self.public_url}/files/{file_id}/{name}?expires={expires}&signature={self.sign(file_id, expires)}"
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        file_id = request.match_info["file_id"]
+        try:
+            expires = int(request.query["expires"])
+            signature = request.query["signature"]
+        except (KeyError, ValueError):
+            raise web.HTTPForbidden()
+
+        if not hmac.compare_digest(signature, self.sign(file_id, expires)):
+            raise web.HTTPForbidden()
+        if expires < time.time():
+            raise web.HTTPGone()
+
+        path = self.path_of(file_id)
+        if not os.path.isfile(path):
+            raise web.HTTPNotFound()
+
+        # FileResponse answers Range and conditional requests and sends the body with sendfile.
+        return web.FileResponse(path, headers={
+            "Content-Disposition": f"attachment; filename*=UTF-8''{urllib.parse.quote(request.match_info['name'])}",
+            "Cache-Control": "private, max-age=0",
+        })
+
+    def sweep(self) -> int:
+        removed = 0
+        deadline = time.time() - self.ttl
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < deadline:
+                        os.remove(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    async def run_janitor(self) -> None:
+        while True:
+            try:
+                removed = await asyncio.to_thread(self.sweep)
+                if removed:
+                    logging.info(f"Removed {removed} expired files from {self.directory}")
+            except OSError as e:
+                logging.warning(f"Couldn't sweep {self.directory}: {e}")
+            await asyncio.sleep(min(SWEEP_INTERVAL, self.ttl))
+
+    async def start(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        app = web.Application()
+        app.router.add_get(r"/files/{file_id:[0-9a-f]{32}(\.\w+)?}/{name}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        self.janitor = asyncio.create_task(self.run_janitor())
+        logging.info(f"Serving finished files on http://{self.host}:{self.port} as {self.public_url}")
+
+    async def close(self) -> None:
+        if self.janitor is not None:
+            self.janitor.cancel()
+        if self.runner is not None:
+            await self.runner.cleanup()
@@ -0,0 +1,316 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import dataclasses
+import logging
+import os
+import tempfile
+import uuid
+from typing import TYPE_CHECKING, Any, AsyncIterator
+
+import core.errors
+from core.broker import JobSpec
+from core.cache import ResultCache, CacheEntry
+from core.disk import DiskReservation, peak_working_set
+from core.errors import UploadError, DisplayError, ErrorProcessing, SomethingWentWrong
+from core.journal import JournalEntry, JournalStage
+from core.metrics import stage_timer, bytes_uploaded
+from core.models import URLParsed, FileType, CompressionType, Progress
+from core.scheduler import JobTicket, QueueName
+
+if TYPE_CHECKING:
+    from core.client import StellaVideoBot
+
+
+@dataclasses.dataclass
+class JobResult:
+    file: str
+    url: str | None
+    upload_error: UploadError | None = None
+
+
+class DownloadJob:
+    def __init__(
+            self, bot: StellaVideoBot, key: str, link: URLParsed, file_type: FileType, preset: CompressionType,
+            guild_id: int | None, user_id: int
+    ):
+        self.bot: StellaVideoBot = bot
+        self.key: str = key
+        self.link: URLParsed = link
+        self.file_type: FileType = file_type
+        self.preset: CompressionType = preset
+        self.guild_id: int | None = guild_id
+        self.user_id: int = user_id
+        self.subscribers: int = 0
+        self.directory: tempfile.TemporaryDirectory | None = None
+        self.entry: JournalEntry | None = None
+        self.reservation: DiskReservation | None = None
+        self.task: asyncio.Task[JobResult] | None = None
+        self.ticket: JobTicket = bot.scheduler.ticket(guild_id, user_id, self._queued)
+        link.ticket = self.ticket
+        link.executor = bot.executor
+
+    def _queued(self, stage: QueueName, position: int, total: int) -> None:
+        self.link.dispatch_progress(Progress(
+            type="queued",
+            eta=None,
+            filename=None,
+            percent=0,
+            speed=None,
+            total=total,
+            current=position,
+            stage=stage
+        ))
+
+    def start(self) -> None:
+        journal = self.bot.journal
+        if journal is not None:
+            # Picks up the entry a previous run left behind for the same key, with its working directory.
+            self.entry = journal.open(
+                self.key, self.link, self.file_type.name, self.preset.name, self.guild_id, self.user_id
+            )
+        self.task = asyncio.create_task(self.run())
+
+    def checkpoint(self, stage: JournalStage, **changes: Any) -> None:
+        if self.entry is not None:
+            self.bot.journal.advance(self.key, stage, **changes)
+
+    async def working_set(self) -> int | None:
+        info = self.link.info
+        if info is None:
+            return None
+        estimate = await info.estimate(self.link.get_format(self.file_type))
+        return peak_working_set(estimate, info.duration, self.file_type, self.preset)
+
+    def working_directory(self) -> str:
+        scratch = self.reservation.directory if self.reservation is not None else None
+        if self.entry is not None:
+            if scratch is not None:
+                self.checkpoint(self.entry.stage, directory=os.path.join(scratch, self.key[:32]))
+            os.makedirs(self.entry.directory, exist_ok=True)
+            return self.entry.directory
+        self.directory = tempfile.TemporaryDirectory(dir=scratch)
+        return self.directory.name
+
+    async def run(self) -> JobResult:
+        entry = self.entry
+        if entry is not None and entry.stage == "done" and entry.upload_url is not None:
+            return JobResult(file=entry.file, url=entry.upload_url)
+
+        cache = self.bot.result_cache
+        cached = cache.get(self.link, self.file_type, self.preset)
+        if cached is not None and cached.cached_url is not None:
+            return JobResult(file=cached.path, url=cached.cached_url)
+
+        if cached is not None:
+            filename = cached.path
+        else:
+            filename = entry.resumed_file() if entry is not None else None
+            if filename is None:
+                # Partial files of a resumed job stay where they are, only new jobs may move to the scratch directory.
+                resuming = entry is not None and entry.stage != "queued"
+                self.reservation = await self.bot.disk.reserve(self.ticket, await self.working_set(), scratch=not resuming)
+                filename = os.path.join(self.working_directory(), f"file.{self.file_type}")
+                self.link.preset = self.preset
+                if entry is not None:
+                    self.link.fetched = entry.resumed_fetch()
+                    self.link.on_fetched = lambda fetched: self.checkpoint("transcode", fetched=dataclasses.asdict(fetched))
+                self.checkpoint("transcode" if self.link.fetched is not None else "download")
+                if self.bot.uploads.streams(self.preset) and self.link.can_stream(self.file_type):
+                    url = await self.stream(filename)
+                    if url is not None:
+                        return JobResult(file=filename, url=url)
+                filename = await self.link.download(filename, self.file_type)
+                self.checkpoint("upload", file=filename)
+            cached = await cache.put(self.link, self.file_type, self.preset, filename)
+
+        # Publishing to the local file server is only a hard link, it doesn't wait behind real uploads.
+        if self.bot.uploads.instant:
+            return await self.upload(filename, cached)
+
+        async with self.ticket.stage("upload"):
+            return await self.upload(filename, cached)
+
+    async def stream(self, filename: str) -> str | None:
+        uploaded = 0
+
+        async def counted(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+            nonlocal uploaded
+            async for chunk in chunks:
+                uploaded += len(chunk)
+                yield chunk
+
+        # Uploads while ffmpeg encodes, inside the transcode slot, so the result cache only keeps the URL.
+        try:
+            url = await self.link.download_stream(
+                filename, self.file_type, lambda chunks, name: self.bot.uploads.upload_stream(counted(chunks), name)
+            )
+        except UploadError as e:
+            logging.warning(f"Streamed upload of {self.link.url} failed, uploading the file instead: {e}")
+            return None
+
+        bytes_uploaded.inc(uploaded, downloader=self.link.__class__.__name__)
+        await self.bot.result_cache.put_url(self.link, self.file_type, self.preset, url)
+        self.checkpoint("done", file=filename, upload_url=url)
+        if self.reservation is not None:
+            self.reservation.release()
+            self.reservation = None
+        return url
+
+    async def upload(self, filename: str, cached: CacheEntry | None) -> JobResult:
+        self.link.dispatch_progress(Progress(
+            type="uploading",
+            eta=None,
+            filename=filename,
+            percent=1,
+            speed=None,
+            total=1,
+            current=1
+        ))
+        try:
+            with stage_timer("upload"):
+                url = await self.bot.upload_file(filename)
+        except UploadError as e:
+            return JobResult(file=filename, url=None, upload_error=e)
+
+        bytes_uploaded.inc(os.path.getsize(filename), downloader=self.link.__class__.__name__)
+
+        await self.bot.result_cache.remember_url(cached, url)
+        self.checkpoint("done", upload_url=url)
+        return JobResult(file=filename, url=url)
+
+    async def wait(self) -> JobResult:
+        # Shielded so one subscriber going away doesn't cancel the download for everyone else.
+        return await asyncio.shield(self.task)
+
+    def cancel(self) -> None:
+        self.task.cancel()
+
+    def cleanup(self) -> None:
+        if self.reservation is not None:
+            self.reservation.release()
+            self.reservation = None
+        if self.directory is not None:
+            self.directory.cleanup()
+            self.directory = None
+        if self.entry is not None:
+            self.bot.journal.discard(self.key)
+            self.entry = None
+
+
+def error_event(error: Exception) -> dict[str, Any]:
+    if isinstance(error, DisplayError):
+        return {"type": "failed", "error": error.__class__.__name__, "message": str(error)}
+    return {"type": "failed", "error": SomethingWentWrong.__name__, "message": ""}
+
+
+def error_from_event(event: dict[str, Any]) -> DisplayError:
+    error = getattr(core.errors, event["error"], None)
+    if error is SomethingWentWrong:
+        return SomethingWentWrong()
+    if not isinstance(error, type) or not issubclass(error, DisplayError):
+        error = ErrorProcessing
+    return error(event["message"])
+
+
+class RemoteJob:
+    # Stands in for a DownloadJob running on a headless worker, progress and the result come back through the broker.
+    def __init__(
+            self, bot: StellaVideoBot, key: str, link: URLParsed, file_type: FileType, preset: CompressionType,
+            guild_id: int | None, user_id: int
+    ):
+        self.bot: StellaVideoBot = bot
+        self.key: str = key
+        self.link: URLParsed = link
+        self.file_type: FileType = file_type
+        self.preset: CompressionType = preset
+        self.subscribers: int = 0
+        self.task: asyncio.Task[JobResult] | None = None
+        self.cancelling: asyncio.Task[None] | None = None
+        self.spec: JobSpec = JobSpec(
+            id=uuid.uuid4().hex,
+            downloader=link.__class__.__name__,
+            url=link.url,
+            ident=link.canonical_id.partition(":")[2],
+            file_type=file_type.name,
+            preset=preset.name,
+            size_limit=link.size_limit,
+            guild_id=guild_id,
+            user_id=user_id,
+        )
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self) -> JobResult:
+        broker = self.bot.broker
+        await broker.submit(self.spec)
+        async with contextlib.aclosing(broker.events(self.spec.id)) as events:
+            async for event in events:
+                if event["type"] == "progress":
+                    self.link.dispatch_progress(Progress(**event["progress"]))
+                elif event["type"] == "result":
+                    return self.result(event)
+                else:
+                    raise error_from_event(event)
+        raise ErrorProcessing("The worker stopped without a result.")
+
+    def result(self, event: dict[str, Any]) -> JobResult:
+        upload_error = UploadError(event["upload_error"]) if event["upload_error"] else None
+        if event["url"] is None and not os.path.exists(event["file"]):
+            # The worker is on another machine, there is no file here to attach instead.
+            raise upload_error or ErrorProcessing("The worker's result isn't reachable from here.")
+        return JobResult(file=event["file"], url=event["url"], upload_error=upload_error)
+
+    async def wait(self) -> JobResult:
+        return await asyncio.shield(self.task)
+
+    async def cancel_remote(self) -> None:
+        try:
+            await self.bot.broker.cancel(self.spec.id)
+        except Exception as e:
+            logging.warning(f"Couldn't cancel job {self.spec.id} on its worker: {e}")
+
+    def cancel(self) -> None:
+        self.task.cancel()
+        self.cancelling = asyncio.create_task(self.cancel_remote())
+
+    def cleanup(self) -> None:
+        pass
+
+
+class JobRegistry:
+    def __init__(self, bot: StellaVideoBot, job_type: type[DownloadJob] | type[RemoteJob] = DownloadJob):
+        self.bot: StellaVideoBot = bot
+        self.job_type: type[DownloadJob] | type[RemoteJob] = job_type
+        self.running: dict[str, DownloadJob | RemoteJob] = {}
+
+    def acquire(
+            self, link: URLParsed, file_type: FileType, preset: CompressionType, guild_id: int | None, user_id: int
+    ) -> DownloadJob | RemoteJob:
+        key = ResultCache.make_key(link, file_type, preset)
+        job = self.running.get(key)
+        if job is None:
+            job = self.job_type(self.bot, key, link, file_type, preset, guild_id, user_id)
+            self.running[key] = job
+            job.start()
+            job.task.add_done_callback(lambda _: self._finished(job))
+
+        job.subscribers += 1
+        return job
+
+    def _finished(self, job: DownloadJob | RemoteJob) -> None:
+        if self.running.get(job.key) is job:
+            del self.running[job.key]
+
+    def release(self, job: DownloadJob | RemoteJob) -> None:
+        job.subscribers -= 1
+        if job.subscribers > 0:
+            return
+
+        if job.task.done():
+            job.cleanup()
+        else:
+            job.cancel()
+            job.task.add_done_callback(lambda _: job.cleanup())
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from typing import TYPE_CHECKING, Any, Callable, Literal
+
+from core.executor import Fetched
+
+if TYPE_CHECKING:
+    from core.models import URLParsed
+
+JournalStage = Literal["queued", "download", "transcode", "upload", "done"]
+
+
+@dataclasses.dataclass
+class JournalEntry:
+    key: str
+    downloader: str
+    url: str
+    ident: str
+    file_type: str
+    preset: str
+    size_limit: int | None
+    guild_id: int | None
+    user_id: int
+    directory: str
+    stage: JournalStage = "queued"
+    fetched: dict[str, Any] | None = None
+    file: str | None = None
+    upload_url: str | None = None
+    # Every message waiting on this job, a resumed job reports back to each of them.
+    replies: list[dict[str, Any]] = dataclasses.field(default_factory=list)
+
+    def resumed_fetch(self) -> Fetched | None:
+        if self.fetched is None or not os.path.exists(self.fetched['filepath']):
+            return None
+        return Fetched(**self.fetched)
+
+    def resumed_file(self) -> str | None:
+        if self.stage not in ("upload", "done") or self.file is None or not os.path.exists(self.file):
+            return None
+        return self.file
+
+
+class JobJournal:
+    # Survives restarts next to the working directories it describes, so unfinished jobs pick up where they stopped.
+    def __init__(self, directory: str):
+        self.directory: str = directory
+        self.index_path: str = os.path.join(directory, "journal.json")
+        self.entries: dict[str, JournalEntry] = {}
+        # Set while the bot shuts down, jobs torn down on the way out stay journaled for the next start.
+        self.closed: bool = False
+        # Writes and removals run in threads, the version keeps a late write from replacing a newer one.
+        self.version: int = 0
+        self.written: int = 0
+        self.write_lock: threading.Lock = threading.Lock()
+        self.background: set[asyncio.Future[None]] = set()
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    @classmethod
+    def from_environ(cls) -> JobJournal | None:
+        directory = os.environ.get("JOB_JOURNAL_DIR", ".cache/journal")
+        return cls(directory) if directory else None
+
+    def load(self) -> None:
+        # Directories a crash left half removed.
+        for name in os.listdir(self.directory):
+            if ".discarded-" in name:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+        if not os.path.exists(self.index_path):
+            return
+
+        try:
+            with open(self.index_path, "r") as f:
+                content = json.load(f)
+        except (OSError, ValueError):
+            logging.warning(f"Job journal at {self.index_path} is unreadable, starting empty.")
+            return
+
+        for data in content.get('entries', []):
+            entry = JournalEntry(**data)
+            self.entries[entry.key] = entry
+
+    def save(self) -> None:
+        if self.closed:
+            return
+
+        self.version += 1
+        self.in_background(self._write, self.version, self.snapshot())
+
+    def snapshot(self) -> dict[str, Any]:
+        return {'entries': [dataclasses.asdict(entry) for entry in self.entries.values()]}
+
+    def _write(self, version: int, content: dict[str, Any]) -> None:
+        with self.write_lock:
+            if version <= self.written:
+                return
+
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(content, f, indent=4)
+            os.replace(tmp_path, self.index_path)
+            self.written = version
+
+    def in_background(self, function: Callable[..., None], *args: Any) -> None:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            function(*args)
+            return
+
+        task = asyncio.ensure_future(asyncio.to_thread(function, *args))
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+
+    def open(
+            self, key: str, link: URLParsed, file_type: str, preset: str, guild_id: int | None, user_id: int
+    ) -> JournalEntry:
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = JournalEntry(
+                key=key,
+                downloader=link.__class__.__name__,
+                url=link.url,
+                ident=link.canonical_id.partition(":")[2],
+                file_type=file_type,
+                preset=preset,
+                size_limit=link.size_limit,
+                guild_id=guild_id,
+                user_id=user_id,
+                directory=os.path.join(self.directory, key[:32]),
+            )
+            self.entries[key] = entry
+            self.save()
+        return entry
+
+    def advance(self, key: str, stage: JournalStage, **changes: Any) -> None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+
+        entry.stage = stage
+        for name, value in changes.items():
+            setattr(entry, name, value)
+        self.save()
+
+    def attach(self, key: str, reply: dict[str, Any]) -> None:
+        entry = self.entries.get(key)
+        if entry is not None and reply not in entry.replies:
+            entry.replies.append(reply)
+            self.save()
+
+    def detach(self, key: str, reply: dict[str, Any]) -> None:
+        entry = self.entries.get(key)
+        if self.closed or entry is None or reply not in entry.replies:
+            return
+
+        entry.replies.remove(reply)
+        self.save()
+
+    def discard(self, key: str) -> None:
+        if self.closed:
+            return
+
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+
+        # Moved aside first, a new job for the same request may create the directory again right away.
+        trash = f"{entry.directory}.discarded-{uuid.uuid4().hex}"
+        try:
+            os.rename(entry.directory, trash)
+        except OSError:
+            pass
+        else:
+            self.in_background(shutil.rmtree, trash, True)
+        self.save()
+
+    def pending(self) -> list[JournalEntry]:
+        # Jobs nobody is waiting on anymore, like playlist items, aren't worth resuming.
+        for entry in [entry for entry in self.entries.values() if not entry.replies]:
+            self.discard(entry.key)
+        return list(self.entries.values())
+
+    def close(self) -> None:
+        # Written right here, the loop may not run the background writes anymore.
+        self.version += 1
+        self._write(self.version, self.snapshot())
+        self.closed = True
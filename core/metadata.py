@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import copy
+import dataclasses
+import os
+import time
+from typing import Any, TYPE_CHECKING
+
+from core.metrics import cache_requests
+from core.ytdl import pool
+
+if TYPE_CHECKING:
+    from core.executor import DownloadExecutor
+    from core.models import URLParsed
+
+
+@dataclasses.dataclass
+class VideoInfo:
+    info: dict[str, Any]
+    expires: float
+    estimates: dict[str, int | None] = dataclasses.field(default_factory=dict)
+
+    @property
+    def title(self) -> str | None:
+        return self.info.get('title')
+
+    @property
+    def duration(self) -> float | None:
+        return self.info.get('duration')
+
+    async def estimate(self, format_spec: str) -> int | None:
+        # Asked for by the flow and again by the job, format selection only runs once per format.
+        if format_spec not in self.estimates:
+            self.estimates[format_spec] = await asyncio.to_thread(estimate_size, self.info, format_spec)
+        return self.estimates[format_spec]
+
+
+def estimate_options(format_spec: str) -> dict[str, Any]:
+    return {'quiet': True, 'format': format_spec}
+
+
+def estimate_size(info: dict[str, Any], format_spec: str) -> int | None:
+    with pool.checkout(estimate_options(format_spec)) as ydl:
+        selected = ydl.process_ie_result(copy.deepcopy(info), download=False)
+    return selected.get('filesize') or selected.get('filesize_approx')
+
+
+class InfoCache:
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl: float = ttl
+        self.max_entries: int = max_entries
+        self.entries: collections.OrderedDict[str, VideoInfo] = collections.OrderedDict()
+        self.pending: dict[str, asyncio.Task[VideoInfo]] = {}
+
+    @classmethod
+    def from_environ(cls) -> InfoCache:
+        return cls(
+            ttl=float(os.environ.get("METADATA_TTL", "600")),
+            max_entries=int(os.environ.get("METADATA_CACHE_ENTRIES", "256")),
+        )
+
+    async def get(self, link: URLParsed, executor: DownloadExecutor) -> VideoInfo:
+        key = link.canonical_id
+        entry = self.entries.get(key)
+        if entry is not None and entry.expires > time.time():
+            cache_requests.inc(cache="metadata", result="hit")
+            self.entries.move_to_end(key)
+            return entry
+
+        cache_requests.inc(cache="metadata", result="miss")
+
+        # Several people asking about the same link at once only probe it once. The probe belongs to the
+        # cache rather than whoever started it, one of them going away doesn't cancel it for the others.
+        probe = self.pending.get(key)
+        if probe is None:
+            probe = asyncio.ensure_future(self._probe(key, link.url, executor))
+            # Marks the exception as retrieved when everyone waiting on it went away.
+            probe.add_done_callback(lambda done: done.cancelled() or done.exception())
+            self.pending[key] = probe
+        return await asyncio.shield(probe)
+
+    async def _probe(self, key: str, url: str, executor: DownloadExecutor) -> VideoInfo:
+        try:
+            info = await executor.probe(url)
+        finally:
+            del self.pending[key]
+
+        entry = VideoInfo(info=info, expires=time.time() + self.ttl)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
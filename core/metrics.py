@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import logging
+import math
+import time
+from typing import Callable, Iterator, TypeVar
+
+from aiohttp import web
+
+from core.utils import url_context
+
+LabelValues = tuple[str, ...]
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, math.inf)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return f"{{{','.join(pairs)}}}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind: str = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labelnames: tuple[str, ...] = labelnames
+
+    def _key(self, labels: dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", *self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: collections.defaultdict[LabelValues, float] = collections.defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        self.values[self._key(labels)] += amount
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.collector: Callable[[], dict[LabelValues, float]] | None = None
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.values[self._key(labels)] -= amount
+
+    def set_collector(self, collector: Callable[[], dict[LabelValues, float]]) -> None:
+        # Read at scrape time, for values that already live somewhere else like queue depths.
+        self.collector = collector
+
+    def samples(self) -> Iterator[str]:
+        if self.collector is not None:
+            self.values.update(self.collector())
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets: tuple[float, ...] = buckets
+        self.counts: dict[LabelValues, list[int]] = {}
+        self.sums: collections.defaultdict[LabelValues, float] = collections.defaultdict(float)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        counts = self.counts.setdefault(key, [0] * len(self.buckets))
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+        self.sums[key] += value
+
+    def samples(self) -> Iterator[str]:
+        for key, counts in self.counts.items():
+            for bound, count in zip(self.buckets, counts):
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                yield f"{self.name}_bucket{labels} {count}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(self.sums[key])}"
+            yield f"{self.name}_count{labels} {counts[-1]}"
+
+
+M = TypeVar('M', bound=Metric)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: M) -> M:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+registry = MetricsRegistry()
+stage_seconds = registry.register(Histogram(
+    "dvd_stage_seconds", "Time spent running each job stage, excluding queue time.", ("stage", "downloader")
+))
+queue_wait_seconds = registry.register(Histogram(
+    "dvd_queue_wait_seconds", "Time jobs waited in the scheduler queue before a stage started.", ("stage",)
+))
+queue_depth = registry.register(Gauge("dvd_queue_depth", "Jobs waiting for a stage.", ("stage",)))
+bytes_downloaded = registry.register(Counter("dvd_downloaded_bytes_total", "Bytes fetched by yt-dlp.", ("downloader",)))
+bytes_uploaded = registry.register(Counter("dvd_uploaded_bytes_total", "Bytes uploaded to the upload host.", ("downloader",)))
+cache_requests = registry.register(Counter("dvd_cache_requests_total", "Cache lookups.", ("cache", "result")))
+active_ffmpeg = registry.register(Gauge("dvd_active_ffmpeg_processes", "ffmpeg processes currently running."))
+job_failures = registry.register(Counter("dvd_job_failures_total", "Jobs that failed, by stage.", ("stage", "downloader")))
+time_to_ready = registry.register(Gauge(
+    "dvd_time_to_ready_seconds", "Seconds from process start until the bot was ready.", ("phase",)
+))
+active_ffmpeg.set(0)
+
+
+def current_downloader() -> str:
+    link = url_context.get(None)
+    return link.__class__.__name__ if link is not None else "unknown"
+
+
+@contextlib.contextmanager
+def stage_timer(stage: str) -> Iterator[None]:
+    downloader = current_downloader()
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        job_failures.inc(stage=stage, downloader=downloader)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage=stage, downloader=downloader)
+        link = url_context.get(None)
+        if link is not None:
+            logging.debug(f"[{link.canonical_id}] {stage} took {elapsed:.2f}s")
+
+
+async def serve_metrics(host: str, port: int) -> web.AppRunner:
+    async def handle(_request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
@@ -1,71 +1,152 @@
 from __future__ import annotations
 
 import asyncio
+import contextlib
 import dataclasses
-import functools
+import os
 import re
-import time
 from abc import abstractmethod
 from enum import StrEnum
-from typing import Self, Callable, Awaitable, Any, Literal, TypeVar, Generic
+from typing import Self, Callable, Any, Literal, TypeVar, Generic, AsyncContextManager, AsyncIterator, Awaitable, NamedTuple
 
 import discord.ui
-import yt_dlp
+import humanize
 
 from core.errors import UserErrorUsage, ErrorProcessing, TimeoutResponding
+from core.executor import DownloadExecutor, ThreadExecutor, Fetched
+from core.ffmpeg import run_ffmpeg, stream_ffmpeg, probe_duration, FIT_PASSES, EncodeListener, EncodeProgress
+from core.metadata import VideoInfo
+from core.metrics import stage_timer, bytes_downloaded
+from core.scheduler import JobTicket, StageName, QueueName
+from core.segments import CONNECTIONS_PER_JOB
 from core.types import Context, Interaction
-from core.utils import FIND_CAMEL
+from core.utils import FIND_CAMEL, format_seconds
 
 
 @dataclasses.dataclass
 class Progress:
-    type: Literal["downloading", "processing"]
+    type: Literal["queued", "downloading", "processing", "uploading"]
     filename: str | None
     percent: float
     total: float
     current: float
     speed: float | None
     eta: str | None
+    stage: QueueName | None = None
+
+
+DownloadListener = Callable[[Progress], None]
+# Takes the encoded output while it's produced and its file name, returns the link it ended up at.
+StreamUpload = Callable[[AsyncIterator[bytes], str], Awaitable[str]]
+CHUNK_SIZE = 1024 * 1024
+
+
+async def read_chunks(path: str) -> AsyncIterator[bytes]:
+    with open(path, "rb") as f:
+        while chunk := await asyncio.to_thread(f.read, CHUNK_SIZE):
+            yield chunk
 
 
-DownloadListener = Callable[[Progress], Awaitable[None]]
 class URLParsed:
     pattern: re.compile
+    # Registrable domains the pattern can match, subdomains like www. and m. are looked up by suffix.
+    hosts: tuple[str, ...] = ()
     def __init__(self, url: str, groups: re.Match[str]):
         self.listeners: list[DownloadListener] = []
         self.url: str = url
         self.groups: re.Match = groups
         self.preset: CompressionType = CompressionType.hd
-        self._last_dispatch_time = 0
+        self.ticket: JobTicket | None = None
+        self.executor: DownloadExecutor = ThreadExecutor()
+        self.size_limit: int | None = None
+        self.info: VideoInfo | None = None
+        # A resumed job's finished download, and who to tell once a new one finishes so it can be resumed too.
+        self.fetched: Fetched | None = None
+        self.on_fetched: Callable[[Fetched], None] | None = None
 
     @property
     def type(self) -> str:
         return FIND_CAMEL.sub(' ', self.__class__.__name__)
 
+    @property
+    def canonical_id(self) -> str:
+        # Patterns capture the extractor's own ID as `id` so different URL spellings
+        # of the same video (youtu.be, shorts, query params) resolve to one key.
+        ident = self.groups.groupdict().get('id') or self.groups.group(0)
+        return f"{self.__class__.__name__}:{ident}"
+
     def add_listener(self, call: DownloadListener) -> None:
         self.listeners.append(call)
 
-    async def dispatch_progress(self, progress: Progress) -> None:
-        async with asyncio.TaskGroup() as group:
-            for listen in self.listeners:
-                group.create_task(listen(progress))
+    def remove_listener(self, call: DownloadListener) -> None:
+        try:
+            self.listeners.remove(call)
+        except ValueError:
+            pass
+
+    def dispatch_progress(self, progress: Progress) -> None:
+        for listen in self.listeners:
+            listen(progress)
+
+    def stage(self, name: StageName) -> AsyncContextManager[None]:
+        if self.ticket is None:
+            return contextlib.nullcontext()
+        return self.ticket.stage(name)
+
+    def thread_args(self) -> list[str]:
+        if self.ticket is None:
+            return []
+        return ['-threads', str(self.ticket.scheduler.encode_threads())]
 
     @abstractmethod
-    async def download(self, file: str, file_type: FileType) -> None:
+    async def download(self, file: str, file_type: FileType) -> str:
         pass
 
+    def can_stream(self, file_type: FileType) -> bool:
+        return False
+
+    async def download_stream(self, file: str, file_type: FileType, upload: StreamUpload) -> str:
+        # Downloaders without a streaming encode still work when can_stream is on, the finished file is read out.
+        file = await self.download(file, file_type)
+        return await upload(read_chunks(file), os.path.basename(file))
+
+    @property
+    def is_playlist(self) -> bool:
+        return self.groups.groupdict().get('playlist') is not None
+
     @classmethod
     def from_url(cls, url: str) -> Self:
         matched = cls.pattern.search(url)
         return cls(url=url, groups=matched)
 
+    @classmethod
+    def restore(cls, url: str, ident: str | None) -> Self:
+        matched = cls.pattern.search(url)
+        # Entries of one tweet or multi-part upload share its URL, only their own IDs tell them apart.
+        if matched is None or (ident and (matched.groupdict().get('id') or matched.group(0)) != ident):
+            matched = re.fullmatch(r"(?P<id>.+)", str(ident or url))
+        return cls(url=url, groups=matched)
+
     @staticmethod
-    async def parse(url: str) -> URLParsed:
-        for Parser in PARSERS:
-            if Parser.pattern.search(url):
-                return Parser.from_url(url)
+    def downloader_named(name: str) -> type[URLParsed] | None:
+        pending: list[type[URLParsed]] = [URLParsed]
+        while pending:
+            parser = pending.pop()
+            if parser.__name__ == name:
+                return parser
+            pending.extend(parser.__subclasses__())
+        return None
+
+    def entry(self, entry: dict[str, Any]) -> Self:
+        # Playlist entries keep the extractor's own ID, so they share cached results with direct links to them.
+        return self.restore(entry.get('url') or self.url, entry.get('id'))
 
-        raise UserErrorUsage(f"Could not find a downloader with this URL: `{url}`")
+    @staticmethod
+    async def parse(url: str) -> URLParsed:
+        links = DISPATCHER.find_all(url)
+        if not links:
+            raise UserErrorUsage(f"Could not find a downloader with this URL: `{url}`")
+        return links[0]
 
     @classmethod
     async def convert(cls, ctx: Context, argument: str) -> Self:
@@ -77,7 +158,12 @@ class URLParsed:
 
 
 class YouTubeDownloader(URLParsed):
-    pattern = re.compile(r"(?:https?://)?(?:www\.)?(?:youtube\.com/(?:watch\?v=|shorts/)|youtu\.be/)([A-Za-z0-9_-]{11})")
+    pattern = re.compile(
+        r"(?:https?://)?(?:www\.|m\.)?(?:"
+        r"(?:youtube\.com/(?:watch\?v=|shorts/)|youtu\.be/)(?P<id>[A-Za-z0-9_-]{11})"
+        r"|youtube\.com/playlist\?list=(?P<playlist>[A-Za-z0-9_-]+))"
+    )
+    hosts = ("youtube.com", "youtu.be")
 
     @property
     def type(self) -> str:
@@ -85,46 +171,27 @@ class YouTubeDownloader(URLParsed):
             return "YouTube Downloader"
         return super().type
 
-    def _progress_hook(self, event_loop: asyncio.BaseEventLoop, d: dict[str, Any]) -> None:
+    def _progress_hook(self, d: dict[str, Any]) -> None:
+        # Finishing isn't reported, transcode() follows with the encode's own progress.
         if d['status'] != 'downloading':
-            if d['status'] == 'finished':
-                event_loop.create_task(
-                    self.dispatch_progress(Progress(
-                        type="processing",
-                        eta=None,
-                        filename=None,
-                        percent=1,
-                        speed=1,
-                        total=1,
-                        current=1
-                    ))
-                )
-            return
-
-        now = time.monotonic()
-        if now - self._last_dispatch_time < 0.5:
             return
 
-        self._last_dispatch_time = now
-
         filename = d.get('filename', 'N/A')
         downloaded_bytes = d.get('downloaded_bytes', 0)
         total = d.get('total_bytes_estimate', downloaded_bytes)
-        percent = downloaded_bytes / (total or downloaded_bytes)
+        percent = downloaded_bytes / (total or downloaded_bytes or 1)
         speed = d.get('speed')
         eta_str = d.get('_eta_str', 'N/A')
 
-        event_loop.create_task(
-            self.dispatch_progress(Progress(
-                type="downloading",
-                eta=eta_str,
-                filename=filename,
-                percent=percent,
-                speed=speed,
-                total=total,
-                current=downloaded_bytes
-            ))
-        )
+        self.dispatch_progress(Progress(
+            type="downloading",
+            eta=eta_str,
+            filename=filename,
+            percent=percent,
+            speed=speed,
+            total=total,
+            current=downloaded_bytes
+        ))
 
     def get_video_compression_preset(self) -> list[str]:
         audio_bitrate: str = '128k'
@@ -163,95 +230,386 @@ class YouTubeDownloader(URLParsed):
             ]
         elif self.preset is CompressionType.original:
             return [
-                '-c', 'copy'
+                '-c', 'copy',
+                '-movflags', '+faststart'
             ]
         else:
             raise RuntimeError("Unregistered compression.")
 
-    def get_audio_compression_preset(self) -> dict[str, str]:
-        if self.preset is CompressionType.low:
-            return {
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '64',
-            }
-        elif self.preset is CompressionType.medium:
-            return {
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '128',
-            }
-        elif self.preset is CompressionType.hd:
-            return {
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '256',
-            }
+    def get_audio_compression_preset(self) -> list[str]:
+        if self.preset in AUDIO_BITRATES:
+            return ['-vn', '-c:a', 'libmp3lame', '-b:a', str(AUDIO_BITRATES[self.preset])]
         elif self.preset is CompressionType.original:
-            return {
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'wav',
-            }
+            return ['-vn', '-c:a', 'flac']
         else:
             raise RuntimeError("Unregistered compression.")
 
-    async def download(self, file: str, file_type: FileType) -> None:
-        event_loop = asyncio.get_running_loop()
-        ydl_opts = {}
+    def audio_container(self, fetched: Fetched) -> str | None:
+        return AUDIO_CONTAINERS.get((fetched.acodec or "").split(".")[0])
+
+    def should_copy_audio(self, fetched: Fetched) -> bool:
+        if self.audio_container(fetched) is None:
+            return False
+
+        if self.preset is CompressionType.original:
+            return True
+
+        if self.preset is CompressionType.fit:
+            return self.size_limit is not None and fetched.filesize <= self.size_limit
+
+        return fetched.abr is not None and fetched.abr * 1000 <= AUDIO_BITRATES[self.preset]
+
+    def get_audio_output(self, fetched: Fetched) -> tuple[list[str], str]:
+        if self.should_copy_audio(fetched):
+            container = self.audio_container(fetched)
+            faststart = ['-movflags', '+faststart'] if container == "m4a" else []
+            return ['-vn', '-c:a', 'copy', *faststart], container
+
+        extension = "flac" if self.preset is CompressionType.original else FileType.audio.value
+        return self.get_compression_preset(fetched, FileType.audio), extension
+
+    def get_video_format(self) -> str:
+        fallback = "bestvideo[ext=mp4]+bestaudio[ext=m4a]/bestvideo+bestaudio/best"
+        if self.preset is CompressionType.original:
+            return fallback
+
+        # H.264/AAC within the preset's resolution first, those can be stream copied instead of encoded.
+        height = f"[height<={PRESET_LIMITS[self.preset].max_height}]"
+        return (
+            f"bestvideo[vcodec^=avc1]{height}+bestaudio[acodec^=mp4a]/"
+            f"best[vcodec^=avc1][acodec^=mp4a]{height}/{fallback}"
+        )
+
+    def should_remux(self, fetched: Fetched, file_type: FileType) -> bool:
+        if file_type is not FileType.video or self.preset is CompressionType.original:
+            return False
+
+        if not (fetched.vcodec or "").startswith("avc1") or not (fetched.acodec or "").startswith("mp4a"):
+            return False
+
+        if self.preset is CompressionType.fit:
+            return self.size_limit is not None and fetched.filesize <= self.size_limit
+
+        limits = PRESET_LIMITS[self.preset]
+        if fetched.height is None or fetched.height > limits.max_height or not fetched.duration:
+            return False
+
+        return fetched.filesize * 8 / fetched.duration <= limits.max_bitrate
+
+    def get_audio_format(self) -> str:
+        if self.preset not in AUDIO_BITRATES:
+            return 'bestaudio/best'
+
+        # A source already within the preset's bitrate can be stream copied instead of encoded.
+        return f"bestaudio[abr<={AUDIO_BITRATES[self.preset] // 1000}]/bestaudio/best"
+
+    def get_format(self, file_type: FileType) -> str:
         if file_type is FileType.video:
-            ydl_opts = {
-                'outtmpl': file,
-                'noplaylist': True,
-                'quiet': True,
-                'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/bestvideo+bestaudio/best',
-                'merge_output_format': 'mp4',
-                'postprocessor_args': self.get_video_compression_preset(),
-            }
-        elif file_type is FileType.audio:
-            if file.endswith(".mp3"):
-                file, *_ = file.rpartition(".")
-            ydl_opts = {
-                'outtmpl': file,
-                'noplaylist': True,
-                'quiet': True,
-                'format': 'bestaudio/best',
-                'postprocessors': [self.get_audio_compression_preset()],
-            }
+            return self.get_video_format()
+        return self.get_audio_format()
 
-        ydl_opts['progress_hooks'] = [functools.partial(self._progress_hook, event_loop)]
+    def check_fits(self, duration: float, file_type: FileType) -> None:
+        if file_type is FileType.video:
+            self.get_video_fit_preset(duration)
+        else:
+            self.get_audio_fit_preset(duration)
+
+    def ydl_options(self, file_type: FileType) -> dict[str, Any]:
+        ydl_opts = {
+            'noplaylist': True,
+            'quiet': True,
+            'noprogress': True,
+            'format': self.get_format(file_type),
+            'concurrent_fragment_downloads': CONNECTIONS_PER_JOB,
+        }
+        if file_type is FileType.video:
+            ydl_opts['merge_output_format'] = 'mp4'
+        return ydl_opts
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            error_code = await asyncio.to_thread(lambda: ydl.download([self.url]))
-            if error_code:
-                raise ErrorProcessing(f"Couldn't download {self.url}.")
+    @classmethod
+    def warm_profiles(cls) -> list[dict[str, Any]]:
+        profiles = []
+        for file_type in FileType:
+            for preset in CompressionType:
+                link = cls(url="", groups=None)
+                link.preset = preset
+                profiles.append(link.ydl_options(file_type))
+        return profiles
+
+    async def fetch(self, directory: str, file_type: FileType) -> Fetched:
+        ydl_opts = {**self.ydl_options(file_type), 'outtmpl': f"{directory}/source.%(ext)s"}
+        info = self.info.info if self.info is not None else None
+        return await self.executor.fetch(self.url, ydl_opts, self._progress_hook, info)
+
+    def get_fit_bitrates(self, duration: float, audio_bitrate: int) -> tuple[int, int]:
+        # Leave room for container overhead so the muxed file lands under the limit.
+        budget = self.size_limit * 8 * 0.95 / duration
+        audio_bitrate = min(audio_bitrate, max(32_000, int(budget * 0.15)))
+        video_bitrate = int(budget - audio_bitrate)
+        if video_bitrate < 50_000:
+            limit = humanize.naturalsize(self.size_limit)
+            raise ErrorProcessing(f"This video is too long to fit in {limit}, try the audio format instead.")
+        return video_bitrate, audio_bitrate
+
+    def get_video_fit_preset(self, duration: float) -> list[str]:
+        video_bitrate, audio_bitrate = self.get_fit_bitrates(duration, 128_000)
+        if video_bitrate >= 2_500_000:
+            height = 1080
+        elif video_bitrate >= 1_200_000:
+            height = 720
+        elif video_bitrate >= 600_000:
+            height = 480
+        else:
+            height = 360
+
+        return [
+            '-c:v', 'libx264',
+            '-preset', 'medium',
+            '-b:v', str(video_bitrate),
+            '-maxrate', str(video_bitrate),
+            '-bufsize', str(video_bitrate * 2),
+            '-vf', f"scale=-2:'min({height},ih)'",
+            '-profile:v', 'main',
+            '-pix_fmt', 'yuv420p',
+            '-c:a', 'aac',
+            '-b:a', str(audio_bitrate),
+            '-movflags', '+faststart'
+        ]
+
+    def get_audio_fit_preset(self, duration: float) -> list[str]:
+        budget = int(self.size_limit * 8 * 0.95 / duration)
+        if budget < 32_000:
+            limit = humanize.naturalsize(self.size_limit)
+            raise ErrorProcessing(f"This audio is too long to fit in {limit}.")
+        return ['-vn', '-c:a', 'libmp3lame', '-b:a', str(min(budget, 320_000))]
+
+    def get_compression_preset(self, fetched: Fetched, file_type: FileType) -> list[str]:
+        if self.preset is not CompressionType.fit:
+            if file_type is FileType.video:
+                return self.get_video_compression_preset()
+            return self.get_audio_compression_preset()
+
+        if not fetched.duration or not self.size_limit:
+            raise ErrorProcessing("Couldn't work out the duration of this video to fit it, try another preset.")
+
+        if file_type is FileType.video:
+            return self.get_video_fit_preset(fetched.duration)
+        return self.get_audio_fit_preset(fetched.duration)
+
+    def dispatch_processing(self, file: str, duration: float | None) -> None:
+        self.dispatch_progress(Progress(
+            type="processing",
+            eta=None,
+            filename=file,
+            percent=0,
+            speed=None,
+            total=duration or 0,
+            current=0
+        ))
+
+    def encode_listener(self, file: str, duration: float | None, passes: int = 1, done: int = 0) -> EncodeListener:
+        # Current and total are seconds of media here, speed is how many times faster than realtime it encodes.
+        def listener(progress: EncodeProgress) -> None:
+            if not duration:
+                self.dispatch_progress(Progress(
+                    type="processing", eta=None, filename=file, percent=0, speed=progress.speed, total=0,
+                    current=progress.seconds
+                ))
+                return
+
+            current = min(progress.seconds, duration)
+            # What is left of this pass and any after it, at the speed this one is going.
+            remaining = (passes - done) * duration - current
+            self.dispatch_progress(Progress(
+                type="processing",
+                eta=format_seconds(remaining / progress.speed) if progress.speed else None,
+                filename=file,
+                percent=(done + current / duration) / passes,
+                speed=progress.speed,
+                total=duration,
+                current=current
+            ))
+
+        return listener
+
+    def get_stream_output(self, fetched: Fetched, file_type: FileType) -> tuple[list[str], str]:
+        if self.should_remux(fetched, file_type):
+            args, extension = ['-c', 'copy'], "mp4"
+        elif file_type is FileType.audio:
+            args, extension = self.get_audio_output(fetched)
+        else:
+            args, extension = self.get_compression_preset(fetched, file_type), "mp4"
+
+        # A pipe can't be seeked back into to move the index to the front, fragments carry their own instead.
+        if '-movflags' in args:
+            index = args.index('-movflags')
+            args = args[:index] + args[index + 2:]
+        if extension == "mp4":
+            args = [*args, '-movflags', 'frag_keyframe+empty_moov+default_base_moof']
+        elif extension == "m4a":
+            # Every audio frame is a keyframe, fragments are cut by duration instead.
+            args = [*args, '-movflags', 'empty_moov+default_base_moof', '-frag_duration', '1000000']
+        return [*args, '-f', STREAM_MUXERS[extension]], extension
+
+    async def transcode(self, fetched: Fetched, file: str, file_type: FileType) -> str:
+        if not fetched.duration:
+            # Direct links often come without a duration in the info dict, fit and the progress ETA need it.
+            fetched.duration = await probe_duration(fetched.filepath)
+
+        remux = self.should_remux(fetched, file_type)
+        if remux:
+            args = ['-c', 'copy', '-movflags', '+faststart']
+        elif file_type is FileType.audio:
+            # Audio ends up in its codec's own container, the extension is only known now.
+            args, extension = self.get_audio_output(fetched)
+            file = f"{os.path.splitext(file)[0]}.{extension}"
+        else:
+            args = self.get_compression_preset(fetched, file_type)
+
+        self.dispatch_processing(file, fetched.duration)
+        args = [*args, *self.thread_args()]
+        keep_source = False
+        try:
+            if not remux and self.preset is CompressionType.fit and file_type is FileType.video and FIT_PASSES == 2:
+                # First pass only gathers rate statistics, so the second one can hit the bitrate budget closely.
+                passlog = os.path.join(os.path.dirname(file) or ".", "passlog")
+                await run_ffmpeg(
+                    fetched.filepath, os.devnull, [*args, '-pass', '1', '-passlogfile', passlog, '-an', '-f', 'null'],
+                    on_progress=self.encode_listener(file, fetched.duration, passes=2)
+                )
+                await run_ffmpeg(
+                    fetched.filepath, file, [*args, '-pass', '2', '-passlogfile', passlog],
+                    on_progress=self.encode_listener(file, fetched.duration, passes=2, done=1)
+                )
+            else:
+                await run_ffmpeg(fetched.filepath, file, args, on_progress=self.encode_listener(file, fetched.duration))
+        except asyncio.CancelledError:
+            # A journaled job encodes its downloaded source again after a restart, its directory goes with the job.
+            keep_source = self.on_fetched is not None
+            raise
+        finally:
+            if not keep_source:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(fetched.filepath)
+        return file
+
+    async def fetch_source(self, directory: str, file_type: FileType) -> Fetched:
+        fetched = self.fetched
+        if fetched is None:
+            # yt-dlp continues any .part files an interrupted run left in the directory.
+            async with self.stage("download"):
+                with stage_timer("download"):
+                    fetched = await self.fetch(directory, file_type)
+                bytes_downloaded.inc(fetched.filesize, downloader=self.__class__.__name__)
+            if self.on_fetched is not None:
+                self.on_fetched(fetched)
+        return fetched
+
+    async def download(self, file: str, file_type: FileType) -> str:
+        fetched = await self.fetch_source(os.path.dirname(file) or ".", file_type)
+        async with self.stage("transcode"):
+            with stage_timer("transcode"):
+                return await self.transcode(fetched, file, file_type)
+
+    def can_stream(self, file_type: FileType) -> bool:
+        # fit needs the whole file for its passes, original keeps a seekable file at full quality.
+        return self.preset in (CompressionType.low, CompressionType.medium)
+
+    async def download_stream(self, file: str, file_type: FileType, upload: StreamUpload) -> str:
+        # Kept on the link, if the upload fails the file based download encodes the same source again.
+        self.fetched = await self.fetch_source(os.path.dirname(file) or ".", file_type)
+        async with self.stage("transcode"):
+            with stage_timer("transcode"):
+                if not self.fetched.duration:
+                    self.fetched.duration = await probe_duration(self.fetched.filepath)
+                args, extension = self.get_stream_output(self.fetched, file_type)
+                filename = f"{os.path.splitext(os.path.basename(file))[0]}.{extension}"
+                self.dispatch_processing(filename, self.fetched.duration)
+                listener = self.encode_listener(filename, self.fetched.duration)
+                async with stream_ffmpeg(self.fetched.filepath, [*args, *self.thread_args()], listener) as chunks:
+                    url = await upload(chunks, filename)
+        # Only needed again if the upload had failed, nothing of a streamed job has to stay on disk.
+        os.remove(self.fetched.filepath)
+        self.fetched = None
+        return url
 
 
 class TikTokDownloader(YouTubeDownloader):
-    pattern = re.compile(r'https?://((?:vm|vt|www)\.)?tiktok\.com/.*')
+    pattern = re.compile(r'https?://((?:vm|vt|www)\.)?tiktok\.com/(?:@[\w.-]+/video/(?P<id>\d+))?.*')
+    hosts = ("tiktok.com",)
 
 
 class TwitterDownloader(YouTubeDownloader):
-    pattern = re.compile(r'https?://(x\.com|twitter\.com)/(i/)?[^/]+/status/\d+')
+    pattern = re.compile(r'https?://(x\.com|twitter\.com)/(i/)?[^/]+/status/(?P<id>\d+)')
+    hosts = ("x.com", "twitter.com")
 
 
 class TwitchClipsDownloader(YouTubeDownloader):
-    pattern = re.compile(r'https?://(?:www\.)?twitch\.tv/(?:[a-zA-Z0-9_]+/)?clip/([a-zA-Z0-9_-]+)')
+    pattern = re.compile(r'https?://(?:www\.)?twitch\.tv/(?:[a-zA-Z0-9_]+/)?clip/(?P<id>[a-zA-Z0-9_-]+)')
+    hosts = ("twitch.tv",)
 
 
 class BiliBiliDownloader(YouTubeDownloader):
-    pattern = re.compile(r'https?://(?:www\.)?bilibili\.com/video/(av\d+|BV[a-zA-Z0-9]+)/?')
+    pattern = re.compile(r'https?://(?:www\.)?bilibili\.com/video/(?P<id>av\d+|BV[a-zA-Z0-9]+)/?')
+    hosts = ("bilibili.com",)
 
 
 class FileType(StrEnum):
     video = "mp4"
     audio = "mp3"
 
+    def filename(self, path: str) -> str:
+        # The value is only the usual extension, stream copied audio keeps its codec's own.
+        _, extension = os.path.splitext(path)
+        return f"file{extension}" if extension else f"file.{self}"
+
 
 class CompressionType(StrEnum):
     low = "low"
     medium = "medium"
     hd = "hd"
     original = "original"
+    fit = "fit"
+
+
+class PresetLimits(NamedTuple):
+    max_height: int
+    max_bitrate: int
+
+
+# What a source must already stay under to be stream copied instead of encoded with the preset.
+PRESET_LIMITS: dict[CompressionType, PresetLimits] = {
+    CompressionType.low: PresetLimits(max_height=480, max_bitrate=1_000_000),
+    CompressionType.medium: PresetLimits(max_height=720, max_bitrate=2_500_000),
+    CompressionType.hd: PresetLimits(max_height=1080, max_bitrate=6_000_000),
+    CompressionType.fit: PresetLimits(max_height=1080, max_bitrate=6_000_000),
+}
+
+
+# Bitrates the audio presets encode to, sources at or under them are stream copied.
+AUDIO_BITRATES: dict[CompressionType, int] = {
+    CompressionType.low: 64_000,
+    CompressionType.medium: 128_000,
+    CompressionType.hd: 256_000,
+}
+
+# Audio codecs that are stream copied, by yt-dlp's codec name, and the container each goes into.
+AUDIO_CONTAINERS: dict[str, str] = {
+    "mp4a": "m4a",
+    "aac": "m4a",
+    "opus": "opus",
+    "vorbis": "ogg",
+    "mp3": "mp3",
+}
+
+# ffmpeg muxer writing each streamed output extension to a pipe.
+STREAM_MUXERS: dict[str, str] = {
+    "mp4": "mp4",
+    "m4a": "ipod",
+    "mp3": "mp3",
+    "opus": "opus",
+    "ogg": "ogg",
+}
 
 
 PARSERS = [
@@ -261,6 +619,52 @@ PARSERS = [
     TwitterDownloader,
     BiliBiliDownloader
 ]
+
+
+class URLDispatcher:
+    # Anything that looks like a link, with or without a scheme, in one scan of the text.
+    CANDIDATE = re.compile(r"(?:https?://)?(?:[a-z0-9-]+\.)+[a-z]{2,}(?::\d+)?/[^\s<>\"'`|]*", re.IGNORECASE)
+    TRAILING = ".,;:!?)]}*_~"
+
+    def __init__(self, parsers: list[type[URLParsed]]):
+        self.by_host: dict[str, list[type[URLParsed]]] = {}
+        for parser in parsers:
+            for host in parser.hosts:
+                self.by_host.setdefault(host, []).append(parser)
+
+    @staticmethod
+    def host_of(candidate: str) -> str:
+        _, _, rest = candidate.rpartition("://")
+        return rest.split("/", 1)[0].split(":", 1)[0].lower()
+
+    def parsers_for(self, host: str) -> list[type[URLParsed]]:
+        labels = host.split(".")
+        for start in range(len(labels) - 1):
+            parsers = self.by_host.get(".".join(labels[start:]))
+            if parsers is not None:
+                return parsers
+        return []
+
+    def match(self, candidate: str) -> URLParsed | None:
+        if "://" not in candidate:
+            candidate = f"https://{candidate}"
+        for parser in self.parsers_for(self.host_of(candidate)):
+            matched = parser.pattern.search(candidate)
+            if matched:
+                return parser(url=candidate, groups=matched)
+        return None
+
+    def find_all(self, text: str) -> list[URLParsed]:
+        links: dict[str, URLParsed] = {}
+        for found in self.CANDIDATE.finditer(text):
+            link = self.match(found.group(0).rstrip(self.TRAILING))
+            # The same video linked twice, or in the message and its embed, is only downloaded once.
+            if link is not None and link.canonical_id not in links:
+                links[link.canonical_id] = link
+        return list(links.values())
+
+
+DISPATCHER = URLDispatcher(PARSERS)
 T = TypeVar('T', bound=StrEnum)
 
 class ViewAnswer(discord.ui.View, Generic[T]):
@@ -320,3 +724,23 @@ class ViewCompressionType(ViewAnswer[CompressionType]):
     @discord.ui.button(label='Original', style=discord.ButtonStyle.blurple)
     async def ori(self, interaction: discord.Interaction, _button: discord.ui.Button):
         await self.responded(interaction, CompressionType.original)
+
+    @discord.ui.button(label='Fit', style=discord.ButtonStyle.blurple)
+    async def fit(self, interaction: discord.Interaction, _button: discord.ui.Button):
+        await self.responded(interaction, CompressionType.fit)
+
+
+class ViewCancel(discord.ui.View):
+    def __init__(self, user_id: int):
+        super().__init__(timeout=None)
+        self.user_id: int = user_id
+        self.cancelled: bool = False
+
+    async def interaction_check(self, interaction: discord.Interaction, /) -> bool:
+        return interaction.user.id == self.user_id
+
+    @discord.ui.button(label='Cancel', style=discord.ButtonStyle.red)
+    async def cancel(self, interaction: discord.Interaction, _button: discord.ui.Button):
+        await interaction.response.defer()
+        self.cancelled = True
+        self.stop()
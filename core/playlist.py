@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import dataclasses
+import time
+from typing import TYPE_CHECKING, Any, AsyncIterator, Awaitable, Callable, Literal
+
+from core.metadata import VideoInfo
+
+if TYPE_CHECKING:
+    from core.executor import DownloadExecutor
+    from core.models import URLParsed
+
+ItemStatus = Literal["waiting", "queued", "downloading", "processing", "uploading", "finished", "failed"]
+
+
+@dataclasses.dataclass
+class PlaylistItem:
+    index: int
+    link: URLParsed
+    title: str | None
+    status: ItemStatus = "waiting"
+    percent: float = 0
+    url: str | None = None
+    error: str | None = None
+
+
+async def iter_items(link: URLParsed, executor: DownloadExecutor, limit: int, info_ttl: float) -> AsyncIterator[PlaylistItem]:
+    # Items are handed out while the listing is still running, the first ones start before the last are known.
+    queue: asyncio.Queue[dict[str, Any] | None] = asyncio.Queue()
+    lister = asyncio.create_task(executor.list_entries(link.url, limit, queue.put_nowait))
+    lister.add_done_callback(lambda _: queue.put_nowait(None))
+    try:
+        index = 0
+        while (entry := await queue.get()) is not None:
+            index += 1
+            item = link.entry(entry)
+            if entry.get('info') is not None:
+                item.info = VideoInfo(info=entry['info'], expires=time.time() + info_ttl)
+            yield PlaylistItem(index=index, link=item, title=entry.get('title'))
+
+        lister.result()
+    finally:
+        lister.cancel()
+
+
+async def run_pipeline(
+        items: AsyncIterator[PlaylistItem], process: Callable[[PlaylistItem], Awaitable[None]], concurrency: int
+) -> None:
+    # Bounds how many items of one playlist are in flight, the scheduler still bounds each stage bot-wide.
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    tasks: set[asyncio.Task[None]] = set()
+
+    async def run(item: PlaylistItem) -> None:
+        try:
+            await process(item)
+        finally:
+            semaphore.release()
+
+    try:
+        async with contextlib.aclosing(items):
+            async for item in items:
+                await semaphore.acquire()
+                tasks.add(asyncio.create_task(run(item)))
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
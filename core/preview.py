@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import os
+from typing import Any
+
+from core.ffmpeg import run_ffmpeg
+from core.models import FileType, CompressionType
+from core.scheduler import JobTicket
+
+PRESETS = {name.strip() for name in os.environ.get("PREVIEW_PRESETS", "").split(",") if name.strip()}
+SECONDS = int(os.environ.get("PREVIEW_SECONDS", "30"))
+# Smaller isn't worth watching, larger isn't quick to encode anymore.
+MIN_HEIGHT = 240
+MAX_HEIGHT = 360
+# Direct files and HLS, ffmpeg reads them itself and stops once it has enough.
+PROTOCOLS = ("http", "https", "m3u8", "m3u8_native")
+ENCODE = [
+    '-c:v', 'libx264',
+    '-preset', 'veryfast',
+    '-crf', '30',
+    '-vf', f"scale=-2:'min({MAX_HEIGHT},ih)'",
+    '-pix_fmt', 'yuv420p',
+    '-c:a', 'aac',
+    '-b:a', '64k',
+    '-movflags', '+faststart'
+]
+
+
+def wants_preview(file_type: FileType, preset: CompressionType) -> bool:
+    return file_type is FileType.video and preset.name in PRESETS
+
+
+def smallest(formats: list[dict[str, Any]]) -> dict[str, Any] | None:
+    if not formats:
+        return None
+
+    formats = sorted(formats, key=lambda f: (f.get('height') or 0, f.get('tbr') or 0))
+    watchable = [f for f in formats if (f.get('height') or 0) >= MIN_HEIGHT]
+    return watchable[0] if watchable else formats[-1]
+
+
+def preview_sources(info: dict[str, Any]) -> list[dict[str, Any]]:
+    formats = [f for f in info.get('formats') or [info] if f.get('url') and f.get('protocol') in PROTOCOLS]
+    # Sites often leave the codecs out, only an explicit 'none' says a stream is missing.
+    muxed = smallest([f for f in formats if f.get('vcodec') != 'none' and f.get('acodec') != 'none'])
+    if muxed is not None:
+        return [muxed]
+
+    video = smallest([f for f in formats if f.get('vcodec') != 'none' and f.get('acodec') == 'none'])
+    audio = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') != 'none']
+    if video is None:
+        return []
+    if not audio:
+        return [video]
+    return [video, min(audio, key=lambda f: f.get('abr') or f.get('tbr') or 0)]
+
+
+def reading(fmt: dict[str, Any]) -> list[str]:
+    headers = "".join(f"{name}: {value}\r\n" for name, value in (fmt.get('http_headers') or {}).items())
+    return [*(['-headers', headers] if headers else []), '-rw_timeout', '15000000', '-t', str(SECONDS)]
+
+
+async def make_preview(info: dict[str, Any], file: str, ticket: JobTicket) -> str | None:
+    sources = preview_sources(info)
+    if not sources:
+        return None
+
+    first, *rest = sources
+    args = [arg for fmt in rest for arg in (*reading(fmt), '-i', fmt['url'])]
+    if rest:
+        args += ['-map', '0:v:0', '-map', '1:a:0']
+    async with ticket.stage("preview"):
+        threads = ['-threads', str(ticket.scheduler.encode_threads())]
+        await run_ffmpeg(first['url'], file, [*args, *ENCODE, *threads, '-t', str(SECONDS)], input_args=reading(first))
+    return file
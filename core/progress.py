@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import heapq
+import itertools
+import logging
+import time
+from typing import Callable, Awaitable
+
+from core.models import Progress
+
+ProgressRenderer = Callable[[Progress], Awaitable[None]]
+
+
+class ProgressChannel:
+    # Keeps only the newest progress of a job, older values are dropped instead of queued as edits.
+    def __init__(self, governor: EditGovernor, render: ProgressRenderer):
+        self.governor: EditGovernor = governor
+        self.render: ProgressRenderer = render
+        self.latest: Progress | None = None
+        self.last_edit: float = 0
+        self.scheduled: bool = False
+        self.closed: bool = False
+        self.inflight: asyncio.Future[None] | None = None
+
+    def __call__(self, progress: Progress) -> None:
+        self.push(progress)
+
+    def push(self, progress: Progress) -> None:
+        if self.closed:
+            return
+
+        self.latest = progress
+        self.governor.schedule(self)
+
+    def take(self) -> Progress | None:
+        progress, self.latest = self.latest, None
+        return progress
+
+    async def close(self) -> None:
+        # Waits out an edit already sent so it can't land on top of the final message.
+        self.closed = True
+        self.latest = None
+        if self.inflight is not None:
+            try:
+                await asyncio.shield(self.inflight)
+            except Exception:
+                pass
+
+
+class EditGovernor:
+    def __init__(self, edits_per_second: float, message_interval: float):
+        self.edits_per_second: float = edits_per_second
+        self.message_interval: float = message_interval
+        self.queue: list[tuple[float, int, ProgressChannel]] = []
+        self.counter = itertools.count()
+        self.wakeup: asyncio.Event = asyncio.Event()
+        self.task: asyncio.Task[None] | None = None
+        self.edits: int = 0
+
+    def channel(self, render: ProgressRenderer) -> ProgressChannel:
+        return ProgressChannel(self, render)
+
+    def schedule(self, channel: ProgressChannel) -> None:
+        if channel.scheduled:
+            return
+
+        channel.scheduled = True
+        ready = max(time.monotonic(), channel.last_edit + self.message_interval)
+        heapq.heappush(self.queue, (ready, next(self.counter), channel))
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def _next(self) -> ProgressChannel:
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            ready, _, channel = self.queue[0]
+            delay = ready - time.monotonic()
+            if delay > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.queue)
+            channel.scheduled = False
+            return channel
+
+    def _finished(self, channel: ProgressChannel, edit: asyncio.Future[None]) -> None:
+        channel.inflight = None
+        if not edit.cancelled() and edit.exception() is not None:
+            logging.error("Failed to edit progress message.", exc_info=edit.exception())
+        # Progress that came in while the edit was running waited for it, its turn comes now.
+        if channel.latest is not None and not channel.closed:
+            self.schedule(channel)
+
+    async def run(self) -> None:
+        interval = 1 / self.edits_per_second
+        while True:
+            channel = await self._next()
+            # One edit per message at a time, a message stuck in a rate limit doesn't hold up the others.
+            if channel.closed or channel.inflight is not None:
+                continue
+            progress = channel.take()
+            if progress is None:
+                continue
+
+            channel.last_edit = time.monotonic()
+            channel.inflight = asyncio.ensure_future(channel.render(progress))
+            channel.inflight.add_done_callback(functools.partial(self._finished, channel))
+            self.edits += 1
+            await asyncio.sleep(interval)
+
+    def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import os
+import time
+from typing import Literal, Callable, AsyncIterator, Iterator
+
+from core.metrics import queue_wait_seconds
+
+StageName = Literal["download", "transcode", "upload", "preview"]
+# Jobs also queue for disk space before they download, see core.disk.
+QueueName = StageName | Literal["disk"]
+QueuedListener = Callable[[QueueName, int, int], None]
+
+
+@dataclasses.dataclass(eq=False)
+class Waiter:
+    ticket: JobTicket
+    future: asyncio.Future[None]
+    # Last place and queue length the ticket was told about, 0 until it is told the first time.
+    position: int = 0
+    total: int = 0
+
+
+class FairQueue:
+    # Round-robin across guilds first, then across users inside a guild, so a single
+    # busy server or a single user queuing many links can't starve everyone else.
+    def __init__(self):
+        self.guilds: collections.OrderedDict[int | None, collections.OrderedDict[int, collections.deque[Waiter]]] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return sum(len(items) for users in self.guilds.values() for items in users.values())
+
+    def push(self, waiter: Waiter) -> None:
+        users = self.guilds.setdefault(waiter.ticket.guild_id, collections.OrderedDict())
+        users.setdefault(waiter.ticket.user_id, collections.deque()).append(waiter)
+
+    def pop(self) -> Waiter:
+        guild_id, users = next(iter(self.guilds.items()))
+        user_id, items = next(iter(users.items()))
+        waiter = items.popleft()
+        if items:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+
+        if users:
+            self.guilds.move_to_end(guild_id)
+        else:
+            del self.guilds[guild_id]
+        return waiter
+
+    def remove(self, waiter: Waiter) -> None:
+        users = self.guilds.get(waiter.ticket.guild_id)
+        if users is None:
+            return
+
+        items = users.get(waiter.ticket.user_id)
+        if items is None or waiter not in items:
+            return
+
+        items.remove(waiter)
+        if not items:
+            del users[waiter.ticket.user_id]
+        if not users:
+            del self.guilds[waiter.ticket.guild_id]
+
+    def order(self) -> Iterator[Waiter]:
+        guilds = collections.deque(
+            collections.deque(collections.deque(items) for items in users.values())
+            for users in self.guilds.values()
+        )
+        while guilds:
+            users = guilds.popleft()
+            items = users.popleft()
+            yield items.popleft()
+            if items:
+                users.append(items)
+            if users:
+                guilds.append(users)
+
+
+class Stage:
+    def __init__(self, name: StageName, limit: int):
+        self.name: StageName = name
+        self.limit: int = max(1, limit)
+        self.active: int = 0
+        self.waiting: FairQueue = FairQueue()
+
+    @property
+    def depth(self) -> int:
+        return len(self.waiting)
+
+    async def acquire(self, ticket: JobTicket) -> None:
+        if self.active < self.limit and not self.depth:
+            self.active += 1
+            return
+
+        waiter = Waiter(ticket, asyncio.get_running_loop().create_future())
+        self.waiting.push(waiter)
+        self.notify_positions()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release()
+            else:
+                self.waiting.remove(waiter)
+                self.notify_positions()
+            raise
+
+    def release(self) -> None:
+        while self.depth:
+            waiter = self.waiting.pop()
+            if not waiter.future.done():
+                waiter.future.set_result(None)
+                self.notify_positions()
+                return
+
+        self.active -= 1
+
+    def notify_positions(self) -> None:
+        total = self.depth
+        # A newly queued ticket hears its place right away, the others whenever their place or the queue's length changes.
+        for index, waiter in enumerate(self.waiting.order(), start=1):
+            if (waiter.position, waiter.total) == (index, total):
+                continue
+
+            waiter.position, waiter.total = index, total
+            waiter.ticket.notify(self.name, index, total)
+
+
+class JobTicket:
+    def __init__(self, scheduler: JobScheduler, guild_id: int | None, user_id: int, on_queued: QueuedListener | None = None):
+        self.scheduler: JobScheduler = scheduler
+        self.guild_id: int | None = guild_id
+        self.user_id: int = user_id
+        self.on_queued: QueuedListener | None = on_queued
+
+    def notify(self, stage: QueueName, position: int, total: int) -> None:
+        if self.on_queued is not None:
+            self.on_queued(stage, position, total)
+
+    @contextlib.asynccontextmanager
+    async def stage(self, name: StageName) -> AsyncIterator[None]:
+        stage = self.scheduler.stages[name]
+        start = time.perf_counter()
+        await stage.acquire(self)
+        queue_wait_seconds.observe(time.perf_counter() - start, stage=name)
+        try:
+            yield
+        finally:
+            stage.release()
+
+
+class JobScheduler:
+    def __init__(self, downloads: int, transcodes: int, uploads: int, previews: int, cores: int):
+        self.cores: int = max(1, cores)
+        self.stages: dict[StageName, Stage] = {
+            "download": Stage("download", downloads),
+            "transcode": Stage("transcode", transcodes),
+            "upload": Stage("upload", uploads),
+            # Slots of their own, a preview never waits behind the full encodes it stands in for.
+            "preview": Stage("preview", previews),
+        }
+
+    @classmethod
+    def from_environ(cls) -> JobScheduler:
+        return cls(
+            downloads=int(os.environ.get("MAX_CONCURRENT_DOWNLOADS", "3")),
+            transcodes=int(os.environ.get("MAX_CONCURRENT_TRANSCODES", str(max(1, (os.cpu_count() or 1) // 4)))),
+            uploads=int(os.environ.get("MAX_CONCURRENT_UPLOADS", "3")),
+            previews=int(os.environ.get("MAX_CONCURRENT_PREVIEWS", "2")),
+            cores=int(os.environ.get("ENCODE_CORES", "0")) or os.cpu_count() or 1,
+        )
+
+    @property
+    def depth(self) -> int:
+        return sum(stage.depth for stage in self.stages.values())
+
+    def encode_threads(self) -> int:
+        # Asked by an encode already holding its slot. The ones running and the ones queued to start next split
+        # the cores evenly, rather than each taking all of them and fighting over the CPU.
+        transcode, preview = self.stages["transcode"], self.stages["preview"]
+        encodes = min(transcode.limit, transcode.active + transcode.depth) + preview.active
+        return max(1, self.cores // max(1, encodes))
+
+    def ticket(self, guild_id: int | None, user_id: int, on_queued: QueuedListener | None = None) -> JobTicket:
+        return JobTicket(self, guild_id, user_id, on_queued)
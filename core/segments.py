@@ -0,0 +1,294 @@
+from __future__ import annotations
+
+import copy
+import math
+import os
+import queue
+import re
+import subprocess
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable
+
+from core.ffmpeg import FFMPEG_PATH
+
+if TYPE_CHECKING:
+    import yt_dlp
+
+ENGINE = os.environ.get("DOWNLOAD_ENGINE", "ytdlp")
+CONNECTIONS_PER_JOB = int(os.environ.get("DOWNLOAD_CONNECTIONS", "4"))
+MAX_CONNECTIONS = int(os.environ.get("DOWNLOAD_MAX_CONNECTIONS", "16"))
+# Some hosts throttle long ranges, YouTube among them, yt-dlp itself asks it for 10 MiB at a time.
+SEGMENT_SIZE = 10 * 1024 * 1024
+# Smaller ranges spend more of their time connecting than transferring.
+MIN_SEGMENT_SIZE = 1024 * 1024
+# Below this a single connection finishes before more would have connected.
+MIN_SEGMENTED_SIZE = 2 * 1024 * 1024
+READ_SIZE = 256 * 1024
+RANGE_RETRIES = 3
+CONTENT_RANGE = re.compile(r"bytes \d+-\d+/(\d+)")
+
+connection_slots: threading.BoundedSemaphore = threading.BoundedSemaphore(MAX_CONNECTIONS)
+
+
+def limit_connections(total: int) -> None:
+    # Each download worker process gets its share of the bot-wide cap.
+    global connection_slots
+    connection_slots = threading.BoundedSemaphore(max(1, total))
+
+
+class ProgressTotal:
+    # Every stream and connection of a job reports here, listeners see one download like yt-dlp's own.
+    def __init__(self, hooks: list[Callable[[dict[str, Any]], None]], interval: float = 0.25):
+        self.hooks: list[Callable[[dict[str, Any]], None]] = hooks
+        self.interval: float = interval
+        self.lock: threading.Lock = threading.Lock()
+        self.downloaded: dict[str, int] = {}
+        self.totals: dict[str, int] = {}
+        # Already on disk from an earlier run, counted as done but not towards the speed.
+        self.resumed: int = 0
+        self.started: float = time.monotonic()
+        self.emitted: float = 0
+
+    def expect(self, name: str, total: int | None) -> None:
+        with self.lock:
+            if total:
+                self.totals[name] = total
+
+    def resume(self, name: str, amount: int) -> None:
+        with self.lock:
+            self.resumed += amount
+            self.downloaded[name] = self.downloaded.get(name, 0) + amount
+
+    def add(self, name: str, amount: int) -> None:
+        with self.lock:
+            self.downloaded[name] = self.downloaded.get(name, 0) + amount
+            self._emit()
+
+    def hook(self, d: dict[str, Any]) -> None:
+        # Streams left to yt-dlp's own downloader, its 'finished' is sent once the whole job is.
+        if d['status'] != 'downloading':
+            return
+
+        with self.lock:
+            name = d.get('filename', '')
+            self.downloaded[name] = d.get('downloaded_bytes') or 0
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            if total:
+                self.totals[name] = int(total)
+            self._emit()
+
+    def _emit(self) -> None:
+        now = time.monotonic()
+        if now - self.emitted < self.interval:
+            return
+
+        import yt_dlp
+
+        self.emitted = now
+        downloaded = sum(self.downloaded.values())
+        total = max(sum(self.totals.values()), downloaded)
+        speed = (downloaded - self.resumed) / max(now - self.started, 1e-3)
+        eta = (total - downloaded) / speed if speed else None
+        d = {
+            'status': 'downloading',
+            'downloaded_bytes': downloaded,
+            'total_bytes_estimate': total,
+            'speed': speed,
+            '_eta_str': yt_dlp.utils.formatSeconds(eta) if eta is not None else 'N/A',
+        }
+        # Hooks may write to a pipe, one thread at a time.
+        for hook in self.hooks:
+            hook(d)
+
+    def finish(self) -> None:
+        with self.lock:
+            for hook in self.hooks:
+                hook({'status': 'finished'})
+
+
+def probe_size(ydl: yt_dlp.YoutubeDL, fmt: dict[str, Any]) -> int | None:
+    from yt_dlp.networking import Request
+    from yt_dlp.networking.exceptions import RequestError
+
+    # One byte is enough to learn both the size and whether the server honours ranges.
+    headers = {**(fmt.get('http_headers') or {}), 'Range': 'bytes=0-0'}
+    try:
+        with ydl.urlopen(Request(fmt['url'], headers=headers)) as response:
+            if response.status != 206:
+                return None
+            matched = CONTENT_RANGE.match(response.headers.get('Content-Range', ''))
+    except RequestError:
+        return None
+    return int(matched.group(1)) if matched else None
+
+
+def fetch_range(
+        ydl: yt_dlp.YoutubeDL, fmt: dict[str, Any], path: str, start: int, end: int, on_bytes: Callable[[int], None]
+) -> None:
+    import yt_dlp
+    from yt_dlp.networking import Request
+    from yt_dlp.networking.exceptions import RequestError
+
+    offset = start
+    for attempt in range(RANGE_RETRIES):
+        headers = {**(fmt.get('http_headers') or {}), 'Range': f"bytes={offset}-{end}"}
+        try:
+            with ydl.urlopen(Request(fmt['url'], headers=headers)) as response, open(path, "r+b") as f:
+                if response.status != 206:
+                    raise yt_dlp.utils.DownloadError(f"{fmt['url']} stopped honouring byte ranges.")
+                f.seek(offset)
+                while chunk := response.read(READ_SIZE):
+                    f.write(chunk)
+                    offset += len(chunk)
+                    on_bytes(len(chunk))
+        except RequestError:
+            if attempt == RANGE_RETRIES - 1:
+                raise
+        if offset > end:
+            return
+
+    raise yt_dlp.utils.DownloadError(f"Range {start}-{end} of {fmt['url']} ended early.")
+
+
+def segment_size(total: int) -> int:
+    # Split evenly between the job's connections, so files of a few segments still use all of them.
+    return min(SEGMENT_SIZE, max(MIN_SEGMENT_SIZE, math.ceil(total / CONNECTIONS_PER_JOB)))
+
+
+def read_ledger(ledger: str, size: int) -> set[int] | None:
+    with open(ledger) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    # Indices only mean something with the segment size they were written with.
+    if not lines or lines[0] != f"size {size}":
+        return None
+    return {int(line) for line in lines[1:]}
+
+
+def fetch_segmented(ydl: yt_dlp.YoutubeDL, fmt: dict[str, Any], path: str, total: int, progress: ProgressTotal) -> None:
+    part, ledger = f"{path}.part", f"{path}.segments"
+    size = segment_size(total)
+    count = math.ceil(total / size)
+    finished: set[int] | None = None
+    if os.path.exists(part) and os.path.exists(ledger):
+        # Resumed after a restart, the ledger lists the segments already written.
+        finished = read_ledger(ledger, size)
+    if finished is None:
+        finished = set()
+        with open(part, "wb") as f:
+            f.truncate(total)
+        with open(ledger, "w") as f:
+            f.write(f"size {size}\n")
+
+    progress.expect(path, total)
+    progress.resume(path, sum(min(size, total - index * size) for index in finished))
+    pending: queue.SimpleQueue[int] = queue.SimpleQueue()
+    for index in range(count):
+        if index not in finished:
+            pending.put(index)
+
+    errors: list[BaseException] = []
+    lock = threading.Lock()
+
+    def work() -> None:
+        while not errors:
+            try:
+                index = pending.get_nowait()
+            except queue.Empty:
+                return
+
+            start = index * size
+            try:
+                with connection_slots:
+                    fetch_range(ydl, fmt, part, start, min(total, start + size) - 1, lambda n: progress.add(path, n))
+            except BaseException as e:
+                errors.append(e)
+                return
+
+            with lock, open(ledger, "a") as f:
+                f.write(f"{index}\n")
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(min(CONNECTIONS_PER_JOB, count))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    os.replace(part, path)
+    os.remove(ledger)
+
+
+def fetch_stream(ydl: yt_dlp.YoutubeDL, info: dict[str, Any], fmt: dict[str, Any], path: str, progress: ProgressTotal) -> None:
+    import yt_dlp
+
+    if os.path.exists(path):
+        progress.expect(path, os.path.getsize(path))
+        progress.resume(path, os.path.getsize(path))
+        return
+
+    if fmt.get('protocol') in ('http', 'https'):
+        total = probe_size(ydl, fmt)
+        if total is not None and total >= MIN_SEGMENTED_SIZE:
+            fetch_segmented(ydl, fmt, path, total, progress)
+            return
+
+    # Fragmented formats and small or range-less files, yt-dlp fetches fragments concurrently itself.
+    stream_info = {key: value for key, value in info.items() if key != 'requested_formats'}
+    success, _ = ydl.dl(path, {**stream_info, **fmt})
+    if not success:
+        raise yt_dlp.utils.DownloadError(f"Couldn't download format {fmt.get('format_id')}.")
+
+
+def download(
+        ydl: yt_dlp.YoutubeDL, url: str, info: dict[str, Any] | None, progress: ProgressTotal
+) -> tuple[dict[str, Any], str]:
+    import yt_dlp
+
+    if info is None:
+        info = ydl.extract_info(url, download=False)
+    else:
+        info = copy.deepcopy(info)
+    # Only selects the formats, downloading them is done here.
+    info = ydl.process_ie_result(info, download=False)
+
+    final = ydl.prepare_filename(info)
+    formats = info.get('requested_formats') or [info]
+    if len(formats) == 1:
+        paths = [final]
+    else:
+        base, _ = os.path.splitext(final)
+        paths = [f"{base}.f{fmt['format_id']}.{fmt['ext']}" for fmt in formats]
+
+    # Video and audio download side by side instead of one after the other.
+    errors: list[BaseException] = []
+
+    def run(fmt: dict[str, Any], path: str) -> None:
+        try:
+            fetch_stream(ydl, info, fmt, path, progress)
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(fmt, path), daemon=True) for fmt, path in zip(formats, paths)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    if len(paths) > 1:
+        inputs = [arg for path in paths for arg in ('-i', path)]
+        maps = [arg for index in range(len(paths)) for arg in ('-map', str(index))]
+        process = subprocess.run(
+            [FFMPEG_PATH, '-hide_banner', '-nostdin', '-loglevel', 'error', '-y', *inputs, *maps, '-c', 'copy', final],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+        if process.returncode != 0:
+            raise yt_dlp.utils.DownloadError(f"Couldn't merge the formats: {process.stderr.decode(errors='replace')[-500:]}")
+        for path in paths:
+            os.remove(path)
+
+    progress.finish()
+    return info, final
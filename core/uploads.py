@@ -0,0 +1,489 @@
+from __future__ import annotations
+
+import asyncio
+import datetime
+import hashlib
+import hmac
+import logging
+import os
+import random
+import urllib.parse
+import uuid
+import xml.etree.ElementTree as ElementTree
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, Callable, Mapping, TypeVar
+
+import aiohttp
+import discord
+import yarl
+
+from core.errors import UploadError, TransientUploadError
+from core.fileserver import FileServer
+
+if TYPE_CHECKING:
+    from core.client import StellaVideoBot
+    from core.models import CompressionType
+
+T = TypeVar('T')
+MEGABYTE = 1024 * 1024
+
+
+def raise_for_status(response: aiohttp.ClientResponse, host: str) -> None:
+    if response.status >= 500 or response.status == 429:
+        raise TransientUploadError(f"`{host}` is unavailable right now ({response.status})")
+    if response.status == 413:
+        raise UploadError(f"File is too large for `{host}`")
+    if response.status >= 400:
+        raise UploadError(f"`{host}` refused the upload ({response.status})")
+
+
+async def with_retries(call: Callable[[], Awaitable[T]], retries: int, base_delay: float = 0.5) -> T:
+    for attempt in range(retries + 1):
+        try:
+            return await call()
+        except (TransientUploadError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+            if attempt == retries:
+                if isinstance(e, UploadError):
+                    raise
+                raise TransientUploadError(f"Couldn't reach the upload host: {e.__class__.__name__}") from e
+
+            delay = base_delay * 2 ** attempt
+            await asyncio.sleep(delay + random.uniform(0, delay))
+
+
+class UploadBackend(ABC):
+    name: str
+    size_limit: int | None = None
+    # Takes output while it's still being encoded, its size isn't known until the end.
+    streaming: bool = False
+
+    @abstractmethod
+    async def upload(self, file_path: str) -> str:
+        pass
+
+    async def upload_stream(self, chunks: AsyncIterator[bytes], filename: str) -> str:
+        raise UploadError(f"`{self.name}` can't take streamed uploads")
+
+    def check_size(self, file_path: str) -> None:
+        if self.size_limit and os.path.getsize(file_path) > self.size_limit:
+            raise UploadError(f"File is too large for `{self.name}`")
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+class TmpFilesBackend(UploadBackend):
+    name = "tmpfiles.org"
+
+    def __init__(self, manager: UploadManager, url: str, size_limit: int | None):
+        self.manager: UploadManager = manager
+        self.url: str = url
+        self.size_limit: int | None = size_limit
+
+    async def upload(self, file_path: str) -> str:
+        self.check_size(file_path)
+        with open(file_path, 'rb') as f:
+            # aiohttp streams the file object in chunks instead of reading it into memory.
+            data = aiohttp.FormData()
+            data.add_field('file', f, filename=os.path.basename(file_path))
+
+            async with self.manager.session.post(self.url, data=data) as response:
+                raise_for_status(response, self.name)
+                result = await response.json(content_type=None)
+                try:
+                    if result['status'] != 'success':
+                        raise UploadError("Couldn't upload to `tmpfiles.org`")
+                    return result['data']['url']
+                except (KeyError, TypeError):
+                    raise UploadError("Weird response from tmpfiles.org")
+
+
+class S3Backend(UploadBackend):
+    name = "S3"
+    streaming = True
+
+    def __init__(
+            self, manager: UploadManager, endpoint: str, bucket: str, access_key: str, secret_key: str, region: str,
+            public_url: str | None, url_expiry: int, part_size: int, multipart_threshold: int, part_concurrency: int,
+            size_limit: int | None
+    ):
+        self.manager: UploadManager = manager
+        self.endpoint: str = endpoint.rstrip("/")
+        self.bucket: str = bucket
+        self.access_key: str = access_key
+        self.secret_key: str = secret_key
+        self.region: str = region
+        self.public_url: str | None = public_url.rstrip("/") if public_url else None
+        self.url_expiry: int = url_expiry
+        self.part_size: int = part_size
+        self.multipart_threshold: int = multipart_threshold
+        self.part_concurrency: int = part_concurrency
+        self.size_limit: int | None = size_limit
+
+    @classmethod
+    def from_environ(cls, manager: UploadManager) -> S3Backend:
+        try:
+            endpoint = os.environ["S3_ENDPOINT"]
+            bucket = os.environ["S3_BUCKET"]
+            access_key = os.environ["S3_ACCESS_KEY"]
+            secret_key = os.environ["S3_SECRET_KEY"]
+        except KeyError as e:
+            raise RuntimeError(f"The S3 upload backend needs {e.args[0]} to be set.") from None
+
+        return cls(
+            manager,
+            endpoint=endpoint,
+            bucket=bucket,
+            access_key=access_key,
+            secret_key=secret_key,
+            region=os.environ.get("S3_REGION", "us-east-1"),
+            public_url=os.environ.get("S3_PUBLIC_URL"),
+            url_expiry=int(os.environ.get("S3_URL_EXPIRY", "86400")),
+            part_size=int(os.environ.get("S3_PART_SIZE_MB", "16")) * MEGABYTE,
+            multipart_threshold=int(os.environ.get("S3_MULTIPART_THRESHOLD_MB", "64")) * MEGABYTE,
+            part_concurrency=int(os.environ.get("S3_PART_CONCURRENCY", "4")),
+            size_limit=int(os.environ.get("S3_MAX_SIZE_MB", "0")) * MEGABYTE or None,
+        )
+
+    @property
+    def origin(self) -> str:
+        return str(yarl.URL(self.endpoint).origin())
+
+    @staticmethod
+    def _hmac(key: bytes, message: str) -> bytes:
+        return hmac.new(key, message.encode(), hashlib.sha256).digest()
+
+    def _signature(self, string_to_sign: str, date: str) -> str:
+        key = self._hmac(f"AWS4{self.secret_key}".encode(), date)
+        for part in (self.region, "s3", "aws4_request"):
+            key = self._hmac(key, part)
+        return hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+    def _object_path(self, key: str) -> str:
+        # Path-style addressing, keeping any path prefix of the endpoint in what gets signed.
+        prefix = yarl.URL(self.endpoint).raw_path.rstrip("/")
+        return f"{prefix}/" + urllib.parse.quote(f"{self.bucket}/{key}", safe="/-_.~")
+
+    @staticmethod
+    def _query_string(params: dict[str, str]) -> str:
+        return "&".join(
+            f"{urllib.parse.quote(k, safe='-_.~')}={urllib.parse.quote(v, safe='-_.~')}"
+            for k, v in sorted(params.items())
+        )
+
+    def _string_to_sign(self, method: str, path: str, query: str, headers: dict[str, str], payload_hash: str, now: datetime.datetime) -> str:
+        signed_headers = ";".join(sorted(headers))
+        canonical_headers = "".join(f"{name}:{headers[name].strip()}\n" for name in sorted(headers))
+        canonical_request = "\n".join([method, path, query, canonical_headers, signed_headers, payload_hash])
+        scope = f"{now:%Y%m%d}/{self.region}/s3/aws4_request"
+        return "\n".join([
+            "AWS4-HMAC-SHA256", f"{now:%Y%m%dT%H%M%SZ}", scope, hashlib.sha256(canonical_request.encode()).hexdigest()
+        ])
+
+    def _signed_request(self, method: str, key: str, params: dict[str, str]) -> tuple[yarl.URL, dict[str, str]]:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        path = self._object_path(key)
+        query = self._query_string(params)
+        host = yarl.URL(self.endpoint).raw_authority
+        headers = {
+            "host": host,
+            "x-amz-content-sha256": "UNSIGNED-PAYLOAD",
+            "x-amz-date": f"{now:%Y%m%dT%H%M%SZ}",
+        }
+        signature = self._signature(self._string_to_sign(method, path, query, headers, "UNSIGNED-PAYLOAD", now), f"{now:%Y%m%d}")
+        headers["authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{now:%Y%m%d}/{self.region}/s3/aws4_request, "
+            f"SignedHeaders={';'.join(sorted(h for h in headers if h != 'authorization'))}, Signature={signature}"
+        )
+        del headers["host"]
+        url = yarl.URL(f"{self.origin}{path}" + (f"?{query}" if query else ""), encoded=True)
+        return url, headers
+
+    def presigned_url(self, key: str) -> str:
+        if self.public_url:
+            return f"{self.public_url}/{urllib.parse.quote(key, safe='/-_.~')}"
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        path = self._object_path(key)
+        params = {
+            "X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+            "X-Amz-Credential": f"{self.access_key}/{now:%Y%m%d}/{self.region}/s3/aws4_request",
+            "X-Amz-Date": f"{now:%Y%m%dT%H%M%SZ}",
+            "X-Amz-Expires": str(self.url_expiry),
+            "X-Amz-SignedHeaders": "host",
+        }
+        query = self._query_string(params)
+        headers = {"host": yarl.URL(self.endpoint).raw_authority}
+        signature = self._signature(self._string_to_sign("GET", path, query, headers, "UNSIGNED-PAYLOAD", now), f"{now:%Y%m%d}")
+        return f"{self.origin}{path}?{query}&X-Amz-Signature={signature}"
+
+    async def _request(self, method: str, key: str, params: dict[str, str], data: bytes | None = None) -> tuple[str, Mapping[str, str]]:
+        async def send() -> tuple[str, Mapping[str, str]]:
+            url, headers = self._signed_request(method, key, params)
+            async with self.manager.session.request(method, url, headers=headers, data=data) as response:
+                raise_for_status(response, self.name)
+                return await response.text(), response.headers.copy()
+
+        return await with_retries(send, self.manager.retries)
+
+    @staticmethod
+    def _read_part(file_path: str, offset: int, size: int) -> bytes:
+        with open(file_path, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    async def upload(self, file_path: str) -> str:
+        self.check_size(file_path)
+        key = f"{uuid.uuid4().hex}/{os.path.basename(file_path)}"
+        size = os.path.getsize(file_path)
+        if size <= self.multipart_threshold:
+            data = await asyncio.to_thread(self._read_part, file_path, 0, size)
+            await self._request("PUT", key, {}, data)
+        else:
+            await self._upload_multipart(file_path, key, size)
+        return self.presigned_url(key)
+
+    async def _upload_multipart(self, file_path: str, key: str, size: int) -> None:
+        body, _ = await self._request("POST", key, {"uploads": ""})
+        upload_id = self._find(body, "UploadId")
+        semaphore = asyncio.Semaphore(self.part_concurrency)
+
+        async def upload_part(number: int, offset: int) -> tuple[int, str]:
+            async with semaphore:
+                data = await asyncio.to_thread(self._read_part, file_path, offset, self.part_size)
+                _, headers = await self._request("PUT", key, {"partNumber": str(number), "uploadId": upload_id}, data)
+                return number, headers.get("ETag", "")
+
+        try:
+            parts = await asyncio.gather(*(
+                upload_part(number, offset)
+                for number, offset in enumerate(range(0, size, self.part_size), start=1)
+            ))
+            await self._complete(key, upload_id, parts)
+        except BaseException:
+            # Abandoned multipart uploads keep their parts stored (and billed) until aborted.
+            await asyncio.shield(self._abort(key, upload_id))
+            raise
+
+    async def upload_stream(self, chunks: AsyncIterator[bytes], filename: str) -> str:
+        key = f"{uuid.uuid4().hex}/{filename}"
+        body, _ = await self._request("POST", key, {"uploads": ""})
+        upload_id = self._find(body, "UploadId")
+        # Held while a part is in flight, reading more output waits for a free slot instead of buffering it all.
+        semaphore = asyncio.Semaphore(self.part_concurrency)
+        uploads: list[asyncio.Task[tuple[int, str]]] = []
+
+        async def upload_part(number: int, data: bytes) -> tuple[int, str]:
+            try:
+                _, headers = await self._request("PUT", key, {"partNumber": str(number), "uploadId": upload_id}, data)
+                return number, headers.get("ETag", "")
+            finally:
+                semaphore.release()
+
+        async def send(data: bytes) -> None:
+            await semaphore.acquire()
+            for task in uploads:
+                if task.done() and task.exception() is not None:
+                    raise task.exception()
+            uploads.append(asyncio.create_task(upload_part(len(uploads) + 1, data)))
+
+        try:
+            buffer = bytearray()
+            size = 0
+            async for chunk in chunks:
+                buffer += chunk
+                size += len(chunk)
+                if self.size_limit and size > self.size_limit:
+                    raise UploadError(f"File is too large for `{self.name}`")
+                if len(buffer) >= self.part_size:
+                    await send(bytes(buffer))
+                    buffer.clear()
+            # Only the last part may be smaller than the minimum part size.
+            if buffer or not uploads:
+                await send(bytes(buffer))
+            await self._complete(key, upload_id, await asyncio.gather(*uploads))
+        except BaseException:
+            for task in uploads:
+                task.cancel()
+            await asyncio.gather(*uploads, return_exceptions=True)
+            await asyncio.shield(self._abort(key, upload_id))
+            raise
+        return self.presigned_url(key)
+
+    async def _complete(self, key: str, upload_id: str, parts: list[tuple[int, str]]) -> None:
+        completion = "".join(
+            f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>" for number, etag in parts
+        )
+        await self._request(
+            "POST", key, {"uploadId": upload_id},
+            f"<CompleteMultipartUpload>{completion}</CompleteMultipartUpload>".encode()
+        )
+
+    async def _abort(self, key: str, upload_id: str) -> None:
+        try:
+            await self._request("DELETE", key, {"uploadId": upload_id})
+        except Exception:
+            logging.warning(f"Couldn't abort multipart upload {upload_id} of {key}.")
+
+    @staticmethod
+    def _find(body: str, tag: str) -> str:
+        for element in ElementTree.fromstring(body).iter():
+            if element.tag.rpartition("}")[2] == tag:
+                return element.text or ""
+        raise UploadError(f"Weird response from S3, missing {tag}")
+
+
+class DiscordAttachmentBackend(UploadBackend):
+    name = "Discord"
+
+    def __init__(self, bot: StellaVideoBot, channel_id: int):
+        self.bot: StellaVideoBot = bot
+        self.channel_id: int = channel_id
+
+    async def upload(self, file_path: str) -> str:
+        channel = self.bot.get_channel(self.channel_id) or await self.bot.fetch_channel(self.channel_id)
+        limit = channel.guild.filesize_limit if getattr(channel, "guild", None) else discord.utils.DEFAULT_FILE_SIZE_LIMIT_BYTES
+        if os.path.getsize(file_path) > limit:
+            raise UploadError("File is too large to be uploaded to Discord")
+
+        try:
+            message = await channel.send(file=discord.File(file_path, filename=os.path.basename(file_path)))
+        except discord.HTTPException as e:
+            if e.status >= 500:
+                raise TransientUploadError("Discord is unavailable right now") from e
+            raise UploadError(f"Discord refused the upload ({e.status})") from e
+        return message.attachments[0].url
+
+
+class LocalBackend(UploadBackend):
+    name = "local file server"
+
+    def __init__(self, server: FileServer):
+        self.server: FileServer = server
+
+    async def upload(self, file_path: str) -> str:
+        try:
+            return await asyncio.to_thread(self.server.publish, file_path)
+        except OSError as e:
+            raise UploadError(f"Couldn't publish the file: {e.strerror}") from e
+
+    async def start(self) -> None:
+        await self.server.start()
+
+    async def close(self) -> None:
+        await self.server.close()
+
+
+class UploadManager:
+    def __init__(self, bot: StellaVideoBot | None):
+        self.bot: StellaVideoBot | None = bot
+        self.mode: str = os.environ.get("UPLOAD_MODE", "failover")
+        self.retries: int = int(os.environ.get("UPLOAD_RETRIES", "2"))
+        self.connections: int = int(os.environ.get("UPLOAD_CONNECTIONS", "16"))
+        self._session: aiohttp.ClientSession | None = None
+        self.backends: list[UploadBackend] = [
+            self.create_backend(name.strip())
+            for name in os.environ.get("UPLOAD_BACKENDS", "tmpfiles").split(",") if name.strip()
+        ]
+        if self.mode not in ("failover", "race"):
+            raise RuntimeError(f"Unknown UPLOAD_MODE {self.mode!r}, expected 'failover' or 'race'.")
+        self.stream_presets: set[str] = {
+            name.strip() for name in os.environ.get("STREAM_PRESETS", "").split(",") if name.strip()
+        }
+        if not self.stream_presets <= {"low", "medium"}:
+            raise RuntimeError(f"STREAM_PRESETS only takes 'low' and 'medium', got {os.environ['STREAM_PRESETS']!r}.")
+
+    def create_backend(self, name: str) -> UploadBackend:
+        if name == "tmpfiles":
+            return TmpFilesBackend(
+                self,
+                url=os.environ.get("UPLOAD_URL", "https://tmpfiles.org/api/v1/upload"),
+                size_limit=int(os.environ.get("UPLOAD_MAX_SIZE_MB", "100")) * MEGABYTE or None,
+            )
+        elif name == "s3":
+            return S3Backend.from_environ(self)
+        elif name == "discord":
+            if self.bot is None:
+                raise RuntimeError("The discord upload backend only works in the bot process, not in workers.")
+            return DiscordAttachmentBackend(self.bot, int(os.environ["DISCORD_UPLOAD_CHANNEL_ID"]))
+        elif name == "local":
+            return LocalBackend(FileServer.from_environ())
+        else:
+            raise RuntimeError(f"Unknown upload backend {name!r}, expected 'tmpfiles', 's3', 'discord' or 'local'.")
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connections,
+                limit_per_host=self.connections,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+            )
+            # No total timeout, large files take as long as they take, but a stalled socket doesn't.
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=120)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    @property
+    def size_limit(self) -> int | None:
+        limits = [backend.size_limit for backend in self.backends if backend.size_limit]
+        return min(limits) if limits else None
+
+    @property
+    def instant(self) -> bool:
+        return bool(self.backends) and all(isinstance(backend, LocalBackend) for backend in self.backends)
+
+    def streams(self, preset: CompressionType) -> bool:
+        # Only when the first backend in order takes streams, the others get the file if it fails.
+        return preset.name in self.stream_presets and bool(self.backends) and self.backends[0].streaming
+
+    async def upload_stream(self, chunks: AsyncIterator[bytes], filename: str) -> str:
+        return await self.backends[0].upload_stream(chunks, filename)
+
+    async def upload_with(self, backend: UploadBackend, file_path: str) -> str:
+        return await with_retries(lambda: backend.upload(file_path), self.retries)
+
+    async def upload(self, file_path: str) -> str:
+        if not self.backends:
+            raise UploadError("No upload backend is configured")
+
+        if self.mode == "race" and len(self.backends) > 1:
+            return await self._race(file_path)
+
+        error: UploadError | None = None
+        for backend in self.backends:
+            try:
+                return await self.upload_with(backend, file_path)
+            except UploadError as e:
+                logging.warning(f"Upload to {backend.name} failed: {e}")
+                error = e
+        raise error
+
+    async def _race(self, file_path: str) -> str:
+        tasks = [asyncio.create_task(self.upload_with(backend, file_path)) for backend in self.backends]
+        error: UploadError | None = None
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    return await next_done
+                except UploadError as e:
+                    error = e
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def start(self) -> None:
+        for backend in self.backends:
+            await backend.start()
+
+    async def close(self) -> None:
+        for backend in self.backends:
+            await backend.close()
+        if self._session is not None:
+            await self._session.close()
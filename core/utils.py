@@ -1,6 +1,25 @@
 import contextvars
+import os
 import re
 
 FIND_CAMEL = re.compile(r'(?<!^)(?=[A-Z])')
 
 url_context = contextvars.ContextVar("url")
+
+
+def process_uptime() -> float | None:
+    # Counted from when the process started, so interpreter startup and imports are included.
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rpartition(")")[2].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+def format_seconds(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes:02}:{seconds:02}"
@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import logging
+import os
+import socket
+import tempfile
+
+from aiohttp import web
+
+from core.broker import JobBroker, JobSpec
+from core.cache import ResultCache
+from core.disk import DiskSpace
+from core.errors import DisplayError, ErrorProcessing
+from core.executor import DownloadExecutor, create_executor
+from core.jobs import DownloadJob, JobResult, error_event
+from core.journal import JobJournal
+from core.metadata import InfoCache
+from core.metrics import queue_depth, serve_metrics
+from core.models import URLParsed, YouTubeDownloader, FileType, CompressionType, Progress
+from core.scheduler import JobScheduler
+from core.uploads import UploadManager
+from core.utils import url_context
+
+
+class ProgressPublisher:
+    # Same idea as the frontend's edit governor, only the newest progress is published per interval.
+    def __init__(self, broker: JobBroker, job_id: str, interval: float):
+        self.broker: JobBroker = broker
+        self.job_id: str = job_id
+        self.interval: float = interval
+        self.latest: Progress | None = None
+        self.task: asyncio.Task[None] | None = None
+
+    def __call__(self, progress: Progress) -> None:
+        self.latest = progress
+        if self.task is None:
+            self.task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.interval)
+        self.task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.warning(f"Couldn't publish progress of job {self.job_id}: {e}")
+
+    async def flush(self) -> None:
+        progress, self.latest = self.latest, None
+        if progress is not None:
+            await self.broker.publish(self.job_id, {"type": "progress", "progress": dataclasses.asdict(progress)})
+
+    def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+
+
+class JobWorker:
+    # Headless, runs jobs from the queue with everything DownloadJob expects from the bot.
+    def __init__(self, broker: JobBroker):
+        self.broker: JobBroker = broker
+        self.name: str = f"{socket.gethostname()}-{os.getpid()}"
+        self.max_jobs: int = int(os.environ.get("WORKER_JOBS", "4"))
+        self.progress_interval: float = float(os.environ.get("WORKER_PROGRESS_INTERVAL", "0.5"))
+        self.result_grace: float = float(os.environ.get("WORKER_RESULT_GRACE", "120"))
+        self.executor: DownloadExecutor = create_executor()
+        self.scheduler: JobScheduler = JobScheduler.from_environ()
+        self.result_cache: ResultCache = ResultCache.from_environ()
+        self.info_cache: InfoCache = InfoCache.from_environ()
+        self.uploads: UploadManager = UploadManager(None)
+        # The queue keeps the jobs this worker hasn't claimed yet, claimed ones aren't resumed.
+        self.journal: JobJournal | None = None
+        self.disk: DiskSpace = DiskSpace.from_environ(tempfile.gettempdir(), self.result_cache)
+        self.metrics_runner: web.AppRunner | None = None
+        queue_depth.set_collector(lambda: {
+            **{(name,): stage.depth for name, stage in self.scheduler.stages.items()}, ("disk",): self.disk.depth
+        })
+
+    async def upload_file(self, file_path: str) -> str:
+        return await self.uploads.upload(file_path)
+
+    def restore(self, spec: JobSpec) -> URLParsed:
+        parser = URLParsed.downloader_named(spec.downloader)
+        if parser is None:
+            raise ErrorProcessing(f"This worker doesn't know how to download from {spec.downloader}.")
+
+        link = parser.restore(spec.url, spec.ident)
+        link.size_limit = spec.size_limit
+        return link
+
+    async def watch_cancel(self, job_id: str, job: DownloadJob) -> None:
+        while not job.task.done():
+            await asyncio.sleep(1)
+            if await self.broker.cancelled(job_id):
+                logging.info(f"Job {job_id} was cancelled by the frontend.")
+                job.cancel()
+                return
+
+    async def handle(self, spec: JobSpec) -> None:
+        link = self.restore(spec)
+        url_context.set(link)
+        publisher = ProgressPublisher(self.broker, spec.id, self.progress_interval)
+        link.add_listener(publisher)
+        job = DownloadJob(
+            self, spec.id, link, FileType[spec.file_type], CompressionType[spec.preset], spec.guild_id, spec.user_id
+        )
+        # Probed again here rather than sent along, some sites bind their media URLs to the prober's address.
+        link.info = await self.info_cache.get(link, self.executor)
+        job.start()
+        watcher = asyncio.create_task(self.watch_cancel(spec.id, job))
+        result: JobResult | None = None
+        try:
+            result = await job.task
+        finally:
+            watcher.cancel()
+            publisher.close()
+            if result is not None and result.url is None:
+                # The frontend attaches the file itself when it shares this machine, give it time to.
+                asyncio.get_running_loop().call_later(self.result_grace, job.cleanup)
+            else:
+                job.cleanup()
+
+        await publisher.flush()
+        await self.broker.publish(spec.id, {
+            "type": "result",
+            "file": result.file,
+            "url": result.url,
+            "upload_error": str(result.upload_error) if result.upload_error else None,
+        })
+
+    async def run_job(self, spec: JobSpec) -> None:
+        logging.info(f"[{self.name}] Running job {spec.id} for {spec.url}")
+        try:
+            await self.handle(spec)
+        except asyncio.CancelledError:
+            if not await self.broker.cancelled(spec.id):
+                raise
+        except Exception as e:
+            if not isinstance(e, DisplayError):
+                logging.exception(f"Job {spec.id} failed.")
+            await self.broker.publish(spec.id, error_event(e))
+
+    async def run(self) -> None:
+        metrics_port = os.environ.get("METRICS_PORT")
+        if metrics_port:
+            self.metrics_runner = await serve_metrics(os.environ.get("METRICS_HOST", "127.0.0.1"), int(metrics_port))
+        await self.uploads.start()
+        warm_up = asyncio.create_task(self.executor.warm(YouTubeDownloader.warm_profiles()))
+
+        semaphore = asyncio.Semaphore(self.max_jobs)
+        tasks: set[asyncio.Task[None]] = set()
+
+        def finished(task: asyncio.Task[None]) -> None:
+            tasks.discard(task)
+            semaphore.release()
+
+        logging.info(f"[{self.name}] Waiting for jobs, up to {self.max_jobs} at once.")
+        try:
+            while True:
+                await semaphore.acquire()
+                try:
+                    spec = await self.broker.claim(timeout=5)
+                except (OSError, ConnectionError) as e:
+                    logging.warning(f"Couldn't reach the job queue: {e}")
+                    semaphore.release()
+                    await asyncio.sleep(5)
+                    continue
+
+                if spec is None:
+                    semaphore.release()
+                    continue
+
+                task = asyncio.create_task(self.run_job(spec))
+                tasks.add(task)
+                task.add_done_callback(finished)
+        finally:
+            warm_up.cancel()
+            for task in list(tasks):
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.close()
+
+    async def close(self) -> None:
+        await self.uploads.close()
+        await self.broker.close()
+        self.executor.close()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
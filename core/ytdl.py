@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import contextlib
+import dataclasses
+import json
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Callable, Iterator
+
+if TYPE_CHECKING:
+    import yt_dlp
+
+# Set per download on a pooled instance, everything else in the options makes up its profile.
+PER_JOB_OPTIONS = ('outtmpl', 'progress_hooks')
+
+
+def profile_key(ydl_opts: dict[str, Any]) -> str:
+    profile = {key: value for key, value in ydl_opts.items() if key not in PER_JOB_OPTIONS}
+    return json.dumps(profile, sort_keys=True, default=str)
+
+
+@dataclasses.dataclass
+class _Pooled:
+    ydl: yt_dlp.YoutubeDL
+    hooks: list[Callable[[dict[str, Any]], None]] = dataclasses.field(default_factory=list)
+
+    def relay(self, d: dict[str, Any]) -> None:
+        for hook in self.hooks:
+            hook(d)
+
+
+class YoutubeDLPool:
+    # Building a YoutubeDL loads every extractor class, reusing one also keeps its HTTP connections alive.
+    def __init__(self, max_idle: int):
+        self.max_idle: int = max_idle
+        self.idle: dict[str, list[_Pooled]] = {}
+        self.lock: threading.Lock = threading.Lock()
+
+    def _create(self, ydl_opts: dict[str, Any]) -> _Pooled:
+        import yt_dlp
+
+        ydl = yt_dlp.YoutubeDL({key: value for key, value in ydl_opts.items() if key not in PER_JOB_OPTIONS})
+        pooled = _Pooled(ydl)
+        ydl.add_progress_hook(pooled.relay)
+        return pooled
+
+    def _take(self, key: str) -> _Pooled | None:
+        with self.lock:
+            idle = self.idle.get(key)
+            return idle.pop() if idle else None
+
+    def _give(self, key: str, pooled: _Pooled) -> bool:
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(pooled)
+                return True
+        return False
+
+    @contextlib.contextmanager
+    def checkout(self, ydl_opts: dict[str, Any]) -> Iterator[yt_dlp.YoutubeDL]:
+        key = profile_key(ydl_opts)
+        pooled = self._take(key) or self._create(ydl_opts)
+        if 'outtmpl' in ydl_opts:
+            pooled.ydl.params['outtmpl']['default'] = ydl_opts['outtmpl']
+        pooled.hooks = list(ydl_opts.get('progress_hooks', []))
+        try:
+            yield pooled.ydl
+        finally:
+            pooled.hooks = []
+            if not self._give(key, pooled):
+                pooled.ydl.close()
+
+    def warm(self, profiles: list[dict[str, Any]]) -> int:
+        created = 0
+        for ydl_opts in profiles:
+            key = profile_key(ydl_opts)
+            with self.lock:
+                if self.idle.get(key):
+                    continue
+            if self._give(key, self._create(ydl_opts)):
+                created += 1
+        return created
+
+    def close(self) -> None:
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for instances in idle.values():
+            for pooled in instances:
+                pooled.ydl.close()
+
+
+pool = YoutubeDLPool(int(os.environ.get("YTDL_POOL_IDLE", "2")))
@@ -1,7 +1,12 @@
 import asyncio
+import contextlib
 import datetime
+import functools
 import itertools
+import logging
+import os
 import tempfile
+from typing import Any, AsyncIterator, Callable
 
 import discord
 import humanize
@@ -10,35 +15,93 @@ from discord.ext import commands
 from dotenv import load_dotenv
 
 from core.client import StellaVideoBot
-from core.errors import UploadError, SomethingWentWrong, DisplayError, UserErrorUsage, TimeoutResponding
-from core.models import URLParsed, FileType, Progress, ViewFormatType, CompressionType, ViewCompressionType
+from core.disk import peak_working_set
+from core.errors import UploadError, SomethingWentWrong, DisplayError, UserErrorUsage, TimeoutResponding, ErrorProcessing
+from core.jobs import DownloadJob, RemoteJob
+from core.journal import JournalEntry
+from core.metrics import stage_timer
+from core.playlist import PlaylistItem, iter_items, run_pipeline
+from core.preview import make_preview, wants_preview, SECONDS as PREVIEW_SECONDS
+from core.models import (
+    URLParsed, FileType, Progress, ViewFormatType, CompressionType, ViewCompressionType, ViewCancel, DISPATCHER
+)
 from core.types import Context, Interaction
-from core.utils import FIND_CAMEL, url_context
+from core.utils import FIND_CAMEL, url_context, format_seconds
 
 load_dotenv()
 bot = StellaVideoBot()
 
 
-async def download_flow(sender: Context, link: URLParsed, file_type: FileType, compression: CompressionType):
-    url_context.set(link)
-    color = 0xffcccb
-    embed = discord.Embed(
-        title=link.type,
-        description=f"**Link:** {link.url}\nFetching metadata...\n"
-                    f"**Type:** {file_type.name}\n"
-                    f"**Preset:**: {compression}",
-        color=color
-    )
-    msg = await sender.send(embed=embed, ephemeral=True)
+def discord_size_limit(sender: Context) -> int:
+    # Only newer discord.py versions report an interaction's own limit, older ones fall back to the guild's.
+    limit = getattr(sender.interaction, "filesize_limit", None)
+    if limit is not None:
+        return limit
+    if sender.guild is not None:
+        return sender.guild.filesize_limit
+    return discord.utils.DEFAULT_FILE_SIZE_LIMIT_BYTES
+
 
-    last_update: datetime.datetime | None = None
+def reply_handle(sender: Context, msg: discord.Message) -> dict[str, Any]:
+    # Enough to find the progress message again after a restart, interaction tokens last 15 minutes.
+    if sender.interaction is not None:
+        return {
+            "application_id": sender.interaction.application_id,
+            "token": sender.interaction.token,
+            "message_id": msg.id,
+            "user_id": sender.author.id,
+        }
+    return {"channel_id": msg.channel.id, "message_id": msg.id, "user_id": sender.author.id}
+
+
+async def send_preview(
+        msg: discord.Message | discord.WebhookMessage, link: URLParsed, sender: Context, size_limit: int
+) -> None:
+    ticket = bot.scheduler.ticket(sender.guild.id if sender.guild else None, sender.author.id)
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            file = await make_preview(link.info.info, os.path.join(directory, "preview.mp4"), ticket)
+            if file is None or os.path.getsize(file) > size_limit:
+                return
+            await msg.edit(
+                content=f"Preview of the first {PREVIEW_SECONDS} seconds, the full file is on its way.",
+                attachments=[discord.File(file, filename="preview.mp4")]
+            )
+        except (ErrorProcessing, discord.HTTPException) as e:
+            # Only ever a head start, the full job carries on without it.
+            logging.info(f"No preview for {link.url}: {e}")
+
+
+async def follow_job(
+        msg: discord.Message | discord.WebhookMessage, job: DownloadJob | RemoteJob, file_type: FileType,
+        cancel_view: ViewCancel, reply: dict[str, Any], preview: asyncio.Future[None] | None = None
+) -> str | None:
+    color = 0xffcccb
     loading = itertools.cycle([".", "..", "..."])
-    async def listen(progress: Progress):
-        nonlocal last_update
-        if last_update is not None and (discord.utils.utcnow() - last_update) < datetime.timedelta(seconds=1):
+    async def render(progress: Progress):
+        if progress.type == "uploading":
+            embed_ = discord.Embed(title=f"Uploading `[{next(loading)}]`", description="Please be nice...", color=color)
+            await msg.edit(embed=embed_)
+            return
+
+        if progress.type == "queued":
+            waiting = "for disk space" if progress.stage == "disk" else f"to {progress.stage}"
+            desc = f"Position **{progress.current:.0f}** of {progress.total:.0f} waiting {waiting}."
+            embed_ = discord.Embed(title=f"Queued `[{next(loading)}]`", description=desc, color=color)
+            await msg.edit(embed=embed_)
+            return
+
+        if progress.type == "processing":
+            speed = f" at {progress.speed:.1f}x" if progress.speed else ""
+            if progress.total:
+                position = f"{format_seconds(progress.current)}/**{format_seconds(progress.total)}**"
+                desc = f"[{position}] ({progress.percent:.2%}) ETA {progress.eta or 'unknown'}{speed}"
+            else:
+                desc = f"Encoded {format_seconds(progress.current)}{speed}"
+            embed_ = discord.Embed(title=f"Processing `[{next(loading)}]`", description=desc, color=color)
+            await msg.edit(embed=embed_)
             return
 
-        last_update = discord.utils.utcnow()
         current = humanize.naturalsize(progress.current)
         total = humanize.naturalsize(progress.total)
         desc = f"[{current}/**{total}**] ({progress.percent:.2%}) ETA {progress.eta}"
@@ -46,69 +109,408 @@ async def download_flow(sender: Context, link: URLParsed, file_type: FileType, c
         embed_ = discord.Embed(title=f"{progress.type.capitalize()} `[{next(loading)}]`", description=desc, color=color)
         await msg.edit(embed=embed_)
 
-    link.add_listener(listen)
-    with tempfile.TemporaryDirectory() as tmp:
-        filename = f"{tmp}/file.{file_type}"
-        link.preset = compression
-        await link.download(filename, file_type)
-        embed = discord.Embed(title=f"Uploading `[{next(loading)}]`", description="Please be nice...", color=color)
+    # Only the newest progress is kept, the bot-wide governor decides when it is actually edited in.
+    channel = bot.edit_governor.channel(render)
+    job.link.add_listener(channel)
+    if bot.journal is not None:
+        bot.journal.attach(job.key, reply)
+    result_task = asyncio.ensure_future(job.wait())
+    try:
+        await asyncio.wait([result_task, asyncio.ensure_future(cancel_view.wait())], return_when=asyncio.FIRST_COMPLETED)
+        job.link.remove_listener(channel)
+        await channel.close()
+        # The full result takes the preview's place, a late preview mustn't land on top of it.
+        cleared: dict[str, Any] = {}
+        if preview is not None:
+            preview.cancel()
+            await asyncio.gather(preview, return_exceptions=True)
+            cleared = {"content": None, "attachments": []}
+        if cancel_view.cancelled:
+            # Releasing the last subscriber below cancels the job and kills its worker.
+            result_task.cancel()
+            embed = discord.Embed(title="Cancelled", description=f"Stopped downloading {job.link.url}.", color=color)
+            await msg.edit(embed=embed, view=None, **cleared)
+            return None
+
+        result = result_task.result()
         try:
-            await msg.edit(embed=embed)
-            try:
-                url = await bot.upload_file(filename)
-            except UploadError as e:
-                embed = discord.Embed(title=f"Uploading `[{next(loading)}]`", description=f"{e}, fallback to discord.", color=color)
-                await msg.edit(embed=embed)
+            if result.url is None:
+                embed = discord.Embed(title=f"Uploading `[{next(loading)}]`", description=f"{result.upload_error}, fallback to discord.", color=color)
+                await msg.edit(embed=embed, view=None)
                 await asyncio.sleep(1)
-                await msg.edit(content=None, attachments=[discord.File(filename, filename=f"file.{file_type}")], embed=None)
-            else:
-                embed = discord.Embed(title=f"Finished~", description=f"You can download it: \n{url}", color=color)
-                await msg.edit(embed=embed)
+                with stage_timer("discord_fallback"):
+                    await msg.edit(content=None, attachments=[discord.File(result.file, filename=file_type.filename(result.file))], embed=None)
+                return None
+
+            embed = discord.Embed(title=f"Finished~", description=f"You can download it: \n{result.url}", color=color)
+            await msg.edit(embed=embed, view=None, **cleared)
+            return result.url
         except discord.HTTPException as e:
             if e.status == 413:
                 raise UploadError("File is too large to be uploaded to Discord.")
 
             await msg.delete(delay=0)
+            return None
+    finally:
+        if preview is not None:
+            preview.cancel()
+        cancel_view.stop()
+        job.link.remove_listener(channel)
+        await channel.close()
+        if bot.journal is not None:
+            bot.journal.detach(job.key, reply)
+        bot.jobs.release(job)
+
+
+async def download_flow(sender: Context, link: URLParsed, file_type: FileType, compression: CompressionType) -> str | None:
+    url_context.set(link)
+    color = 0xffcccb
+    embed = discord.Embed(
+        title=link.type,
+        description=f"**Link:** {link.url}\nFetching metadata...\n"
+                    f"**Type:** {file_type.name}\n"
+                    f"**Preset:**: {compression}",
+        color=color
+    )
+    msg = await sender.send(embed=embed, ephemeral=True)
+
+    # The fit preset targets the upload host's limit, or Discord's own when no host limit is configured.
+    link.size_limit = bot.upload_size_limit or discord_size_limit(sender)
+    cached = bot.result_cache.get(link, file_type, compression)
+    if cached is not None and cached.cached_url is not None:
+        embed = discord.Embed(title=f"Finished~", description=f"You can download it: \n{cached.cached_url}", color=color)
+        await msg.edit(embed=embed)
+        return cached.cached_url
+
+    link.preset = compression
+    with stage_timer("metadata"):
+        link.info = await bot.info_cache.get(link, bot.executor)
+        estimate = await link.info.estimate(link.get_format(file_type))
+    duration = datetime.timedelta(seconds=int(link.info.duration)) if link.info.duration else "unknown"
+    embed.description = (
+        f"**Link:** {link.url}\n"
+        f"**Title:** {link.info.title}\n"
+        f"**Duration:** {duration}\n"
+        f"**Estimated size:** {humanize.naturalsize(estimate) if estimate else 'unknown'}\n"
+        f"**Type:** {file_type.name}\n"
+        f"**Preset:**: {compression}"
+    )
+    await msg.edit(embed=embed)
+    if bot.max_download_size and estimate and estimate > bot.max_download_size:
+        await msg.delete(delay=0)
+        raise UserErrorUsage(
+            f"This is around {humanize.naturalsize(estimate)}, "
+            f"over the {humanize.naturalsize(bot.max_download_size)} download limit."
+        )
+
+    try:
+        # Rejected now rather than after waiting in the queue, when it could never fit on the bot's disk.
+        bot.disk.check(peak_working_set(estimate, link.info.duration, file_type, compression))
+        if compression is CompressionType.fit and link.info.duration:
+            link.check_fits(link.info.duration, file_type)
+    except ErrorProcessing:
+        await msg.delete(delay=0)
+        raise
+
+    # Identical requests share a single running job, this one may only be subscribing to it.
+    guild_id = sender.guild.id if sender.guild else None
+    job = bot.jobs.acquire(link, file_type, compression, guild_id, sender.author.id)
+    # Only offered once there is a job for it to cancel.
+    cancel_view = ViewCancel(sender.author.id)
+    try:
+        await msg.edit(view=cancel_view)
+    except BaseException:
+        cancel_view.stop()
+        bot.jobs.release(job)
+        raise
+
+    preview = None
+    if wants_preview(file_type, compression):
+        preview = asyncio.ensure_future(send_preview(msg, link, sender, discord_size_limit(sender)))
+    try:
+        return await follow_job(msg, job, file_type, cancel_view, reply_handle(sender, msg), preview)
+    except Exception:
+        # The error is reported on its own, the progress message mustn't keep offering to cancel.
+        with contextlib.suppress(discord.HTTPException):
+            await msg.edit(view=None)
+        raise
+
+
+async def resumed_message(
+        reply: dict[str, Any], embed: discord.Embed, view: ViewCancel
+) -> discord.Message | discord.WebhookMessage:
+    try:
+        if "token" in reply:
+            webhook = discord.Webhook.partial(reply["application_id"], reply["token"], client=bot)
+            return await webhook.edit_message(reply["message_id"], embed=embed, view=view)
+        channel = bot.get_channel(reply["channel_id"]) or await bot.fetch_channel(reply["channel_id"])
+        return await channel.get_partial_message(reply["message_id"]).edit(embed=embed, view=view)
+    except discord.HTTPException:
+        # The interaction expired or the message is gone, a direct message still reaches the user.
+        user = bot.get_user(reply["user_id"]) or await bot.fetch_user(reply["user_id"])
+        return await user.send(embed=embed, view=view)
+
+
+async def resume_reply(
+        msg: discord.Message | discord.WebhookMessage, job: DownloadJob | RemoteJob, file_type: FileType,
+        cancel_view: ViewCancel, reply: dict[str, Any]
+) -> None:
+    try:
+        await follow_job(msg, job, file_type, cancel_view, reply)
+    except DisplayError as e:
+        title = FIND_CAMEL.sub(' ', e.__class__.__name__)
+        await msg.edit(embed=discord.Embed(color=discord.Color.red(), title=title, description=str(e)), view=None)
+
+
+@bot.event
+async def on_job_resume(entry: JournalEntry) -> None:
+    parser = URLParsed.downloader_named(entry.downloader)
+    if parser is None:
+        bot.journal.discard(entry.key)
+        return
+
+    link = parser.restore(entry.url, entry.ident)
+    link.size_limit = entry.size_limit
+    url_context.set(link)
+    embed = discord.Embed(
+        title=link.type, description=f"**Link:** {link.url}\nResuming after a restart...", color=0xffcccb
+    )
+    reached = []
+    for reply in list(entry.replies):
+        cancel_view = ViewCancel(reply["user_id"])
+        try:
+            msg = await resumed_message(reply, embed, cancel_view)
+        except discord.HTTPException as e:
+            logging.warning(f"Couldn't reach the user waiting on {link.url}: {e}")
+            bot.journal.detach(entry.key, reply)
+            continue
+        reached.append((msg, cancel_view, reply))
+
+    if not reached:
+        bot.journal.discard(entry.key)
+        return
+
+    # Every waiting message subscribes to the same job, its working directory carries on from the journaled stage.
+    file_type, compression = FileType[entry.file_type], CompressionType[entry.preset]
+    await asyncio.gather(*(
+        resume_reply(msg, bot.jobs.acquire(link, file_type, compression, entry.guild_id, entry.user_id), file_type, view, reply)
+        for msg, view, reply in reached
+    ))
+
+
+ITEM_STATUS = {
+    "waiting": "Waiting",
+    "queued": "Queued",
+    "downloading": "Downloading",
+    "processing": "Processing",
+    "uploading": "Uploading",
+    "finished": "Finished",
+    "failed": "Failed",
+}
+
+
+def describe_item(item: PlaylistItem) -> str:
+    title = (item.title or item.link.url)[:60]
+    status = ITEM_STATUS[item.status]
+    if item.status in ("downloading", "processing"):
+        status = f"{status} {item.percent:.0%}"
+    elif item.status == "finished" and item.url is not None:
+        status = f"[{status}]({item.url})"
+    elif item.status == "failed":
+        status = f"{status}: {item.error}"
+    return f"`{item.index}.` {title} - {status}"
+
+
+async def playlist_item(
+        sender: Context, item: PlaylistItem, file_type: FileType, compression: CompressionType,
+        size_limit: int, on_update: Callable[[], None]
+) -> None:
+    link = item.link
+    url_context.set(link)
+    link.size_limit = size_limit
+
+    def listener(progress: Progress) -> None:
+        item.status = progress.type
+        item.percent = progress.percent
+        on_update()
+
+    async def deliver(url: str | None, file: str | None) -> None:
+        name = discord.utils.escape_markdown(item.title or link.url)
+        if url is not None:
+            await sender.send(f"**{item.index}.** {name}\n{url}", ephemeral=True)
+        else:
+            await sender.send(f"**{item.index}.** {name}", file=discord.File(file, filename=file_type.filename(file)), ephemeral=True)
+        item.status, item.url = "finished", url
+        on_update()
+
+    try:
+        cached = bot.result_cache.get(link, file_type, compression)
+        if cached is not None and cached.cached_url is not None:
+            await deliver(cached.cached_url, None)
+            return
+
+        link.preset = compression
+        if link.info is None:
+            link.info = await bot.info_cache.get(link, bot.executor)
+        estimate = await link.info.estimate(link.get_format(file_type))
+        if bot.max_download_size and estimate and estimate > bot.max_download_size:
+            raise UserErrorUsage(f"Around {humanize.naturalsize(estimate)}, over the download limit.")
+        bot.disk.check(peak_working_set(estimate, link.info.duration, file_type, compression))
+        if compression is CompressionType.fit and link.info.duration:
+            link.check_fits(link.info.duration, file_type)
+
+        guild_id = sender.guild.id if sender.guild else None
+        job = bot.jobs.acquire(link, file_type, compression, guild_id, sender.author.id)
+        job.link.add_listener(listener)
+        try:
+            result = await job.wait()
+            # Delivered before releasing the job, the file goes away with the last subscriber.
+            await deliver(result.url, result.file)
+        finally:
+            job.link.remove_listener(listener)
+            bot.jobs.release(job)
+    except discord.HTTPException as e:
+        item.status, item.error = "failed", "Too large for Discord" if e.status == 413 else "Couldn't send it"
+        on_update()
+    except DisplayError as e:
+        item.status, item.error = "failed", str(e)
+        on_update()
+
+
+async def playlist_flow(sender: Context, link: URLParsed, file_type: FileType, compression: CompressionType) -> None:
+    url_context.set(link)
+    color = 0xffcccb
+    header = (
+        f"**Link:** {link.url}\n"
+        f"**Type:** {file_type.name}\n"
+        f"**Preset:**: {compression}\n"
+    )
+    cancel_view = ViewCancel(sender.author.id)
+    embed = discord.Embed(title=f"{link.type} playlist", description=f"{header}Listing entries...", color=color)
+    msg = await sender.send(embed=embed, ephemeral=True, view=cancel_view)
+
+    items: list[PlaylistItem] = []
+    loading = itertools.cycle([".", "..", "..."])
+
+    def build_embed(title: str) -> discord.Embed:
+        description = header + "\n".join(describe_item(item) for item in items)
+        return discord.Embed(title=title, description=description[:4096], color=color)
+
+    async def render(_progress: Progress) -> None:
+        await msg.edit(embed=build_embed(f"Playlist `[{next(loading)}]`"))
+
+    # Every item pushes into the same channel, the governor turns them into at most one edit per interval.
+    channel = bot.edit_governor.channel(render)
+    update = functools.partial(channel, Progress(
+        type="downloading", filename=None, percent=0, total=0, current=0, speed=None, eta=None
+    ))
+    size_limit = bot.upload_size_limit or discord_size_limit(sender)
+
+    async def listed() -> AsyncIterator[PlaylistItem]:
+        entries = iter_items(link, bot.executor, bot.max_playlist_items, bot.info_cache.ttl)
+        async with contextlib.aclosing(entries):
+            async for item in entries:
+                items.append(item)
+                update()
+                yield item
+
+    pipeline = asyncio.ensure_future(run_pipeline(
+        listed(),
+        lambda item: playlist_item(sender, item, file_type, compression, size_limit, update),
+        bot.playlist_concurrency
+    ))
+    try:
+        await asyncio.wait([pipeline, asyncio.ensure_future(cancel_view.wait())], return_when=asyncio.FIRST_COMPLETED)
+        await channel.close()
+        if cancel_view.cancelled:
+            pipeline.cancel()
+            await asyncio.gather(pipeline, return_exceptions=True)
+            await msg.edit(embed=build_embed("Cancelled"), view=None)
+            return
+
+        pipeline.result()
+        finished = sum(1 for item in items if item.status == "finished")
+        await msg.edit(embed=build_embed(f"Finished {finished} of {len(items)}~"), view=None)
+    finally:
+        cancel_view.stop()
+        pipeline.cancel()
+        await channel.close()
 
 
 @bot.hybrid_command(help="Download videos from popular platform via a URL.")
 @app_commands.describe(
     link="Shared video link to be downloaded. Supports YouTube, TikTok, Instagram, Twitter (X), twitch, bilibili.",
-    file_type="Supported Type (video, audio)"
+    file_type="Supported Type (video, audio)",
+    playlist="Download every video of a playlist, multi-video post or multi-part upload."
 )
 @app_commands.user_install()
 @app_commands.allowed_contexts(guilds=True, dms=True, private_channels=True)
-async def download(ctx: Context, link: URLParsed, file_type: FileType, compression: CompressionType = CompressionType.medium) -> None:
-    await download_flow(ctx, link, file_type, compression)
+async def download(
+        ctx: Context, link: URLParsed, file_type: FileType, compression: CompressionType = CompressionType.medium,
+        playlist: bool = False
+) -> None:
+    if playlist or link.is_playlist:
+        await playlist_flow(ctx, link, file_type, compression)
+    else:
+        await download_flow(ctx, link, file_type, compression)
+
+
+def message_text(message: discord.Message) -> str:
+    # Links hide in the content and in the embeds' own fields, not in their serialized dicts.
+    parts = [message.content]
+    for embed in message.embeds:
+        parts.extend([embed.url, embed.title, embed.description, embed.video.url, embed.author.url])
+        parts.extend(field.value for field in embed.fields)
+    return "\n".join(part for part in parts if part)
+
+
+async def batch_download(ctx: Context, links: list[URLParsed], file_type: FileType, preset: CompressionType) -> None:
+    # Each link runs its own flow with its own progress message, the summary collects them once all are done.
+    results = await asyncio.gather(
+        *(download_flow(ctx, link, file_type, preset) for link in links), return_exceptions=True
+    )
+    lines = []
+    for link, result in zip(links, results):
+        if isinstance(result, DisplayError):
+            lines.append(f"- {link.url}\n  **{FIND_CAMEL.sub(' ', result.__class__.__name__)}:** {result}")
+        elif isinstance(result, BaseException):
+            logging.error(f"Batch download of {link.url} failed", exc_info=result)
+            lines.append(f"- {link.url}\n  **Something went wrong**")
+        else:
+            lines.append(f"- {link.url}\n  {result or 'Sent as an attachment or cancelled.'}")
+
+    finished = sum(1 for result in results if not isinstance(result, BaseException))
+    embed = discord.Embed(
+        title=f"Finished {finished} of {len(links)}", description="\n".join(lines)[:4096], color=0xffcccb
+    )
+    await ctx.send(embed=embed, ephemeral=True)
 
 
 @bot.tree.context_menu(name="download video")
 @app_commands.user_install()
 @app_commands.allowed_contexts(guilds=True, dms=True, private_channels=True)
 async def context_download(interaction: Interaction, message: discord.Message) -> None:
-    try:
-        url_parsed = await URLParsed.transform(interaction, message.content)
-    except UserErrorUsage:
-        if not message.embeds:
-            raise UserErrorUsage("No URL with a compatible parser found in this message!")
-
-        try:
-            embed_data = str([e.to_dict() for e in message.embeds])
-            url_parsed = await URLParsed.transform(interaction, embed_data)
-        except UserErrorUsage:
-            raise UserErrorUsage("No URL with a compatible parser found in this message!")
+    links = DISPATCHER.find_all(message_text(message))
+    if not links:
+        raise UserErrorUsage("No URL with a compatible parser found in this message!")
 
+    links = links[:bot.max_batch_links]
     ctx = await bot.get_context(interaction)
-    file_type = await ViewFormatType.ask(ctx,
-        f"Found `{url_parsed.url}` compatible with **{url_parsed.type}**."
-        f"\nSelect a format:"
-    )
+    if len(links) == 1:
+        found = f"Found `{links[0].url}` compatible with **{links[0].type}**."
+    else:
+        found = f"Found {len(links)} compatible links:\n" + "\n".join(f"- `{link.url}` (**{link.type}**)" for link in links)
+
+    file_type = await ViewFormatType.ask(ctx, f"{found}\nSelect a format:")
     try:
         preset = await ViewCompressionType.ask(ctx, f"\nSelect a compression preset:")
     except TimeoutResponding:
         preset = CompressionType.medium
 
-    await download_flow(ctx, url_parsed, file_type, preset)
+    if len(links) == 1:
+        await download_flow(ctx, links[0], file_type, preset)
+    else:
+        await batch_download(ctx, links, file_type, preset)
 
 
 @bot.tree.error
@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+from core.cache import ResultCache
+from core.models import FileType, CompressionType
+
+
+class Link:
+    canonical_id = "YouTubeDownloader:abc"
+    size_limit = None
+
+
+class ResultCacheTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = ResultCache(os.path.join(self.directory.name, "results"), 1024 * 1024, url_ttl=60)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def source(self, content: bytes) -> str:
+        path = os.path.join(self.directory.name, "file.mp4")
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    async def test_put_replaces_streamed_entry(self):
+        await self.cache.put_url(Link(), FileType.video, CompressionType.low, "https://example.com/streamed.mp4")
+
+        entry = await self.cache.put(Link(), FileType.video, CompressionType.low, self.source(b"encoded"))
+
+        self.assertIsNotNone(entry.path)
+        self.assertIsNone(entry.cached_url)
+        self.assertIs(self.cache.get(Link(), FileType.video, CompressionType.low), entry)
+        with open(entry.path, "rb") as f:
+            self.assertEqual(f.read(), b"encoded")
+
+    async def test_streamed_entry_survives_reload(self):
+        await self.cache.put_url(Link(), FileType.video, CompressionType.low, "https://example.com/streamed.mp4")
+
+        reloaded = ResultCache(self.cache.directory, self.cache.max_bytes, self.cache.url_ttl)
+
+        entry = reloaded.get(Link(), FileType.video, CompressionType.low)
+        self.assertIsNone(entry.path)
+        self.assertEqual(entry.cached_url, "https://example.com/streamed.mp4")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,25 @@
+import asyncio
+import logging
+
+from dotenv import load_dotenv
+
+from core.broker import create_broker
+from core.worker import JobWorker
+
+load_dotenv()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)-8s %(name)s %(message)s")
+    broker = create_broker()
+    if broker is None:
+        raise SystemExit("Set JOB_QUEUE to 'sqlite' or 'redis' to run a worker.")
+
+    try:
+        asyncio.run(JobWorker(broker).run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()